@@ -17,14 +17,20 @@
 """Cloud Pub/Sub sample application."""
 
 
-import base64
+import calendar
+import datetime
 import json
 import logging
+import random
 import re
-import urllib
+import threading
+import time
+import zlib
 
-from apiclient import errors
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 import jinja2
@@ -32,7 +38,12 @@ import jinja2
 import webapp2
 
 import constants
+import pubsub_codec
+import pubsub_latency
+import pubsub_profile
+import pubsub_transport
 import pubsub_utils
+import push_envelope
 
 
 JINJA2 = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'),
@@ -43,13 +54,191 @@ JINJA2 = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'),
 
 MAX_ITEM = 20
 
+# Codecs to encode published messages with, e.g. 'zlib'; see pubsub_codec.
+PUBLISH_CODEC = None
+
+# Fraction of requests to profile and log; requests with a 'profile' query
+# parameter are profiled too, for administrators or on the dev server. See
+# pubsub_profile.ProfileMiddleware.
+PROFILE_SAMPLE_RATE = 0
+
 MESSAGE_CACHE_KEY = 'messages_key'
 
+# Every instance logs the latency of the messages pushed to it this often;
+# see pubsub_latency. Instances see an arbitrary share of the messages each,
+# so they don't count gaps or duplicates in the probe sequences.
+LATENCY_REPORT_SECONDS = 60
+
+# Memcache key prefix and lifetime for the recently seen message IDs.
+# Pub/Sub push is at-least-once, so the same message can be delivered more
+# than once; memcache evicts the least recently used IDs on its own.
+SEEN_MESSAGE_KEY_PREFIX = 'seen_message_'
+
+SEEN_MESSAGE_TTL = 60 * 60
+
+
+# Messages are spread over this many shards so that writes don't all land
+# on the tail of a single monotonically increasing index.
+NUM_SHARDS = 16
+
+# Messages are grouped into time buckets of this many seconds, and buckets
+# older than MESSAGE_RETENTION_BUCKETS are deleted as a whole.
+BUCKET_SECONDS = 60 * 60
+
+MESSAGE_RETENTION_BUCKETS = 24
+
+EXPIRE_BATCH_SIZE = 500
+
+BACKFILL_BATCH_SIZE = 200
+
+
+class LatencyReporter(object):
+    """Records pushed messages, and logs their latency periodically."""
+
+    def __init__(self, report_seconds=LATENCY_REPORT_SECONDS):
+        self.probe = pubsub_latency.LatencyProbe(track_sequences=False)
+        self.report_seconds = report_seconds
+        self.lock = threading.Lock()
+        self.next_report = time.time() + report_seconds
+
+    def record(self, message):
+        self.probe.record(message)
+        with self.lock:
+            if time.time() < self.next_report:
+                return
+            self.next_report = time.time() + self.report_seconds
+        logging.info('Push latency:\n%s', self.probe.report())
+
+
+LATENCY = LatencyReporter()
+
+
+def get_bucket(dt):
+    """Returns the time bucket for a given datetime."""
+    return calendar.timegm(dt.utctimetuple()) // BUCKET_SECONDS
+
+
+def get_shard(message_id):
+    """Returns the shard of a message; random when it has no ID."""
+    if message_id:
+        return zlib.crc32(message_id) % NUM_SHARDS
+    return random.randrange(NUM_SHARDS)
+
+
+def get_shard_time(shard, dt):
+    """Returns the value of PubSubMessage.shard_time, which sorts by time
+    within a shard."""
+    return '{:02x}-{}'.format(shard, dt.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+
 
 class PubSubMessage(ndb.Model):
-    """A model stores pubsub message and the time when it arrived."""
-    message = ndb.StringProperty()
-    created_at = ndb.DateTimeProperty(auto_now_add=True)
+    """A model stores pubsub message and the time when it arrived.
+
+    Only shard_time and bucket are indexed. shard_time leads with the
+    shard, so new index rows land on NUM_SHARDS tails instead of one; the
+    recent messages query reads the head of each shard from it, and the
+    expiry uses bucket.
+    """
+    message = ndb.BlobProperty()
+    message_id = ndb.StringProperty(indexed=False)
+    attributes = ndb.JsonProperty()
+    publish_time = ndb.StringProperty(indexed=False)
+    shard = ndb.IntegerProperty(indexed=False)
+    bucket = ndb.IntegerProperty()
+    created_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    shard_time = ndb.StringProperty()
+
+    @classmethod
+    def from_push_message(cls, message):
+        """Creates an entity for a decoded push message.
+
+        The shard and the key are derived from the message ID when there is
+        one, so storing a redelivered message overwrites the same entity.
+        """
+        shard = get_shard(message.message_id)
+        key_name = None
+        if message.message_id:
+            key_name = '{:x}-{}'.format(shard, message.message_id)
+        now = datetime.datetime.utcnow()
+        return cls(id=key_name,
+                   message=message.data,
+                   message_id=message.message_id,
+                   attributes=message.attributes or None,
+                   publish_time=message.publish_time,
+                   shard=shard,
+                   bucket=get_bucket(now),
+                   created_at=now,
+                   shard_time=get_shard_time(shard, now))
+
+    @classmethod
+    def fetch_recent(cls, limit):
+        """Returns the most recent messages by merging the shard heads."""
+        futures = []
+        for shard in range(NUM_SHARDS):
+            # The values of a shard sort between '<shard>-' and '<shard>.'.
+            prefix = '{:02x}'.format(shard)
+            futures.append(
+                cls.query(cls.shard_time > prefix + '-',
+                          cls.shard_time < prefix + '.')
+                .order(-cls.shard_time).fetch_async(limit))
+        messages = [message for future in futures
+                    for message in future.get_result()]
+        messages.sort(key=lambda message: message.created_at, reverse=True)
+        return messages[:limit]
+
+    @classmethod
+    def expire(cls, now=None):
+        """Deletes buckets older than the retention period.
+
+        Returns the number of deleted messages.
+        """
+        now = now or datetime.datetime.utcnow()
+        oldest_bucket = get_bucket(now) - MESSAGE_RETENTION_BUCKETS
+        query = cls.query(cls.bucket < oldest_bucket)
+        # Walk the results once: the query is eventually consistent, so
+        # fetching again after a delete may return the same keys.
+        deleted = 0
+        keys = []
+        for key in query.iter(keys_only=True, batch_size=EXPIRE_BATCH_SIZE):
+            keys.append(key)
+            if len(keys) == EXPIRE_BATCH_SIZE:
+                ndb.delete_multi(keys)
+                deleted += len(keys)
+                keys = []
+        if keys:
+            ndb.delete_multi(keys)
+            deleted += len(keys)
+        return deleted
+
+    def backfill(self):
+        """Sets the fields added since the entity was stored, if missing.
+
+        Returns whether any was.
+        """
+        if self.shard_time:
+            return False
+        if self.shard is None:
+            self.shard = get_shard(self.message_id)
+        if self.created_at is None:
+            self.created_at = datetime.datetime.utcnow()
+        if self.bucket is None:
+            self.bucket = get_bucket(self.created_at)
+        self.shard_time = get_shard_time(self.shard, self.created_at)
+        return True
+
+    @classmethod
+    def backfill_page(cls, cursor=None):
+        """Backfills a page of entities, in key order.
+
+        Returns the number updated and the cursor of the next page, or
+        None after the last one.
+        """
+        messages, cursor, more = cls.query().order(cls._key).fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        updated = [message for message in messages if message.backfill()]
+        # Rewriting the entity also rewrites its indexed properties.
+        ndb.put_multi(updated)
+        return len(updated), cursor if more else None
 
 
 class InitHandler(webapp2.RequestHandler):
@@ -57,7 +246,7 @@ class InitHandler(webapp2.RequestHandler):
     def __init__(self, request=None, response=None):
         """Calls the constructor of the super and does the local setup."""
         super(InitHandler, self).__init__(request, response)
-        self.client = pubsub_utils.get_client()
+        self.transport = pubsub_utils.get_transport()
         self._setup_topic()
         self._setup_subscription()
 
@@ -65,12 +254,10 @@ class InitHandler(webapp2.RequestHandler):
         """Creates a topic if it does not exist."""
         topic_name = pubsub_utils.get_full_topic_name()
         try:
-            self.client.projects().topics().get(
-                topic=topic_name).execute()
-        except errors.HttpError as e:
-            if e.resp.status == 404:
-                self.client.projects().topics().create(
-                    name=topic_name, body={}).execute()
+            self.transport.get_topic(topic_name)
+        except pubsub_transport.TransportError as e:
+            if e.status == 404:
+                self.transport.create_topic(topic_name)
             else:
                 logging.exception(e)
                 raise
@@ -79,18 +266,12 @@ class InitHandler(webapp2.RequestHandler):
         """Creates a subscription if it does not exist."""
         subscription_name = pubsub_utils.get_full_subscription_name()
         try:
-            self.client.projects().subscriptions().get(
-                subscription=subscription_name).execute()
-        except errors.HttpError as e:
-            if e.resp.status == 404:
-                body = {
-                    'topic': pubsub_utils.get_full_topic_name(),
-                    'pushConfig': {
-                        'pushEndpoint': pubsub_utils.get_app_endpoint_url()
-                    }
-                }
-                self.client.projects().subscriptions().create(
-                    name=subscription_name, body=body).execute()
+            self.transport.get_subscription(subscription_name)
+        except pubsub_transport.TransportError as e:
+            if e.status == 404:
+                self.transport.create_subscription(
+                    subscription_name, pubsub_utils.get_full_topic_name(),
+                    push_endpoint=pubsub_utils.get_app_endpoint_url())
             else:
                 logging.exception(e)
                 raise
@@ -115,31 +296,28 @@ class FetchMessages(webapp2.RequestHandler):
         """Returns recent messages as a json."""
         messages = memcache.get(MESSAGE_CACHE_KEY)
         if not messages:
-            messages = PubSubMessage.query().order(
-                -PubSubMessage.created_at).fetch(MAX_ITEM)
+            messages = PubSubMessage.fetch_recent(MAX_ITEM)
             memcache.add(MESSAGE_CACHE_KEY, messages)
         self.response.headers['Content-Type'] = ('application/json;'
                                                  ' charset=UTF-8')
         self.response.write(
             json.dumps(
-                [message.message for message in messages]))
+                [message.message.decode('utf-8', 'replace')
+                 for message in messages]))
 
 
 class SendMessage(webapp2.RequestHandler):
     """A handler publishes the given message."""
     def post(self):
         """Publishes the message via the Pub/Sub API."""
-        client = pubsub_utils.get_client()
+        transport = pubsub_utils.get_transport()
         message = self.request.get('message')
         if message:
             topic_name = pubsub_utils.get_full_topic_name()
-            body = {
-                'messages': [{
-                    'data': base64.b64encode(message.encode('utf-8'))
-                }]
-            }
-            client.projects().topics().publish(
-                topic=topic_name, body=body).execute()
+            data, attributes = pubsub_codec.encode_message(
+                message.encode('utf-8'), codec=PUBLISH_CODEC)
+            transport.publish(topic_name, [
+                pubsub_transport.make_message(data, attributes)])
         self.response.status = 204
 
 
@@ -150,22 +328,96 @@ class ReceiveMessage(webapp2.RequestHandler):
             self.response.status = 404
             return
 
-        # Store the message in the datastore.
-        logging.debug('Post body: {}'.format(self.request.body))
-        message = json.loads(urllib.unquote(self.request.body).rstrip('='))
-        message_body = base64.b64decode(str(message['message']['data']))
-        pubsub_message = PubSubMessage(message=message_body)
-        pubsub_message.put()
+        try:
+            with pubsub_profile.span('decode'):
+                message = push_envelope.decode(self.request.body)
+                message = message._replace(data=pubsub_codec.decode(
+                    message.data, message.attributes))
+        except push_envelope.InvalidPushEnvelope as e:
+            # Redelivering a malformed body would never succeed, so
+            # acknowledge it instead of asking for a retry.
+            logging.warning(e)
+            self.response.status = 200
+            return
+        except pubsub_codec.CodecError as e:
+            # The envelope is fine, so this is a message of ours we can't
+            # decode, e.g. with a codec of a newer version; leave it to be
+            # redelivered, with Pub/Sub's backoff, rather than lose it.
+            logging.error(e)
+            self.response.status = 400
+            return
+        # Before the duplicate check, so that redeliveries are counted.
+        LATENCY.record(message)
+        message_id = message.message_id
+
+        # Acknowledge redeliveries we have already stored without touching
+        # the datastore. Only a get hit counts as seen, so when memcache is
+        # unavailable the message falls through to the idempotent put below.
+        seen_key = None
+        if message_id:
+            seen_key = SEEN_MESSAGE_KEY_PREFIX + message_id
+            if memcache.get(seen_key):
+                logging.debug('Duplicate message: {}'.format(message_id))
+                self.response.status = 200
+                return
+
+        # Store the message in the datastore. Keying the entity by the
+        # message ID makes the put idempotent when a duplicate gets past the
+        # memcache check, e.g. one that arrives while this put is running.
+        pubsub_message = PubSubMessage.from_push_message(message)
+        with pubsub_profile.span('datastore put'):
+            pubsub_message.put()
+        # Only mark the message as seen once it is stored, so that a
+        # redelivery after a failed put is stored rather than acknowledged.
+        if seen_key:
+            memcache.set(seen_key, True, time=SEEN_MESSAGE_TTL)
 
         # Invalidate the cache
         memcache.delete(MESSAGE_CACHE_KEY)
         self.response.status = 200
 
 
-APPLICATION = webapp2.WSGIApplication(
+class BackfillMessages(webapp2.RequestHandler):
+    """A task handler that backfills the fields of messages stored before
+    they were sharded and bucketed, so that they are listed and expired.
+
+    It handles a page per request, and queues itself for the next one;
+    request /tasks/backfill_messages once after deploying.
+    """
+    def get(self):
+        cursor = self.request.get('cursor')
+        updated, cursor = PubSubMessage.backfill_page(
+            Cursor(urlsafe=cursor) if cursor else None)
+        logging.info('Backfilled {} messages.'.format(updated))
+        if cursor:
+            taskqueue.add(url='/tasks/backfill_messages', method='GET',
+                          params={'cursor': cursor.urlsafe()})
+        else:
+            memcache.delete(MESSAGE_CACHE_KEY)
+        self.response.status = 204
+
+
+class ExpireMessages(webapp2.RequestHandler):
+    """A cron handler deletes expired message buckets."""
+    def get(self):
+        deleted = PubSubMessage.expire()
+        logging.info('Deleted {} expired messages.'.format(deleted))
+        memcache.delete(MESSAGE_CACHE_KEY)
+        self.response.status = 204
+
+
+def may_profile(environ):
+    """Whether a request may ask to be profiled with a 'profile' query
+    parameter."""
+    return pubsub_utils.is_devserver() or users.is_current_user_admin()
+
+
+APPLICATION = pubsub_profile.ProfileMiddleware(webapp2.WSGIApplication(
     [
         ('/', InitHandler),
         ('/fetch_messages', FetchMessages),
         ('/send_message', SendMessage),
         ('/_ah/push-handlers/receive_message', ReceiveMessage),
-    ], debug=True)
+        ('/tasks/expire_messages', ExpireMessages),
+        ('/tasks/backfill_messages', BackfillMessages),
+    ], debug=True), sample_rate=PROFILE_SAMPLE_RATE, may_profile=may_profile)
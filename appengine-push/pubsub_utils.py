@@ -28,6 +28,7 @@ import httplib2
 from oauth2client.client import GoogleCredentials
 
 import constants
+import pubsub_transport
 
 
 APPLICATION_NAME = "google-cloud-pubsub-appengine-sample/1.0"
@@ -51,6 +52,13 @@ def get_client():
     return client_store.client
 
 
+def get_transport():
+    """Returns a Pub/Sub transport using the client from get_client."""
+    if not hasattr(client_store, 'transport'):
+        client_store.transport = pubsub_transport.RestTransport(get_client())
+    return client_store.transport
+
+
 def get_client_from_credentials(credentials):
     """Creates Pub/Sub client from a given credentials and returns it."""
     if credentials.create_scoped_required():
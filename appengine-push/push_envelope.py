@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Decoder for the JSON envelope of Pub/Sub push requests.
+
+A push request body looks like:
+
+    {
+      "message": {
+        "data": "<base64>",
+        "attributes": {"key": "value"},
+        "messageId": "123",
+        "publishTime": "2016-01-01T00:00:00.000Z"
+      },
+      "subscription": "projects/<project>/subscriptions/<subscription>"
+    }
+"""
+
+import base64
+import binascii
+import collections
+import json
+import logging
+import urllib
+
+
+# How much of the body is logged when debug logging is enabled.
+MAX_LOGGED_BODY = 1024
+
+log = logging.getLogger(__name__)
+
+
+PushMessage = collections.namedtuple(
+    'PushMessage',
+    ['data', 'attributes', 'message_id', 'publish_time', 'subscription'])
+
+
+class InvalidPushEnvelope(ValueError):
+    """Raised when a push request body can not be decoded."""
+
+
+def _load_envelope(body):
+    """Parses the JSON envelope, falling back to the legacy encoding."""
+    try:
+        return json.loads(body)
+    except ValueError:
+        pass
+    # Older endpoints received the envelope url-encoded with padding
+    # appended; only pay for the extra copies in that case.
+    try:
+        return json.loads(urllib.unquote(body).rstrip('='))
+    except ValueError as e:
+        raise InvalidPushEnvelope('Malformed push envelope: {}'.format(e))
+
+
+def _check_type(name, value, expected):
+    """Raises InvalidPushEnvelope unless value is None or an expected."""
+    if value is not None and not isinstance(value, expected):
+        raise InvalidPushEnvelope('Push envelope {} is a {}'.format(
+            name, type(value).__name__))
+
+
+def decode(body):
+    """Decodes a push request body into a PushMessage.
+
+    The envelope is parsed once and the payload is returned as a byte
+    string, so binary payloads survive unchanged.
+    """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Post body (%d bytes): %s', len(body),
+                  body[:MAX_LOGGED_BODY])
+
+    envelope = _load_envelope(body)
+    if not isinstance(envelope, dict) or 'message' not in envelope:
+        raise InvalidPushEnvelope('Push envelope has no message')
+    message = envelope['message']
+    if not isinstance(message, dict):
+        raise InvalidPushEnvelope('Push envelope message is a {}'.format(
+            type(message).__name__))
+    for field in ('data', 'messageId', 'publishTime'):
+        _check_type(field, message.get(field), basestring)
+    _check_type('attributes', message.get('attributes'), dict)
+    _check_type('subscription', envelope.get('subscription'), basestring)
+
+    data = message.get('data')
+    if data:
+        try:
+            data = base64.b64decode(data)
+        except (TypeError, binascii.Error) as e:
+            raise InvalidPushEnvelope('Malformed message data: {}'.format(e))
+    else:
+        data = ''
+
+    return PushMessage(data=data,
+                       attributes=message.get('attributes') or {},
+                       message_id=message.get('messageId'),
+                       publish_time=message.get('publishTime'),
+                       subscription=envelope.get('subscription'))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Microbenchmark for decoding push request bodies.
+
+Compares push_envelope.decode with the decoding that ReceiveMessage used
+to do inline, over payload sizes from 100B to 10MB:
+
+% python push_envelope_benchmark.py
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import timeit
+import urllib
+
+import push_envelope
+
+
+PAYLOAD_SIZES = [100, 1000, 10 * 1000, 100 * 1000, 1000 * 1000,
+                 10 * 1000 * 1000]
+
+
+def make_body(size):
+    """Returns a push request body carrying a random payload of size bytes."""
+    return json.dumps({
+        'message': {
+            'data': base64.b64encode(os.urandom(size)),
+            'attributes': {'timestamp': '1262304000000'},
+            'messageId': '12345',
+            'publishTime': '2016-01-01T00:00:00.000Z'
+        },
+        'subscription': 'projects/project/subscriptions/subscription'
+    })
+
+
+def legacy_decode(body):
+    """The decoding ReceiveMessage did before push_envelope existed."""
+    logging.debug('Post body: {}'.format(body))
+    message = json.loads(urllib.unquote(body).rstrip('='))
+    return base64.b64decode(str(message['message']['data']))
+
+
+def run(sizes, min_time):
+    """Times both decoders for each size and prints a table."""
+    print '{:>10} {:>14} {:>14} {:>8}'.format(
+        'size', 'legacy (us)', 'decode (us)', 'speedup')
+    for size in sizes:
+        body = make_body(size)
+        results = []
+        for func in (legacy_decode, push_envelope.decode):
+            timer = timeit.Timer(lambda: func(body))
+            number = 1
+            while timer.timeit(number) < min_time:
+                number *= 10
+            results.append(min(timer.repeat(3, number)) / number * 1e6)
+        print '{:>10} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(
+            size, results[0], results[1], results[0] / results[1])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark decoding of Pub/Sub push request bodies')
+    parser.add_argument('--sizes', type=int, nargs='+', default=PAYLOAD_SIZES,
+                        help='Payload sizes in bytes')
+    parser.add_argument('--min_time', type=float, default=0.2,
+                        help='Minimum seconds spent on each measurement')
+    args = parser.parse_args(argv[1:])
+    run(args.sizes, args.min_time)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Load generator for the push endpoint of this sample.
+
+Replays Pub/Sub push requests against the ReceiveMessage handler and
+reports throughput, latency percentiles and error rates.
+
+Run it in-process against main.APPLICATION with datastore and memcache
+stubs from the App Engine SDK. This mode also counts the datastore and
+memcache calls made per message:
+
+% python push_load_generator.py --sdk_path ~/google-cloud-sdk/platform/\
+google_appengine --messages 5000 --concurrency 8 --payload_size 1024
+
+Or run it against a dev server started with dev_appserver.py:
+
+% python push_load_generator.py --host localhost:8080 --messages 5000
+"""
+
+import argparse
+import base64
+import collections
+import json
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+
+import constants
+
+
+PUSH_PATH = '/_ah/push-handlers/receive_message?token={}'
+
+SUBSCRIPTION = 'projects/load-test/subscriptions/load-test'
+
+# Handlers under /_ah/push-handlers/ require an admin on the dev server.
+DEV_APPSERVER_ADMIN_COOKIE = (
+    'dev_appserver_login="test@example.com:True:185804764220139124118"')
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def make_envelope(message_id, payload_size):
+    """Returns a push request body like the ones Pub/Sub sends."""
+    return json.dumps({
+        'message': {
+            'data': base64.b64encode(os.urandom(payload_size)),
+            'attributes': {'timestamp': str(int(time.time() * 1000))},
+            'messageId': str(message_id),
+            'publishTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                         time.gmtime())
+        },
+        'subscription': SUBSCRIPTION
+    })
+
+
+class InProcessTarget(object):
+    """Sends push requests to main.APPLICATION in this process."""
+
+    def __init__(self, sdk_path):
+        sys.path.insert(0, sdk_path)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_app_identity_stub()
+
+        self.api_calls = collections.Counter()
+        self.lock = threading.Lock()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'push_load_generator', self._count_call)
+
+        import appengine_config  # noqa: vendors the libraries in lib
+        import main
+        import webapp2
+        self.application = main.APPLICATION
+        self.request_class = webapp2.Request
+
+    def _count_call(self, service, call, request, response):
+        """Counts an App Engine API call."""
+        with self.lock:
+            self.api_calls[service] += 1
+
+    def post(self, path, body):
+        """Sends a push request and returns the response status."""
+        request = self.request_class.blank(
+            path, method='POST', body=body,
+            headers={'Content-Type': 'application/json'})
+        return request.get_response(self.application).status_int
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+class HttpTarget(object):
+    """Sends push requests to a running server over HTTP."""
+
+    def __init__(self, host):
+        import httplib2
+        self.http_class = httplib2.Http
+        self.host = host
+        self.api_calls = None
+        self.local = threading.local()
+
+    def post(self, path, body):
+        """Sends a push request and returns the response status."""
+        # httplib2.Http objects are not thread safe.
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.http_class()
+        resp, _ = self.local.http.request(
+            'http://{}{}'.format(self.host, path), 'POST', body=body,
+            headers={'Content-Type': 'application/json',
+                     'Cookie': DEV_APPSERVER_ADMIN_COOKIE})
+        return resp.status
+
+    def close(self):
+        pass
+
+
+class Stats(object):
+    """Collects the outcome of every push request."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def record(self, latency, status):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            if not 200 <= status < 300:
+                self.errors += 1
+
+    def percentile(self, p):
+        """Returns the p-th percentile latency in seconds, or None when no
+        request completed."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        index = int(round(p / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+
+def worker(target, path, work, stats):
+    """Sends the push requests from the work queue."""
+    while True:
+        body = work.get()
+        if body is None:
+            return
+        start = time.time()
+        try:
+            status = target.post(path, body)
+        except Exception as e:
+            print 'Request failed: {}'.format(e)
+            status = 0
+        stats.record(time.time() - start, status)
+
+
+def run(target, args):
+    """Replays push requests and returns the Stats."""
+    path = PUSH_PATH.format(args.token)
+    # Build the bodies up front so encoding is not measured.
+    bodies = []
+    for i in range(args.messages):
+        if bodies and random.random() < args.duplicates:
+            bodies.append(random.choice(bodies))
+        else:
+            bodies.append(make_envelope(i, args.payload_size))
+
+    work = Queue.Queue()
+    for body in bodies:
+        work.put(body)
+    stats = Stats()
+    threads = [threading.Thread(target=worker,
+                                args=(target, path, work, stats))
+               for _ in range(args.concurrency)]
+    for _ in threads:
+        work.put(None)
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats.elapsed = time.time() - start
+    return stats
+
+
+def report(stats, api_calls, args):
+    """Prints the results of a run."""
+    count = len(stats.latencies)
+    print 'messages: {}, concurrency: {}, payload: {} bytes'.format(
+        count, args.concurrency, args.payload_size)
+    if not count:
+        print 'no request completed'
+        return
+    print 'throughput: {:.1f} msgs/s'.format(
+        count / max(stats.elapsed, 1e-9))
+    print 'latency (ms): {}, max {:.2f}'.format(
+        ', '.join('p{} {:.2f}'.format(p, stats.percentile(p) * 1000)
+                  for p in PERCENTILES),
+        max(stats.latencies) * 1000)
+    print 'errors: {} ({:.2%})'.format(stats.errors,
+                                       float(stats.errors) / count)
+    print 'statuses: {}'.format(dict(stats.statuses))
+    if api_calls is not None:
+        for service in sorted(api_calls):
+            print '{} calls/message: {:.2f}'.format(
+                service, float(api_calls[service]) / count)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Generate load on the push endpoint')
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument(
+        '--sdk_path',
+        help='Path to the App Engine SDK; runs main.APPLICATION in-process')
+    target_group.add_argument(
+        '--host', help='host:port of a running dev server')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='Number of push requests to send')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of concurrent requests')
+    parser.add_argument('--payload_size', type=int, default=256,
+                        help='Size of each message payload in bytes')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='Fraction of requests that redeliver an '
+                        'earlier message')
+    parser.add_argument('--token', default=constants.SUBSCRIPTION_UNIQUE_TOKEN,
+                        help='The SUBSCRIPTION_UNIQUE_TOKEN of the app')
+    args = parser.parse_args(argv[1:])
+    if args.messages < 1:
+        parser.error('--messages must be at least 1')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    if args.sdk_path:
+        target = InProcessTarget(os.path.expanduser(args.sdk_path))
+    else:
+        target = HttpTarget(args.host)
+    try:
+        stats = run(target, args)
+    finally:
+        target.close()
+    report(stats, target.api_calls, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
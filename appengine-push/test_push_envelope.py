@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the push envelope decoder."""
+
+import base64
+import json
+import unittest
+import urllib
+
+import push_envelope
+
+
+def make_body(data, **message):
+    """Returns a push request body for the given payload."""
+    message['data'] = base64.b64encode(data)
+    return json.dumps({'message': message,
+                       'subscription': 'projects/p/subscriptions/s'})
+
+
+class DecodeTestCase(unittest.TestCase):
+    """A test case for push_envelope.decode."""
+
+    def test_decode(self):
+        """Test that every field of the envelope is exposed."""
+        body = make_body('=@~message', attributes={'k': 'v'},
+                         messageId='42', publishTime='2016-01-01T00:00:00Z')
+        message = push_envelope.decode(body)
+        self.assertEqual('=@~message', message.data)
+        self.assertEqual({'k': 'v'}, message.attributes)
+        self.assertEqual('42', message.message_id)
+        self.assertEqual('2016-01-01T00:00:00Z', message.publish_time)
+        self.assertEqual('projects/p/subscriptions/s', message.subscription)
+
+    def test_decode_binary(self):
+        """Test that a binary payload is returned unchanged."""
+        data = ''.join(chr(i) for i in range(256))
+        self.assertEqual(data, push_envelope.decode(make_body(data)).data)
+
+    def test_decode_legacy_encoding(self):
+        """Test a url-encoded body with trailing padding."""
+        body = urllib.quote(make_body('hello', messageId='1')) + '=='
+        message = push_envelope.decode(body)
+        self.assertEqual('hello', message.data)
+        self.assertEqual({}, message.attributes)
+
+    def test_decode_invalid(self):
+        """Test that malformed bodies raise InvalidPushEnvelope."""
+        for body in ('not json', '{}', '[]',
+                     json.dumps({'message': {'data': 'a'}})):
+            self.assertRaises(push_envelope.InvalidPushEnvelope,
+                              push_envelope.decode, body)
+
+    def test_decode_wrong_shape(self):
+        """Test that valid JSON of the wrong shape raises
+        InvalidPushEnvelope, rather than an error that would be retried."""
+        for envelope in ({'message': 5}, {'message': None},
+                         {'message': {'data': 5}},
+                         {'message': {'attributes': ['k']}},
+                         {'message': {'messageId': {}}},
+                         {'message': {}, 'subscription': 1}):
+            self.assertRaises(push_envelope.InvalidPushEnvelope,
+                              push_envelope.decode, json.dumps(envelope))
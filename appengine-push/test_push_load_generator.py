@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the push endpoint load generator."""
+
+import argparse
+import contextlib
+import StringIO
+import sys
+import unittest
+
+import push_load_generator
+
+
+@contextlib.contextmanager
+def captured_stdout():
+    """Captures the output, and discards the errors, of argparse."""
+    out, old_out, old_err = StringIO.StringIO(), sys.stdout, sys.stderr
+    try:
+        sys.stdout = out
+        sys.stderr = StringIO.StringIO()
+        yield out
+    finally:
+        sys.stdout, sys.stderr = old_out, old_err
+
+
+def make_args():
+    return argparse.Namespace(concurrency=2, payload_size=10)
+
+
+class StatsTestCase(unittest.TestCase):
+    """A test case for Stats and report."""
+
+    def make_stats(self, latencies, statuses):
+        stats = push_load_generator.Stats()
+        for latency, status in zip(latencies, statuses):
+            stats.record(latency, status)
+        stats.elapsed = 2.0
+        return stats
+
+    def test_percentile(self):
+        stats = self.make_stats([0.004, 0.001, 0.003, 0.002, 0.005],
+                                [200] * 5)
+        self.assertEqual(stats.percentile(0), 0.001)
+        self.assertEqual(stats.percentile(50), 0.003)
+        self.assertEqual(stats.percentile(100), 0.005)
+
+    def test_percentile_empty(self):
+        self.assertIsNone(push_load_generator.Stats().percentile(50))
+
+    def test_report(self):
+        stats = self.make_stats([0.001, 0.002, 0.003, 0.004],
+                                [200, 200, 204, 500])
+        with captured_stdout() as out:
+            push_load_generator.report(stats, {'datastore_v3': 6},
+                                       make_args())
+        output = out.getvalue()
+        self.assertIn('throughput: 2.0 msgs/s', output)
+        self.assertIn('errors: 1 (25.00%)', output)
+        self.assertIn('max 4.00', output)
+        self.assertIn('datastore_v3 calls/message: 1.50', output)
+
+    def test_report_nothing_completed(self):
+        with captured_stdout() as out:
+            push_load_generator.report(push_load_generator.Stats(), None,
+                                       make_args())
+        self.assertIn('no request completed', out.getvalue())
+
+    def test_messages_must_be_positive(self):
+        with captured_stdout():
+            with self.assertRaises(SystemExit):
+                push_load_generator.main(['push_load_generator.py',
+                                          '--host', 'localhost:8080',
+                                          '--messages', '0'])
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Checks the throughput and latency of the transports against baselines.
+
+Runs every scenario over the memory transport and over the rest
+transport against a pubsub_fake server, so it needs neither a project
+nor the network:
+
+- throughput: the publish and the pull+ack rates of transport_benchmark;
+- latency: the round trip of one message at a time, published, pulled
+  and acknowledged, as percentiles.
+
+Every scenario runs --repeats times and the median of each metric is
+compared with the baseline recorded in perf_baseline.json: rates may not
+fall by more than tolerance, and latencies may not rise by more than
+tolerance plus LATENCY_FLOOR_MS, so that the sub-millisecond round trips
+of the memory transport don't fail on scheduling noise. The exit status
+is 1 on a regression. After a deliberate change, record
+new baselines on a quiet machine with:
+
+% python perf_suite.py --record
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+import uuid
+
+import pubsub_fake
+from pubsub_latency import Histogram
+import pubsub_transport
+from transport_benchmark import run_workload
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'perf_baseline.json')
+
+TOLERANCE = 0.5  # machines differ; this catches regressions, not noise
+
+LATENCY_FLOOR_MS = 1.0  # latencies may rise this much on top of tolerance
+
+REPEATS = 5
+
+PROJECT = 'perf-suite'
+
+SUITE_TRANSPORTS = ['memory', 'rest']
+
+# Whether more is better, by the suffix of a metric name.
+HIGHER_IS_BETTER = {'msgs/s': True, 'ms': False}
+
+Result = collections.namedtuple(
+    'Result', ['metric', 'value', 'baseline', 'regressed'])
+
+
+def measure_latency(transport, project, args):
+    """Returns a Histogram of the publish, pull and ack round trips."""
+    random_id = uuid.uuid4()
+    topic = 'projects/{}/topics/latency-{}'.format(project, random_id)
+    subscription = 'projects/{}/subscriptions/latency-{}'.format(
+        project, random_id)
+    transport.create_topic(topic)
+    transport.create_subscription(subscription, topic)
+    histogram = Histogram()
+    try:
+        payload = os.urandom(args.payload_size)
+        for _ in range(args.round_trips):
+            start = time.time()
+            transport.publish(topic, [pubsub_transport.make_message(payload)])
+            received = []
+            while not received:
+                received = transport.pull(subscription, 1)
+            transport.acknowledge(subscription, [received[0].ack_id])
+            histogram.add(time.time() - start)
+        return histogram
+    finally:
+        transport.delete_subscription(subscription)
+        transport.delete_topic(topic)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_suite(transports, args):
+    """Returns {metric: median value} for every scenario over every
+    transport, each run args.repeats times."""
+    runs = collections.defaultdict(list)
+    for name, transport in transports:
+        for _ in range(args.repeats):
+            publish_rate, pull_rate = run_workload(transport, PROJECT, args)
+            runs['{}/publish msgs/s'.format(name)].append(publish_rate)
+            runs['{}/pull+ack msgs/s'.format(name)].append(pull_rate)
+            histogram = measure_latency(transport, PROJECT, args)
+            for percent in (50, 99):
+                runs['{}/round trip p{} ms'.format(name, percent)].append(
+                    histogram.percentile(percent) * 1e3)
+    return dict((metric, median(values)) for metric, values in runs.items())
+
+
+def compare(measured, baselines, tolerance=TOLERANCE,
+            latency_floor=LATENCY_FLOOR_MS):
+    """Returns a Result for every measured metric, in name order."""
+    results = []
+    for metric in sorted(measured):
+        value = measured[metric]
+        baseline = baselines.get(metric)
+        regressed = False
+        if baseline is not None:
+            if HIGHER_IS_BETTER[metric.rsplit(' ', 1)[-1]]:
+                regressed = value < baseline * (1 - tolerance)
+            else:
+                regressed = (value >
+                             baseline * (1 + tolerance) + latency_floor)
+        results.append(Result(metric, value, baseline, regressed))
+    return results
+
+
+def load_baselines(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Check the transports against performance baselines')
+    parser.add_argument('--transports', nargs='+', choices=SUITE_TRANSPORTS,
+                        default=SUITE_TRANSPORTS)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--payload_size', type=int, default=256)
+    parser.add_argument('--round_trips', type=int, default=200)
+    parser.add_argument('--repeats', type=int, default=REPEATS,
+                        help='Runs of every scenario to take the median of')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='Allowed fraction worse than the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--record', action='store_true',
+                        help='Save the results as the new baselines')
+    args = parser.parse_args(argv[1:])
+
+    with pubsub_fake.FakePubsubServer() as server:
+        os.environ[pubsub_transport.EMULATOR_HOST_ENV] = server.host
+        transports = [(name, pubsub_transport.create_transport(name))
+                      for name in args.transports]
+        measured = run_suite(transports, args)
+
+    if args.record:
+        baselines = load_baselines(args.baseline)
+        baselines.update(measured)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, separators=(',', ': '),
+                      sort_keys=True)
+            f.write('\n')
+        print 'Recorded {} baselines in {}'.format(len(measured),
+                                                   args.baseline)
+        return 0
+
+    results = compare(measured, load_baselines(args.baseline),
+                      args.tolerance)
+    print '{:<28} {:>10} {:>10}'.format('metric', 'value', 'baseline')
+    for result in results:
+        baseline = ('-' if result.baseline is None
+                    else '{:.2f}'.format(result.baseline))
+        print '{:<28} {:>10.2f} {:>10}{}'.format(
+            result.metric, result.value, baseline,
+            '  REGRESSED' if result.regressed else '')
+    regressions = sum(result.regressed for result in results)
+    if regressions:
+        print '{} of {} metrics regressed by more than {:.0%}'.format(
+            regressions, len(results), args.tolerance)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
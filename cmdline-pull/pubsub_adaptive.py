@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tunes batch sizes and concurrency online, AIMD style.
+
+An AdaptiveLimit is told the outcome of every request made with its
+value: how many messages it carried, how long it took, whether it was
+throttled, and whether a larger value could have been used at all (e.g.
+whether a pull came back full). Every window of requests it decides:
+
+- on throttling (HTTP 429 or 503) or errors, or when the requests took
+  longer than target_latency on average, it multiplies the value by
+  decrease;
+- when the throughput fell after the last increase, it undoes it;
+- otherwise, if most requests could have used more, it adds step.
+
+Every change is printed with its reason.
+"""
+
+import threading
+import time
+
+
+THROTTLED_STATUSES = (429, 503)
+
+WINDOW = 10  # requests per decision
+
+DECREASE = 0.5
+
+THROUGHPUT_TOLERANCE = 0.1  # a drop that undoes an increase
+
+
+def is_throttled(error):
+    """Tells whether an error asks the client to slow down."""
+    return getattr(error, 'status', None) in THROTTLED_STATUSES
+
+
+class AdaptiveLimit(object):
+    """An integer limit between minimum and maximum, tuned by AIMD."""
+
+    def __init__(self, name, initial, minimum=1, maximum=1000, step=1,
+                 decrease=DECREASE, target_latency=None, window=WINDOW,
+                 clock=time.time, log=None):
+        self.name = name
+        self.value = max(minimum, min(maximum, initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.window = window
+        self.clock = clock
+        self.log = log or _print
+        self.lock = threading.Lock()
+        self.last_rate = None
+        self.increased = False
+        self._start_window()
+
+    def _start_window(self):
+        self.window_start = self.clock()
+        self.requests = self.items = self.saturated = 0
+        self.throttled = self.failed = 0
+        self.seconds = 0.0
+
+    def observe(self, items, seconds, throttled=False, failed=False,
+                saturated=True):
+        """Records a request that carried items and took seconds."""
+        with self.lock:
+            self.requests += 1
+            self.items += items
+            self.seconds += seconds
+            self.throttled += bool(throttled)
+            self.failed += bool(failed)
+            self.saturated += bool(saturated)
+            if self.requests >= self.window:
+                self._decide()
+
+    def observe_error(self, error, items=0, seconds=0.0):
+        """Records a failed request."""
+        throttled = is_throttled(error)
+        self.observe(items, seconds, throttled=throttled,
+                     failed=not throttled)
+
+    def _decide(self):
+        elapsed = max(self.clock() - self.window_start, 1e-9)
+        rate = self.items / elapsed
+        latency = self.seconds / self.requests
+        old = self.value
+        increased = False
+        if self.throttled or self.failed:
+            reason = '{} throttled and {} failed of {} requests'.format(
+                self.throttled, self.failed, self.requests)
+            new = int(old * self.decrease)
+        elif self.target_latency and latency > self.target_latency:
+            reason = 'latency {:.3f}s over {:.3f}s'.format(
+                latency, self.target_latency)
+            new = int(old * self.decrease)
+        elif (self.increased and self.last_rate and
+              rate < self.last_rate * (1 - THROUGHPUT_TOLERANCE)):
+            reason = 'throughput fell from {:.0f}/s to {:.0f}/s'.format(
+                self.last_rate, rate)
+            new = old - self.step
+        elif self.saturated * 2 >= self.requests:
+            reason = 'throughput {:.0f}/s, latency {:.3f}s'.format(
+                rate, latency)
+            new = old + self.step
+            increased = True
+        else:
+            new = old
+        new = max(self.minimum, min(self.maximum, new))
+        self.increased = increased and new > old
+        self.last_rate = rate
+        self.value = new
+        self._start_window()
+        if new != old:
+            self.log('{}: {} -> {} ({})'.format(self.name, old, new, reason))
+
+
+def _print(line):
+    print line
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Payload codecs for the Cloud Pub/Sub samples.
+
+A publisher can encode payloads with one or more codecs, joined with '+'
+and applied left to right, e.g. 'row+zlib'. The codec is recorded in the
+CODEC_ATTRIBUTE message attribute, so consumers can decode any message
+without knowing how it was published.
+
+- zlib compresses the payload.
+- zstd compresses the payload with Zstandard; it needs the zstandard
+  package.
+- row packs a comma separated line, like a traffic sensor reading, into a
+  compact binary form. Integers, decimals and timestamps are stored as
+  varints, and anything else as a string, so decoding always returns the
+  original line.
+"""
+
+import calendar
+import re
+import time
+import zlib
+
+
+# Namespaced, so as not to take the attributes of other publishers for ours.
+CODEC_ATTRIBUTE = 'pubsub-samples-codec'
+
+CODECS = ['zlib', 'zstd', 'row']
+
+ZLIB_LEVEL = 6
+
+ROW_FORMAT_VERSION = 1
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_DECIMAL_RE = re.compile(r'^(-?)(0|[1-9][0-9]*)(?:\.([0-9]{1,31}))?$')
+
+_TIMESTAMP_RE = re.compile(
+    r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$')
+
+# Every field of the row format starts with a byte holding its type in the
+# low 3 bits. The high 5 bits hold the number of fraction digits of a
+# decimal, or the length of a string shorter than _LONG_STRING.
+_EMPTY, _INTEGER, _DECIMAL, _TIMESTAMP, _STRING = range(5)
+
+_TYPE_BITS = 3
+
+_TYPE_MASK = 0x07
+
+_LONG_STRING = 31
+
+
+class CodecError(ValueError):
+    """Raised for unknown codecs or payloads that can not be decoded."""
+
+
+def _append_varint(buf, value):
+    """Appends a non-negative integer to a bytearray as a varint."""
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(buf, pos):
+    """Returns (value, new position) of the varint at pos in a bytearray."""
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def _pack_field(buf, field):
+    """Appends one field of a row to a bytearray."""
+    if not field:
+        buf.append(_EMPTY)
+        return
+    m = _DECIMAL_RE.match(field)
+    if m:
+        sign, whole, fraction = m.groups()
+        value = int(whole + (fraction or ''))
+        if not (sign and value == 0):  # '-0' would lose its sign
+            value = -value if sign else value
+            if fraction is None:
+                buf.append(_INTEGER)
+            else:
+                buf.append(_DECIMAL | len(fraction) << _TYPE_BITS)
+            _append_varint(buf, _zigzag(value))
+            return
+    if _TIMESTAMP_RE.match(field):
+        try:
+            seconds = calendar.timegm(time.strptime(field, TIMESTAMP_FORMAT))
+        except ValueError:
+            seconds = None
+        if seconds is not None and seconds >= 0 and time.strftime(
+                TIMESTAMP_FORMAT, time.gmtime(seconds)) == field:
+            buf.append(_TIMESTAMP)
+            _append_varint(buf, seconds)
+            return
+    if len(field) < _LONG_STRING:
+        buf.append(_STRING | len(field) << _TYPE_BITS)
+    else:
+        buf.append(_STRING | _LONG_STRING << _TYPE_BITS)
+        _append_varint(buf, len(field))
+    buf.extend(field)
+
+
+def pack_row(line):
+    """Packs a comma separated line into the row format."""
+    buf = bytearray([ROW_FORMAT_VERSION])
+    for field in line.split(','):
+        _pack_field(buf, field)
+    return bytes(buf)
+
+
+def unpack_row(data):
+    """Returns the comma separated line packed in the row format."""
+    buf = bytearray(data)
+    if not buf or buf[0] != ROW_FORMAT_VERSION:
+        raise CodecError('Unknown row format version')
+    fields = []
+    pos = 1
+    try:
+        while pos < len(buf):
+            tag = buf[pos] & _TYPE_MASK
+            param = buf[pos] >> _TYPE_BITS
+            pos += 1
+            if tag == _EMPTY:
+                fields.append('')
+            elif tag == _INTEGER:
+                value, pos = _read_varint(buf, pos)
+                fields.append(str(_unzigzag(value)))
+            elif tag == _DECIMAL:
+                value, pos = _read_varint(buf, pos)
+                value = _unzigzag(value)
+                digits = str(abs(value)).rjust(param + 1, '0')
+                fields.append('{}{}.{}'.format('-' if value < 0 else '',
+                                               digits[:-param],
+                                               digits[-param:]))
+            elif tag == _TIMESTAMP:
+                value, pos = _read_varint(buf, pos)
+                fields.append(time.strftime(TIMESTAMP_FORMAT,
+                                            time.gmtime(value)))
+            elif tag == _STRING:
+                length = param
+                if length == _LONG_STRING:
+                    length, pos = _read_varint(buf, pos)
+                if pos + length > len(buf):
+                    raise IndexError
+                fields.append(str(buf[pos:pos + length]))
+                pos += length
+            else:
+                raise CodecError('Unknown row field tag {}'.format(tag))
+    except IndexError:
+        raise CodecError('Truncated row')
+    return ','.join(fields)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise CodecError('The zstd codec requires the zstandard package: '
+                         'pip install zstandard')
+    return zstandard
+
+
+_ENCODERS = {
+    'zlib': lambda data: zlib.compress(data, ZLIB_LEVEL),
+    'zstd': lambda data: _zstd().ZstdCompressor().compress(data),
+    'row': pack_row,
+}
+
+
+def _zstd_decompress(data):
+    zstandard = _zstd()
+    try:
+        return zstandard.ZstdDecompressor().decompress(data)
+    except zstandard.ZstdError as e:
+        raise CodecError('Malformed zstd payload: {}'.format(e))
+
+
+_DECODERS = {
+    'zlib': zlib.decompress,
+    'zstd': _zstd_decompress,
+    'row': unpack_row,
+}
+
+
+def split_codec(codec):
+    """Returns the names in a codec such as 'row+zlib'."""
+    names = codec.split('+')
+    for name in names:
+        if name not in _ENCODERS:
+            raise CodecError('Unknown codec: {}'.format(name))
+    return names
+
+
+def encode(data, codec):
+    """Encodes a payload with a codec such as 'row+zlib'."""
+    for name in split_codec(codec):
+        data = _ENCODERS[name](data)
+    return data
+
+
+def decode(data, attributes):
+    """Decodes a payload with the codec named in its attributes, if any."""
+    codec = (attributes or {}).get(CODEC_ATTRIBUTE)
+    if not codec:
+        return data
+    for name in reversed(split_codec(codec)):
+        try:
+            data = _DECODERS[name](data)
+        except CodecError:
+            raise
+        except (zlib.error, ValueError, OverflowError) as e:
+            raise CodecError('Malformed {} payload: {}'.format(name, e))
+    return data
+
+
+def encode_message(data, attributes=None, codec=None):
+    """Returns (data, attributes) of a message encoded with codec.
+
+    The given attributes are not modified.
+    """
+    if not codec:
+        return data, attributes
+    attributes = dict(attributes or {})
+    attributes[CODEC_ATTRIBUTE] = codec
+    return encode(data, codec), attributes
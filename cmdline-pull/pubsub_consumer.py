@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Processing of pulled messages: ordering, failures and dead letters.
+
+KeyedDispatcher hashes the key of every message, e.g. the station of a
+traffic reading, to one of several lanes. Each lane is a thread with a
+queue of its own, so messages with the same key are handled one at a
+time, in the order they were pulled, while different keys are handled
+in parallel. A lane acknowledges its messages after handling them, in
+order.
+
+Cloud Pub/Sub itself doesn't guarantee the order of delivery, so this
+keeps the order in which messages were pulled, and a message that is
+redelivered after its ack deadline is handled again out of order. Keep
+the lanes short enough to handle their messages within the deadline.
+When a message fails, the later messages of its key are held, i.e.
+handed back without handling them, until it is handled, dead-lettered,
+or MAX_HOLD_SECONDS have passed. A held message comes back after as long
+as the key has been waiting, from HOLD_SECONDS up to MAX_HOLD_DEADLINE,
+so the redeliveries of a blocked key back off exponentially.
+
+A handler is a function that gets a pubsub_transport.Message, and raises
+when it fails to handle it. A FailurePolicy counts how many times each
+message failed, and nacks it so that it is redelivered right away, until
+it failed max_attempts times: then it hands the message to a
+DeadLetterQueue, which stores it in a dead-letter topic or file in the
+background, and only acknowledges it once stored. So a poison message is
+set aside instead of being redelivered forever, while the healthy ones
+keep flowing. Without a DeadLetterQueue, the message is left to be
+redelivered after its ack deadline instead, which backs off the retries.
+
+The lanes and the DeadLetterQueue print from their own threads while
+holding print_lock; hold it too to print while they run.
+"""
+
+import base64
+import collections
+import json
+import os
+import Queue
+import threading
+import time
+import zlib
+
+import pubsub_codec
+import pubsub_profile
+import pubsub_transport
+
+
+LANES = 8
+
+MAX_LANE_DEPTH = 100  # messages queued per lane before dispatch() blocks
+
+ACK_BATCH_SIZE = 100
+
+HOLD_SECONDS = 1  # until a held message is first redelivered
+
+MAX_HOLD_DEADLINE = 60  # seconds until a held message is redelivered, at most
+
+MAX_HOLD_SECONDS = 600  # a key waits this long for its failed message
+
+MAX_ATTEMPTS = 5
+
+# Failed messages whose attempts are counted; the oldest are forgotten.
+MAX_TRACKED_MESSAGES = 100000
+
+DEAD_LETTER_BATCH_SIZE = 100
+
+DEAD_LETTER_MAX_LATENCY = 0.5  # seconds a dead letter waits for others
+
+MAX_ERROR_LENGTH = 1024
+
+print_lock = threading.RLock()
+
+
+def _print(line):
+    with print_lock:
+        print line
+
+
+def make_key_func(spec):
+    """Returns a function that gets the key of a pulled message.
+
+    spec is 'attribute:NAME' for the value of an attribute, or 'field:N'
+    for the Nth comma separated field of the decoded payload.
+    """
+    kind, _, name = spec.partition(':')
+    if kind == 'attribute' and name:
+        return lambda message: (message.attributes or {}).get(name)
+    if kind == 'field' and name.isdigit():
+        index = int(name)
+
+        def field(message):
+            fields = pubsub_codec.decode(
+                message.data, message.attributes).split(',')
+            return fields[index] if index < len(fields) else None
+        return field
+    raise ValueError('Invalid key: {}, expected attribute:NAME or '
+                     'field:N'.format(spec))
+
+
+def handle_batch(received_messages, handler, policy=None, stopping=None):
+    """Handles pulled messages, and returns the ack IDs of the ones to
+    acknowledge and of the ones to nack.
+
+    Without a policy, failed messages are neither, so they are redelivered
+    after their ack deadline. Once stopping() returns True, the messages
+    left are nacked without handling them.
+    """
+    ack_ids = []
+    nack_ids = []
+    for received in received_messages:
+        if stopping and stopping():
+            nack_ids.append(received.ack_id)
+            continue
+        try:
+            handler(received.message)
+        except Exception as e:
+            if policy is None:
+                _print('Failed to handle message {}: {}'.format(
+                    received.message.message_id, e))
+            elif policy.failed(received, e):
+                nack_ids.append(received.ack_id)
+            continue
+        if policy:
+            policy.succeeded(received.message)
+        ack_ids.append(received.ack_id)
+    return ack_ids, nack_ids
+
+
+class FailurePolicy(object):
+    """Decides what becomes of messages whose handler failed.
+
+    Delivery attempts are counted per message ID, by this process only.
+    Without dead_letters, failed messages are nacked until they failed
+    max_attempts times, and then left to their ack deadline.
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, dead_letters=None,
+                 max_tracked=MAX_TRACKED_MESSAGES):
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters
+        self.max_tracked = max_tracked
+        self.lock = threading.Lock()
+        self.attempts = collections.OrderedDict()
+        self.failures = 0
+
+    def succeeded(self, message):
+        if self.attempts:
+            with self.lock:
+                self.attempts.pop(message.message_id, None)
+
+    def retrying(self, message):
+        """Returns whether the message failed, and is to be delivered
+        again rather than dead-lettered."""
+        with self.lock:
+            return message.message_id in self.attempts
+
+    def failed(self, received, error):
+        """Returns whether the message is to be nacked, rather than left
+        to the dead-letter queue or to its ack deadline."""
+        message_id = received.message.message_id
+        with self.lock:
+            self.failures += 1
+            attempts = self.attempts.pop(message_id, 0) + 1
+            if attempts < self.max_attempts or not self.dead_letters:
+                self.attempts[message_id] = attempts
+                if len(self.attempts) > self.max_tracked:
+                    self.attempts.popitem(last=False)
+        _print('Failed to handle message {} (attempt {}): {}'.format(
+            message_id, attempts, error))
+        if attempts < self.max_attempts:
+            return True
+        if self.dead_letters:
+            self.dead_letters.put(received, error, attempts)
+        return False
+
+
+class DeadLetterTopic(object):
+    """Publishes dead letters to a topic, with the reason in attributes."""
+
+    def __init__(self, transport, topic):
+        self.transport = transport
+        self.topic = topic
+
+    def write(self, subscription, entries):
+        messages = []
+        for received, error, attempts in entries:
+            message = received.message
+            attributes = dict(message.attributes or {})
+            attributes.update({
+                'dead_letter_subscription': subscription,
+                'dead_letter_message_id': message.message_id or '',
+                'dead_letter_attempts': str(attempts),
+                'dead_letter_error': error[:MAX_ERROR_LENGTH],
+            })
+            messages.append(
+                pubsub_transport.make_message(message.data, attributes))
+        self.transport.publish(self.topic, messages)
+
+
+class DeadLetterFile(object):
+    """Appends dead letters to a file, as JSON lines."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, subscription, entries):
+        with open(self.path, 'a') as out:
+            for received, error, attempts in entries:
+                message = received.message
+                out.write(json.dumps({
+                    'subscription': subscription,
+                    'message_id': message.message_id,
+                    'publish_time': message.publish_time,
+                    'attributes': message.attributes,
+                    'data': base64.b64encode(message.data),
+                    'attempts': attempts,
+                    'error': error[:MAX_ERROR_LENGTH],
+                }) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+
+
+def make_dead_letter_sink(transport, spec):
+    """Returns a DeadLetterFile for 'file:PATH', else a DeadLetterTopic."""
+    if spec.startswith('file:'):
+        return DeadLetterFile(spec[len('file:'):])
+    return DeadLetterTopic(transport, spec)
+
+
+class DeadLetterQueue(object):
+    """Stores dead letters in batches, on a thread of its own, and
+    acknowledges them once stored.
+
+    When storing fails, the messages are nacked instead, so they come
+    back and are dead-lettered again.
+    """
+
+    def __init__(self, transport, subscription, sink,
+                 batch_size=DEAD_LETTER_BATCH_SIZE,
+                 max_latency=DEAD_LETTER_MAX_LATENCY):
+        self.transport = transport
+        self.subscription = subscription
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue = Queue.Queue()
+        self.stored = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, received, error, attempts):
+        self.queue.put((received, str(error), attempts))
+
+    def close(self, timeout=None):
+        """Stores what is queued, then stops the thread. Dead letters not
+        stored within timeout seconds are redelivered after their ack
+        deadline."""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(
+                        timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._store(batch)
+
+    def _store(self, batch):
+        ack_ids = [received.ack_id for received, _, _ in batch]
+        try:
+            self.sink.write(self.subscription, batch)
+        except Exception as e:
+            _print('Failed to store {} dead letters: {}'.format(len(batch),
+                                                                e))
+            try:
+                self.transport.modify_ack_deadline(
+                    self.subscription, ack_ids, 0)
+            except Exception:
+                pass  # they come back after their ack deadline anyway
+            return
+        self.stored += len(batch)
+        _print('Stored {} dead letters'.format(len(batch)))
+        try:
+            self.transport.acknowledge(self.subscription, ack_ids)
+        except Exception as e:
+            _print('Failed to acknowledge {} dead letters: {}'.format(
+                len(ack_ids), e))
+
+
+class KeyedDispatcher(object):
+    """Handles pulled messages on lanes chosen by the key of each message.
+
+    handler is called with each pubsub_transport.Message, on the thread
+    of its lane. Messages without a key are spread over the lanes by
+    message ID. When a handler raises, the message is not acknowledged
+    and will be redelivered; with a FailurePolicy, it is nacked or
+    dead-lettered as the policy decides. Until it is handled, the later
+    messages of its key are held, so that they aren't handled ahead of
+    it. Held messages, and those still queued when the dispatcher is
+    closed without drain, are nacked, and count as returned.
+    """
+
+    def __init__(self, transport, subscription, handler, key_func,
+                 lanes=LANES, max_lane_depth=MAX_LANE_DEPTH,
+                 ack_batch_size=ACK_BATCH_SIZE, policy=None):
+        self.transport = transport
+        self.subscription = subscription
+        self.handler = handler
+        self.key_func = key_func
+        self.policy = policy
+        self.ack_batch_size = ack_batch_size
+        self.lock = threading.Lock()
+        self.handled = [0] * lanes
+        self.failed = [0] * lanes
+        self.returned = [0] * lanes
+        self.stopping = threading.Event()
+        self.queues = [Queue.Queue(max_lane_depth) for _ in range(lanes)]
+        self.threads = [threading.Thread(target=self._run_lane, args=(i,))
+                        for i in range(lanes)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def key(self, message):
+        """Returns the key of a message, or else its message ID."""
+        try:
+            key = self.key_func(message)
+        except Exception:  # e.g. a payload that doesn't decode
+            key = None
+        if key is None:
+            key = message.message_id or ''
+        return key
+
+    def lane(self, message):
+        """Returns the lane of a message."""
+        key = self.key(message)
+        if isinstance(key, unicode):  # e.g. an attribute read from JSON
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % len(self.queues)
+
+    def dispatch(self, received_messages):
+        """Queues pulled messages on their lanes, in order."""
+        for received in received_messages:
+            self.queues[self.lane(received.message)].put(received)
+
+    def depths(self):
+        """Returns the number of messages queued on every lane."""
+        return [queue.qsize() for queue in self.queues]
+
+    def join(self):
+        """Waits until every dispatched message has been handled."""
+        for queue in self.queues:
+            queue.join()
+
+    def close(self, drain=True, timeout=None):
+        """Handles what is queued, or nacks it unless drain, then stops
+        the lanes. Returns whether they all stopped within timeout
+        seconds."""
+        if not drain:
+            self.stopping.set()
+        for queue in self.queues:
+            queue.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else
+                        max(deadline - time.time(), 0))
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def report(self):
+        with self.lock:
+            handled, failed = sum(self.handled), sum(self.failed)
+            returned = sum(self.returned)
+        depths = self.depths()
+        print ('handled {} messages, {} failed, {} returned; lane depths: '
+               'max {}, total {}: {}'.format(handled, failed, returned,
+                                             max(depths), sum(depths),
+                                             depths))
+
+    def _acknowledge(self, ack_ids, returned=None):
+        """Acknowledges ack_ids, and hands back the messages of returned,
+        {seconds until redelivered: ack IDs}; 0 seconds is a nack."""
+        returned = returned or {}
+        try:
+            if ack_ids:
+                with pubsub_profile.span('ack', messages=len(ack_ids)):
+                    self.transport.acknowledge(self.subscription, ack_ids)
+            for seconds, returned_ids in sorted(returned.items()):
+                self.transport.modify_ack_deadline(
+                    self.subscription, list(returned_ids), seconds)
+        except Exception as e:  # the messages will be redelivered
+            _print('Failed to acknowledge {} messages: {}'.format(
+                len(ack_ids) + sum(len(ids) for ids in returned.values()),
+                e))
+
+    def _handle(self, lane, received, failed_keys):
+        """Handles a message unless an earlier message of its key failed.
+
+        failed_keys maps the keys of the lane that wait for a failed
+        message to its message ID and the time it first failed. Returns
+        'ack', the seconds until the message is to be redelivered, 0 for a
+        nack, or None to leave it to its ack deadline.
+        """
+        message = received.message
+        key = self.key(message)
+        failed = failed_keys.get(key)
+        waited = failed and time.time() - failed[1]
+        if failed and failed[0] != message.message_id and (
+                waited < MAX_HOLD_SECONDS):
+            with self.lock:
+                self.returned[lane] += 1
+            return int(min(max(HOLD_SECONDS, waited), MAX_HOLD_DEADLINE))
+        with pubsub_profile.span('handle', lane=lane):
+            acked, nacked = handle_batch([received], self.handler,
+                                         self.policy)
+        with self.lock:
+            if acked:
+                self.handled[lane] += 1
+            else:
+                self.failed[lane] += 1
+        if acked:
+            failed_keys.pop(key, None)
+            return 'ack'
+        if self.policy and not self.policy.retrying(message):
+            failed_keys.pop(key, None)  # dead-lettered
+        elif not failed or failed[0] != message.message_id:
+            failed_keys[key] = (message.message_id, time.time())
+        return 0 if nacked else None
+
+    def _run_lane(self, lane):
+        queue = self.queues[lane]
+        ack_ids = []
+        returned = collections.defaultdict(list)
+        failed_keys = {}
+        while True:
+            received = queue.get()
+            if received is None:
+                self._acknowledge(ack_ids, returned)
+                queue.task_done()
+                return
+            if self.stopping.is_set():
+                outcome = 0
+                with self.lock:
+                    self.returned[lane] += 1
+            else:
+                outcome = self._handle(lane, received, failed_keys)
+            if outcome == 'ack':
+                ack_ids.append(received.ack_id)
+            elif outcome is not None:
+                returned[outcome].append(received.ack_id)
+            # Acknowledge before marking the last queued message done, so
+            # that join() returns only once everything is acknowledged.
+            count = len(ack_ids) + sum(len(ids) for ids in returned.values())
+            if count and (count >= self.ack_batch_size or queue.empty()):
+                self._acknowledge(ack_ids, returned)
+                ack_ids = []
+                returned = collections.defaultdict(list)
+            queue.task_done()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A local publishing daemon, and its client.
+
+PublishDaemon keeps a transport and a MultiTopicPublisher warm behind a
+Unix domain socket, so that short lived callers, such as one
+publish_message per line of a shell pipeline, hand their messages off
+instead of each creating a client and publishing on their own. Messages
+from all callers are batched together.
+
+The protocol is one JSON object per line. A request is
+{"topic": TOPIC, "messages": [{"data": BASE64, "attributes": {...}}]},
+and the reply is {"published": N} once the batches of the messages are
+published, or {"error": MESSAGE} when one of them failed. A connection
+may send any number of requests.
+
+The socket is in $XDG_RUNTIME_DIR, or else in a directory of the user's
+own in $TMPDIR, so that other users can't take its place.
+"""
+
+import base64
+import errno
+import json
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+import pubsub_publisher
+import pubsub_transport
+
+
+PRIVATE_DIR = os.path.join(os.environ.get('TMPDIR', '/tmp'),
+                           'pubsub-sample-{}'.format(os.getuid()))
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or PRIVATE_DIR,
+                           'pubsub-sample.sock')
+
+REPLY_TIMEOUT = 60  # seconds a request waits for its messages to publish
+
+
+class DaemonError(Exception):
+    """The daemon couldn't be reached, or refused a request."""
+
+
+def encode_request(topic, messages):
+    return json.dumps({
+        'topic': topic,
+        'messages': [{'data': base64.b64encode(message.data),
+                      'attributes': message.attributes}
+                     for message in messages]}) + '\n'
+
+
+def decode_request(line):
+    """Returns the (topic, messages) of a request line."""
+    request = json.loads(line)
+    messages = [pubsub_transport.make_message(
+        base64.b64decode(message['data']), message.get('attributes'))
+        for message in request['messages']]
+    return request['topic'], messages
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.daemon
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                topic, messages = decode_request(line)
+                daemon.publish(topic, messages)
+                reply = {'published': len(messages)}
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Receipt(object):
+    """Waits for the messages of a request to be published."""
+
+    def __init__(self, count):
+        self.count = count
+        self.error = None
+        self.done = threading.Event()
+
+    def update(self, error):
+        """Counts one message as published, or failed with error."""
+        self.count -= 1
+        if error is not None and self.error is None:
+            self.error = error
+        if self.count <= 0 or self.error is not None:
+            self.done.set()
+
+
+class PublishDaemon(object):
+    """Serves publish requests on a Unix domain socket.
+
+    The BatchPublisher arguments apply to the publisher of every topic. A
+    request that isn't published within reply_timeout seconds gets an
+    error, though its messages may still be published.
+    """
+
+    def __init__(self, transport, path=SOCKET_PATH,
+                 reply_timeout=REPLY_TIMEOUT, **kwargs):
+        self.path = path
+        self.reply_timeout = reply_timeout
+        self.publisher = pubsub_publisher.MultiTopicPublisher(
+            transport, on_done=self._done, **kwargs)
+        self.lock = threading.Lock()
+        self.receipts = {}  # id of a message -> _Receipt of its request
+        self.requests = 0
+        self.received = 0
+        self.failed = 0
+        self.start = time.time()
+        _make_private_dir(os.path.dirname(path))
+        _remove_stale_socket(path)
+        self.server = _Server(path, _Handler)
+        self.server.daemon = self
+
+    def publish(self, topic, messages):
+        """Returns once the messages are published, or raises the error
+        of the first batch of them that failed."""
+        receipt = _Receipt(len(messages))
+        with self.lock:
+            self.requests += 1
+            self.received += len(messages)
+            for message in messages:
+                self.receipts[id(message)] = receipt
+        if messages:
+            try:
+                self.publisher.publish(topic, messages)
+            except Exception:
+                self._forget(messages)
+                raise
+            if not receipt.done.wait(self.reply_timeout):
+                self._forget(messages)
+                raise DaemonError('Not published within {:.0f}s'.format(
+                    self.reply_timeout))
+        if receipt.error is not None:
+            raise receipt.error
+
+    def _forget(self, messages):
+        with self.lock:
+            for message in messages:
+                self.receipts.pop(id(message), None)
+
+    def _done(self, messages, error):
+        with self.lock:
+            if error is not None:
+                self.failed += len(messages)
+            for message in messages:
+                receipt = self.receipts.pop(id(message), None)
+                if receipt:
+                    receipt.update(error)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stops serve_forever(), from another thread."""
+        self.server.shutdown()
+
+    def close(self, timeout=None):
+        """Stops accepting requests and publishes what is still queued,
+        or raises FlushTimeout if that takes longer than timeout seconds.
+        """
+        self.server.server_close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        try:
+            self.publisher.close(timeout=timeout)
+        finally:
+            # Release the requests of the messages that were dropped.
+            with self.lock:
+                receipts, self.receipts = self.receipts, {}
+                self.failed += len(receipts)
+            for receipt in set(receipts.values()):
+                receipt.error = DaemonError('The daemon stopped before '
+                                            'publishing')
+                receipt.done.set()
+
+    def report(self):
+        """Prints the requests received so far, and the publisher stats."""
+        with self.lock:
+            requests, received, failed = (self.requests, self.received,
+                                          self.failed)
+        elapsed = max(time.time() - self.start, 1e-9)
+        print ('daemon: {} requests, {} messages ({:.0f} msgs/s), {} failed '
+               'in {:.0f}s'.format(requests, received, received / elapsed,
+                                   failed, elapsed))
+        self.publisher.report()
+
+
+def _make_private_dir(directory):
+    """Creates directory for the user only, unless it exists. The default
+    one in $TMPDIR must be the user's own."""
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if directory == PRIVATE_DIR and (
+            os.stat(directory).st_uid != os.getuid()):
+        raise DaemonError('{} belongs to another user'.format(directory))
+
+
+def _remove_stale_socket(path):
+    """Removes the socket of a daemon that is gone, but not a live one."""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise DaemonError('A daemon is already serving {}'.format(path))
+
+
+class DaemonClient(object):
+    """Hands messages off to a PublishDaemon."""
+
+    def __init__(self, path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX)
+        try:
+            self.sock.connect(path)
+        except socket.error as e:
+            self.sock.close()
+            raise DaemonError('No daemon is serving {} ({}); start one with '
+                              'the serve command'.format(path, e))
+        self.replies = self.sock.makefile('rb')
+
+    def publish(self, topic, messages):
+        """Returns once the daemon has published the messages, or raises
+        DaemonError if it couldn't."""
+        self.sock.sendall(encode_request(topic, messages))
+        line = self.replies.readline()
+        if not line:
+            raise DaemonError('The daemon closed the connection')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise DaemonError(reply['error'])
+        return reply['published']
+
+    def close(self):
+        self.replies.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
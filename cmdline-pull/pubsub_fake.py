@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A local stand-in for the Cloud Pub/Sub REST API, for tests.
+
+FakePubsubServer serves the v1 REST methods the samples use over HTTP,
+backed by an InMemoryTransport, with its ack deadlines, redelivery and
+long polling pulls. It also serves a discovery document for itself, so
+that the discovery based client builds without any network access. Point
+the samples at it like at the Cloud Pub/Sub emulator:
+
+% python pubsub_fake.py --port 8085 &
+% export PUBSUB_EMULATOR_HOST=localhost:8085
+% python pubsub_sample.py MYPROJ create_topic test
+
+Partial response masks (fields) are ignored.
+"""
+
+import argparse
+import base64
+import BaseHTTPServer
+import json
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import urlparse
+
+import pubsub_transport
+
+
+PORT = 8085
+
+_PROJECT = r'projects/[^/]+'
+
+_TOPIC = _PROJECT + r'/topics/[^/]+'
+
+_SUBSCRIPTION = _PROJECT + r'/subscriptions/[^/]+'
+
+# (resource, method, HTTP method, path template, parameter, pattern, body)
+# for every method of the REST API the samples call.
+METHODS = [
+    ('topics', 'create', 'PUT', 'v1/{+name}', 'name', _TOPIC, True),
+    ('topics', 'get', 'GET', 'v1/{+topic}', 'topic', _TOPIC, False),
+    ('topics', 'delete', 'DELETE', 'v1/{+topic}', 'topic', _TOPIC, False),
+    ('topics', 'list', 'GET', 'v1/{+project}/topics', 'project', _PROJECT,
+     False),
+    ('topics', 'publish', 'POST', 'v1/{+topic}:publish', 'topic', _TOPIC,
+     True),
+    ('topics.subscriptions', 'list', 'GET', 'v1/{+topic}/subscriptions',
+     'topic', _TOPIC, False),
+    ('subscriptions', 'create', 'PUT', 'v1/{+name}', 'name', _SUBSCRIPTION,
+     True),
+    ('subscriptions', 'get', 'GET', 'v1/{+subscription}', 'subscription',
+     _SUBSCRIPTION, False),
+    ('subscriptions', 'delete', 'DELETE', 'v1/{+subscription}',
+     'subscription', _SUBSCRIPTION, False),
+    ('subscriptions', 'list', 'GET', 'v1/{+project}/subscriptions',
+     'project', _PROJECT, False),
+    ('subscriptions', 'pull', 'POST', 'v1/{+subscription}:pull',
+     'subscription', _SUBSCRIPTION, True),
+    ('subscriptions', 'acknowledge', 'POST', 'v1/{+subscription}:acknowledge',
+     'subscription', _SUBSCRIPTION, True),
+    ('subscriptions', 'modifyAckDeadline', 'POST',
+     'v1/{+subscription}:modifyAckDeadline', 'subscription', _SUBSCRIPTION,
+     True),
+    ('subscriptions', 'modifyPushConfig', 'POST',
+     'v1/{+subscription}:modifyPushConfig', 'subscription', _SUBSCRIPTION,
+     True),
+]
+
+_PAGED = {'pageSize': {'type': 'integer', 'format': 'int32',
+                       'location': 'query'},
+          'pageToken': {'type': 'string', 'location': 'query'}}
+
+
+def discovery_document(root_url):
+    """Returns a discovery document describing METHODS at root_url."""
+    document = {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'pubsub:v1',
+        'name': 'pubsub',
+        'version': 'v1',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': '',
+        'baseUrl': root_url,
+        'batchPath': 'batch',
+        'parameters': {'fields': {'type': 'string', 'location': 'query'}},
+        # Request and response bodies are passed through as they are.
+        'schemas': {'Body': {'id': 'Body', 'type': 'object'}},
+        'resources': {'projects': {'resources': {}}},
+    }
+    for resource, method, http_method, path, parameter, pattern, body in (
+            METHODS):
+        node = document['resources']['projects']
+        for name in resource.split('.'):
+            node = node['resources'].setdefault(
+                name, {'methods': {}, 'resources': {}})
+        parameters = {parameter: {'type': 'string', 'location': 'path',
+                                  'required': True,
+                                  'pattern': '^{}$'.format(pattern)}}
+        if method == 'list':
+            parameters.update(_PAGED)
+        description = {
+            'id': 'pubsub.projects.{}.{}'.format(resource, method),
+            'path': path,
+            'httpMethod': http_method,
+            'parameters': parameters,
+            'parameterOrder': [parameter],
+            'response': {'$ref': 'Body'},
+        }
+        if body:
+            description['request'] = {'$ref': 'Body'}
+        node['methods'][method] = description
+    return document
+
+
+def _encode_message(message):
+    encoded = {'data': base64.b64encode(message.data),
+               'messageId': message.message_id,
+               'publishTime': message.publish_time}
+    if message.attributes:
+        encoded['attributes'] = message.attributes
+    return encoded
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep connections alive, like the API
+
+    disable_nagle_algorithm = True  # replies are written in several sends
+
+    def log_message(self, format, *args):
+        pass  # don't clutter the test output
+
+    def _reply(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self):
+        url = urlparse.urlparse(self.path)
+        query = dict((name, values[0]) for name, values
+                     in urlparse.parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or '{}')
+        try:
+            if (url.path == pubsub_transport.EMULATOR_DISCOVERY_PATH and
+                    self.command == 'GET'):
+                reply = discovery_document(
+                    'http://{}/'.format(self.headers['Host']))
+            else:
+                reply = self.server.fake.call(self.command, url.path, query,
+                                              body)
+        except pubsub_transport.TransportError as e:
+            self._reply(e.status, {'error': {'code': e.status,
+                                             'message': str(e)}})
+            return
+        except (KeyError, TypeError, ValueError) as e:
+            self._reply(400, {'error': {'code': 400, 'message': str(e)}})
+            return
+        self._reply(200, reply)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves every connection on a thread, and tracks them, so that the
+    kept alive ones can be closed on stop()."""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           handler_class)
+        self.lock = threading.Lock()
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # closed by the client already
+
+
+class FakeClock(object):
+    """A clock for tests that only moves when told to, or when sleep() is
+    called, e.g. by an InMemoryTransport or a TokenBucket."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+class FakePubsubServer(object):
+    """Serves the REST API on a thread, until stop().
+
+    port 0 picks a free port; host is then the address to use, e.g. as
+    PUBSUB_EMULATOR_HOST.
+    """
+
+    def __init__(self, transport=None, port=0, address='localhost'):
+        self.transport = transport or pubsub_transport.InMemoryTransport()
+        self.server = _Server((address, port), _Handler)
+        self.server.fake = self
+        self.host = '{}:{}'.format(address, self.server.server_address[1])
+        self.root_url = 'http://{}/'.format(self.host)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_connections()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def call(self, http_method, path, query, body):
+        """Calls the transport method of a request, and returns the reply.
+        """
+        if not path.startswith('/v1/'):
+            raise pubsub_transport.TransportError(404, 'Not found: ' + path)
+        name, _, action = path[len('/v1/'):].partition(':')
+        page = (int(query.get('pageSize') or 0) or None,
+                query.get('pageToken'))
+        transport = self.transport
+        if re.match('^{}/topics$'.format(_PROJECT), name):
+            topics, token = transport.list_topics(name[:-len('/topics')],
+                                                  *page)
+            return _page('topics', topics, token)
+        if re.match('^{}/subscriptions$'.format(_PROJECT), name):
+            subscriptions, token = transport.list_subscriptions(
+                name[:-len('/subscriptions')], *page)
+            return _page('subscriptions', subscriptions, token)
+        if re.match('^{}/subscriptions$'.format(_TOPIC), name):
+            subscriptions, token = transport.list_topic_subscriptions(
+                name[:-len('/subscriptions')], *page)
+            return _page('subscriptions', subscriptions, token)
+        if re.match('^{}$'.format(_TOPIC), name):
+            return self._call_topic(http_method, name, action, body)
+        if re.match('^{}$'.format(_SUBSCRIPTION), name):
+            return self._call_subscription(http_method, name, action, body)
+        raise pubsub_transport.TransportError(404, 'Not found: ' + path)
+
+    def _call_topic(self, http_method, topic, action, body):
+        transport = self.transport
+        if (http_method, action) == ('PUT', ''):
+            return transport.create_topic(topic)
+        if (http_method, action) == ('GET', ''):
+            return transport.get_topic(topic)
+        if (http_method, action) == ('DELETE', ''):
+            transport.delete_topic(topic)
+            return {}
+        if (http_method, action) == ('POST', 'publish'):
+            messages = [pubsub_transport.make_message(
+                base64.b64decode(message.get('data', '')),
+                message.get('attributes'))
+                for message in body['messages']]
+            return {'messageIds': transport.publish(topic, messages)}
+        raise pubsub_transport.TransportError(
+            404, 'No {} {} on topics'.format(http_method, action))
+
+    def _call_subscription(self, http_method, subscription, action, body):
+        transport = self.transport
+        if (http_method, action) == ('PUT', ''):
+            return transport.create_subscription(
+                subscription, body['topic'],
+                body.get('pushConfig', {}).get('pushEndpoint'),
+                body.get('ackDeadlineSeconds'))
+        if (http_method, action) == ('GET', ''):
+            return transport.get_subscription(subscription)
+        if (http_method, action) == ('DELETE', ''):
+            transport.delete_subscription(subscription)
+            return {}
+        if (http_method, action) == ('POST', 'pull'):
+            received = transport.pull(subscription, body['maxMessages'],
+                                      body.get('returnImmediately', False))
+            return {'receivedMessages': [
+                {'ackId': r.ack_id, 'message': _encode_message(r.message)}
+                for r in received]}
+        if (http_method, action) == ('POST', 'acknowledge'):
+            transport.acknowledge(subscription, body['ackIds'])
+            return {}
+        if (http_method, action) == ('POST', 'modifyAckDeadline'):
+            transport.modify_ack_deadline(subscription, body['ackIds'],
+                                          body['ackDeadlineSeconds'])
+            return {}
+        if (http_method, action) == ('POST', 'modifyPushConfig'):
+            transport.modify_push_config(
+                subscription,
+                body.get('pushConfig', {}).get('pushEndpoint'))
+            return {}
+        raise pubsub_transport.TransportError(
+            404, 'No {} {} on subscriptions'.format(http_method, action))
+
+
+def _page(key, items, next_page_token):
+    page = {key: items}
+    if next_page_token:
+        page['nextPageToken'] = next_page_token
+    return page
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Serve a local stand-in for the Cloud Pub/Sub REST API')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--address', default='localhost')
+    args = parser.parse_args(argv[1:])
+    server = FakePubsubServer(port=args.port, address=args.address)
+    print 'Serving on {}; export PUBSUB_EMULATOR_HOST={}'.format(
+        server.root_url, server.host)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
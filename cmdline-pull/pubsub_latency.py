@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Delivery latency probes.
+
+A Prober stamps the attributes of published messages with its source, a
+sequence number per topic and the time they were sent. A LatencyProbe
+on the receiving side records, for every message:
+
+- the end-to-end latency, from the send time of a stamped message, which
+  includes any batching on the publisher, and depends on the clocks of
+  both hosts being in sync;
+- the delivery latency, from the publish time set by Cloud Pub/Sub;
+- gaps, duplicates and reordering, from the sequence numbers of every
+  source and topic. A gap is a sequence number that hasn't arrived (yet);
+  it is no longer counted once the message arrives late.
+
+Latencies are kept in histograms with buckets about 10% wide, so a probe
+costs the same however many messages it sees.
+"""
+
+import bisect
+import calendar
+import collections
+import itertools
+import math
+import os
+import re
+import threading
+import time
+
+
+SOURCE_ATTRIBUTE = 'probe_source'
+
+SEQUENCE_ATTRIBUTE = 'probe_seq'
+
+SENT_ATTRIBUTE = 'probe_sent'  # microseconds since the epoch
+
+TOPIC_ATTRIBUTE = 'probe_topic'
+
+BUCKET_GROWTH = 1.1
+
+MIN_LATENCY = 1e-6  # seconds; anything faster goes in the first bucket
+
+PERCENTILES = [50, 90, 99]
+
+MAX_GAP_RANGES = 10000  # per sequence
+
+_TIMESTAMP = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?Z$')
+
+
+def parse_timestamp(value):
+    """Returns the seconds since the epoch of an RFC 3339 UTC timestamp,
+    like the publishTime of a message, or None if it isn't one."""
+    match = _TIMESTAMP.match(value or '')
+    if not match:
+        return None
+    fields = [int(field) for field in match.groups()[:6]]
+    fraction = match.group(7) or '0'
+    return calendar.timegm(fields) + int(fraction) / 10.0 ** len(fraction)
+
+
+class Prober(object):
+    """Stamps the attributes of messages to publish for a LatencyProbe."""
+
+    def __init__(self, source=None):
+        self.source = source or '{}-{}'.format(
+            os.urandom(4).encode('hex'), os.getpid())
+        self.lock = threading.Lock()
+        self.sequences = collections.defaultdict(itertools.count)
+
+    def stamp(self, topic, attributes=None):
+        """Returns a copy of attributes with the probe attributes added."""
+        with self.lock:
+            sequence = next(self.sequences[topic])
+        stamped = dict(attributes or {})
+        stamped[SOURCE_ATTRIBUTE] = self.source
+        stamped[SEQUENCE_ATTRIBUTE] = str(sequence)
+        stamped[TOPIC_ATTRIBUTE] = topic
+        stamped[SENT_ATTRIBUTE] = str(int(time.time() * 1e6))
+        return stamped
+
+
+class Histogram(object):
+    """A histogram of latencies in buckets growing by BUCKET_GROWTH."""
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.negative = 0  # from clocks out of sync
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        if seconds < 0:
+            self.negative += 1
+        bucket = 0
+        if seconds > MIN_LATENCY:
+            bucket = int(math.ceil(math.log(seconds / MIN_LATENCY) /
+                                   math.log(BUCKET_GROWTH)))
+        self.buckets[bucket] += 1
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the percentile."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(MIN_LATENCY * BUCKET_GROWTH ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return 'n=0'
+        parts = ['n={}'.format(self.count),
+                 'avg={:.1f}ms'.format(self.total / self.count * 1e3)]
+        for percent in PERCENTILES:
+            parts.append('p{}={:.1f}ms'.format(
+                percent, self.percentile(percent) * 1e3))
+        parts.append('max={:.1f}ms'.format(self.max * 1e3))
+        if self.negative:
+            parts.append('negative={}'.format(self.negative))
+        return ' '.join(parts)
+
+
+class _Sequence(object):
+    """The sequence numbers seen from one source on one topic.
+
+    Missing numbers are kept as sorted [start, stop) ranges, so a long gap
+    costs no more than a short one. Past MAX_GAP_RANGES ranges the oldest
+    one is given up on: its numbers stay counted as gaps in self.lost, but
+    arriving late they are taken for duplicates.
+    """
+
+    def __init__(self, first):
+        self.low = self.high = first
+        self.missing = []
+        self.lost = 0
+
+    def gaps(self):
+        return self.lost + sum(stop - start for start, stop in self.missing)
+
+    def add(self, sequence):
+        """Returns 'new', 'late' or 'duplicate'."""
+        if sequence > self.high:
+            if sequence > self.high + 1:
+                self._miss(len(self.missing), self.high + 1, sequence)
+            self.high = sequence
+            return 'new'
+        if sequence < self.low:
+            # Sent before the first one we saw, e.g. a redelivery at start.
+            if sequence + 1 < self.low:
+                self._miss(0, sequence + 1, self.low)
+            self.low = sequence
+            return 'late'
+        index = bisect.bisect(self.missing, (sequence, float('inf'))) - 1
+        if index < 0 or self.missing[index][1] <= sequence:
+            return 'duplicate'
+        start, stop = self.missing[index]
+        self.missing[index:index + 1] = [
+            (begin, end) for begin, end in
+            ((start, sequence), (sequence + 1, stop)) if begin < end]
+        return 'late'
+
+    def _miss(self, index, start, stop):
+        self.missing.insert(index, (start, stop))
+        if len(self.missing) > MAX_GAP_RANGES:
+            start, stop = self.missing.pop(0)
+            self.lost += stop - start
+
+
+class LatencyProbe(object):
+    """Records the latencies and the sequence numbers of received messages.
+
+    Histograms cover the messages since the last report(); the sequence
+    counts cover the whole run. Without track_sequences only latencies
+    are recorded, e.g. where each process sees an arbitrary share of the
+    messages. Safe to use from several threads.
+    """
+
+    def __init__(self, track_sequences=True):
+        self.track_sequences = track_sequences
+        self.lock = threading.Lock()
+        self.sequences = {}
+        self.duplicates = 0
+        self.late = 0
+        self.received = 0
+        self._reset()
+
+    def _reset(self):
+        self.end_to_end = Histogram()
+        self.delivery = Histogram()
+
+    def record(self, message, received=None):
+        """Records a pubsub_transport.Message received at time received."""
+        received = received or time.time()
+        attributes = message.attributes or {}
+        published = parse_timestamp(message.publish_time)
+        with self.lock:
+            self.received += 1
+            if published is not None:
+                self.delivery.add(received - published)
+            try:
+                sent = int(attributes[SENT_ATTRIBUTE]) / 1e6
+                key = (attributes[SOURCE_ATTRIBUTE],
+                       attributes.get(TOPIC_ATTRIBUTE))
+                sequence = int(attributes[SEQUENCE_ATTRIBUTE])
+            except (KeyError, ValueError):
+                return  # not stamped by a Prober
+            self.end_to_end.add(received - sent)
+            if not self.track_sequences:
+                return
+            if key not in self.sequences:
+                self.sequences[key] = _Sequence(sequence)
+                return
+            result = self.sequences[key].add(sequence)
+            if result == 'duplicate':
+                self.duplicates += 1
+            elif result == 'late':
+                self.late += 1
+
+    def gaps(self):
+        with self.lock:
+            return sum(s.gaps() for s in self.sequences.values())
+
+    def report(self):
+        """Returns a summary, and starts new latency histograms."""
+        gaps = self.gaps()
+        with self.lock:
+            lines = [
+                'end-to-end latency: ' + self.end_to_end.summary(),
+                'publish->receive latency: ' + self.delivery.summary()]
+            if self.track_sequences:
+                lines.append(
+                    'sequence: {} messages in {} sequences, {} gaps, {} '
+                    'duplicates, {} out of order'.format(
+                        self.received, len(self.sequences), gaps,
+                        self.duplicates, self.late))
+            self._reset()
+        return '\n'.join(lines)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Profiling and tracing for the Cloud Pub/Sub samples.
+
+The command line samples accept the options added by add_arguments:
+
+- --profile FILE profiles the run. The cprofile profiler writes pstats
+  data (python -m pstats FILE, or snakeviz), the sample profiler writes
+  the stacks of all threads in the collapsed format of flamegraph.pl.
+- --trace FILE records the spans around the hot stages of the samples,
+  such as parse, encode, publish, pull and ack, as Chrome trace events
+  (open them in chrome://tracing or Perfetto).
+
+span() is cheap when no trace is being recorded, so the samples always
+call it. ProfileMiddleware does the same for a WSGI application, logging
+the results since App Engine can't write files. The profilers are only
+imported when used, to keep the command line samples quick to start.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+PROFILERS = ['cprofile', 'sample']
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+
+STATS_LIMIT = 30  # number of functions to print from a cProfile run
+
+MAX_TRACE_EVENTS = 1000000  # spans kept by a trace; later ones are dropped
+
+MAX_REQUEST_TRACE_EVENTS = 1000  # per ProfileMiddleware request, as logged
+
+# The tracer of the current run, and a per-thread one for ProfileMiddleware.
+_tracer = None
+
+_local = threading.local()
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of threads from a thread of its own.
+
+    Unlike cProfile, it sees every thread, e.g. the workers of a
+    publisher, and costs little enough to leave on for long runs.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        own_id = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (
+                        self.thread_ids and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, out):
+        """Writes the samples as collapsed stacks, for flamegraph.pl."""
+        for stack, count in sorted(self.counts.items()):
+            out.write('{} {}\n'.format(stack, count))
+
+
+def _print_stats(profile, out, limit=STATS_LIMIT):
+    import pstats
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(limit)
+
+
+@contextlib.contextmanager
+def profiled(path, profiler='cprofile'):
+    """Profiles the block and writes the result to path, if given.
+
+    cProfile only sees the thread it was started in; use the sample
+    profiler for runs that do their work on other threads.
+    """
+    if not path:
+        yield
+    elif profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+            _print_stats(profile, sys.stderr)
+    else:
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            with open(path, 'w') as out:
+                sampler.write(out)
+
+
+class Tracer(object):
+    """Collects spans as Chrome trace events, up to max_events of them,
+    and counts the ones past that as dropped."""
+
+    def __init__(self, max_events=MAX_TRACE_EVENTS):
+        self.events = []
+        self.max_events = max_events
+        self.dropped = 0
+        self.pid = os.getpid()
+
+    def add(self, name, start, end, args):
+        if len(self.events) >= self.max_events:
+            self.dropped += 1  # racy, but only ever reported
+            return
+        # list.append is atomic, so spans can end on any thread.
+        self.events.append({
+            'name': name, 'ph': 'X', 'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+            'args': args})
+
+    def to_json(self):
+        trace = {'traceEvents': self.events}
+        if self.dropped:
+            trace['otherData'] = {'dropped_events': self.dropped}
+        return json.dumps(trace)
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add(self.name, self.start, time.time(), self.args)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **args):
+    """Returns a context manager that records the block as a span."""
+    tracer = getattr(_local, 'tracer', None) or _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, args)
+
+
+@contextlib.contextmanager
+def tracing(path):
+    """Records the spans of the block, and writes them to path, if given."""
+    global _tracer
+    if not path:
+        yield
+        return
+    _tracer = Tracer()
+    try:
+        yield
+    finally:
+        tracer, _tracer = _tracer, None
+        with open(path, 'w') as out:
+            out.write(tracer.to_json())
+
+
+def add_arguments(parser):
+    """Adds the --profile, --profiler and --trace options to a parser."""
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help='Profile the run and write the result to FILE')
+    parser.add_argument(
+        '--profiler', choices=PROFILERS, default='cprofile',
+        help='cprofile writes pstats data; sample writes the stacks of '
+        'all threads for flamegraph.pl')
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help='Write the spans of the hot stages to FILE as Chrome trace '
+        'events')
+
+
+@contextlib.contextmanager
+def from_args(args):
+    """Profiles and traces the block as set by the add_arguments options."""
+    with tracing(args.trace):
+        with profiled(args.profile, args.profiler):
+            yield
+
+
+class ProfileMiddleware(object):
+    """WSGI middleware that profiles requests and logs the results.
+
+    A request is profiled at random with probability sample_rate, or if
+    its query string has a 'profile' parameter and may_profile, a
+    function of the WSGI environ, allows it, e.g. for administrators
+    only. Without may_profile, the parameter is ignored. The profile and
+    the spans recorded while handling the request are logged at INFO
+    level.
+    """
+
+    def __init__(self, app, sample_rate=0, profiler='cprofile',
+                 may_profile=None):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.profiler = profiler
+        self.may_profile = may_profile
+
+    def _wanted(self, environ):
+        import random
+        import urlparse
+        if random.random() < self.sample_rate:
+            return True
+        query = urlparse.parse_qs(environ.get('QUERY_STRING', ''),
+                                  keep_blank_values=True)
+        return ('profile' in query and self.may_profile is not None and
+                self.may_profile(environ))
+
+    def __call__(self, environ, start_response):
+        if not self._wanted(environ):
+            return self.app(environ, start_response)
+        import cProfile
+        import logging
+        import StringIO
+        path = environ.get('PATH_INFO', '')
+        out = StringIO.StringIO()
+        _local.tracer = Tracer(MAX_REQUEST_TRACE_EVENTS)
+        try:
+            if self.profiler == 'cprofile':
+                profile = cProfile.Profile()
+                # Consume the response, so that all of the work is seen.
+                response = profile.runcall(
+                    lambda: list(self.app(environ, start_response)))
+                _print_stats(profile, out)
+            else:
+                sampler = SamplingProfiler(
+                    thread_ids=[threading.current_thread().ident])
+                sampler.start()
+                try:
+                    response = list(self.app(environ, start_response))
+                finally:
+                    sampler.stop()
+                sampler.write(out)
+            logging.info('Profile of %s:\n%s', path, out.getvalue())
+            logging.info('Trace of %s: %s', path, _local.tracer.to_json())
+        finally:
+            _local.tracer = None
+        return response
@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Batching and rate limited publishing for the Cloud Pub/Sub samples.
+
+BatchPublisher, MultiTopicPublisher and RateLimitedPublisher have the
+same publish(topic, messages) method as the transports in
+pubsub_transport, so they can be stacked on top of a transport wherever a
+sample publishes:
+
+    publisher = RateLimitedPublisher(
+        MultiTopicPublisher(transport, batch_size=100, workers=4),
+        message_rate=parse_profile('ramp:60', 20000))
+
+Unlike the transports, they return before the messages are published.
+flush() waits until everything handed to them so far has been published,
+or, given a timeout, raises FlushTimeout when it takes longer; close()
+with a timeout then drops what isn't on its way yet, e.g. to shut down
+within a deadline.
+"""
+
+import math
+import Queue
+import threading
+import time
+
+import pubsub_adaptive
+import pubsub_profile
+
+
+BATCH_SIZE = 100
+
+MAX_BATCH_SIZE = 1000  # Cloud Pub/Sub accepts up to 1000 messages per request
+
+TARGET_RPC_LATENCY = 1.0  # seconds; adaptive batches shrink past this
+
+PUBLISH_WORKERS = 4
+
+MAX_LATENCY = 0.05  # seconds a partial batch may wait for more messages
+
+MAX_SLEEP = 0.1
+
+TOKEN_EPSILON = 1e-6  # rounding errors that acquire() doesn't wait out
+
+REPORT_SECONDS = 10
+
+PROFILES = ['constant', 'step', 'ramp', 'sine']
+
+
+class FlushTimeout(Exception):
+    """Messages were still unpublished when a flush timed out."""
+
+
+def _deadline(timeout):
+    return None if timeout is None else time.time() + timeout
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(deadline - time.time(), 0)
+
+
+def _join(queue, deadline):
+    """Like queue.join(), but returns False if not done by deadline."""
+    if deadline is None:
+        queue.join()
+        return True
+    with queue.all_tasks_done:
+        while queue.unfinished_tasks:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            queue.all_tasks_done.wait(remaining)
+    return True
+
+
+def parse_profile(spec, rate):
+    """Returns a function of the elapsed seconds giving the target rate.
+
+    spec is one of:
+
+    - 'constant': always rate.
+    - 'step:SECONDS:STEPS': rate / STEPS for SECONDS, then 2 * rate / STEPS
+      and so on, up to rate.
+    - 'ramp:SECONDS': from 0 up to rate over SECONDS, then rate.
+    - 'sine:SECONDS[:AMPLITUDE]': oscillates around rate with a period of
+      SECONDS, by AMPLITUDE * rate (default 0.5 * rate).
+    """
+    name, _, params = spec.partition(':')
+    try:
+        params = [float(param) for param in params.split(':') if param]
+    except ValueError:
+        raise ValueError('Invalid rate profile: {}'.format(spec))
+    if name == 'constant' and not params:
+        return lambda elapsed: rate
+    if name == 'step' and len(params) == 2 and params[0] > 0 < params[1]:
+        seconds, steps = params
+        return lambda elapsed: rate * min(
+            1.0, (math.floor(elapsed / seconds) + 1) / steps)
+    if name == 'ramp' and len(params) == 1 and params[0] > 0:
+        return lambda elapsed: rate * min(1.0, elapsed / params[0])
+    if name == 'sine' and len(params) in (1, 2) and params[0] > 0:
+        amplitude = params[1] if len(params) == 2 else 0.5
+        return lambda elapsed: rate * max(0.0, 1 + amplitude * math.sin(
+            2 * math.pi * elapsed / params[0]))
+    raise ValueError('Invalid rate profile: {}'.format(spec))
+
+
+class TokenBucket(object):
+    """Limits acquire() to a rate of tokens per second.
+
+    rate is a number, or a function of the seconds elapsed since the
+    bucket was created like the ones parse_profile returns. Unused tokens
+    are kept for up to burst seconds. acquire() may take more tokens than
+    the bucket holds, e.g. a whole batch, and then waits until the debt is
+    paid off; callers are served one at a time, in order.
+    """
+
+    def __init__(self, rate, burst=1.0, clock=time.time, sleep=time.sleep):
+        self.rate = rate if callable(rate) else lambda elapsed: rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.start = self.last = clock()
+        self.last_rate = self.rate(0)
+        self.tokens = 0.0
+
+    def current_rate(self):
+        return self.rate(self.clock() - self.start)
+
+    def _refill(self):
+        now = self.clock()
+        rate = self.rate(now - self.start)
+        # Average the rate over the interval, which matters for profiles.
+        added = (self.last_rate + rate) / 2.0 * (now - self.last)
+        self.tokens = min(self.tokens + added, rate * self.burst)
+        self.last = now
+        self.last_rate = rate
+        return rate
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            rate = self._refill()
+            self.tokens -= tokens
+            while self.tokens < -TOKEN_EPSILON:
+                # The rate may change while waiting, so check back often.
+                self.sleep(min(-self.tokens / rate, MAX_SLEEP)
+                           if rate > 0 else MAX_SLEEP)
+                rate = self._refill()
+
+
+class BatchPublisher(object):
+    """Publishes messages in batches, on a pool of worker threads.
+
+    Messages are collected per topic until batch_size of them are waiting
+    or the oldest has waited max_latency seconds. At most 2 * workers
+    batches are queued; past that, publish() blocks. When a batch fails,
+    the next publish() or flush() raises its error, once: the calls after
+    that go on, until another batch fails. The messages of failed batches
+    are counted in stats(). close() stops the threads, and counts the
+    messages it didn't get to publish as dropped.
+
+    on_done, if given, is called with the messages of every batch and
+    None once they are published, or the error of the batch when it
+    fails, from the worker thread. The errors it is given aren't raised
+    by publish() or flush().
+
+    When adaptive, the batch size and the number of publish requests in
+    flight start at batch_size and workers, and are tuned with
+    pubsub_adaptive from the time publish requests take, throttling and
+    throughput. name labels the tuning decisions.
+    """
+
+    def __init__(self, transport, batch_size=BATCH_SIZE,
+                 workers=PUBLISH_WORKERS, max_latency=MAX_LATENCY,
+                 adaptive=False, name='publish', on_done=None):
+        self.transport = transport
+        self.on_done = on_done
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.batch_limit = self.concurrency = None
+        if adaptive:
+            self.batch_limit = pubsub_adaptive.AdaptiveLimit(
+                '{} batch size'.format(name), batch_size,
+                maximum=MAX_BATCH_SIZE, step=max(1, batch_size // 10),
+                target_latency=TARGET_RPC_LATENCY)
+            self.concurrency = pubsub_adaptive.AdaptiveLimit(
+                '{} concurrency'.format(name), workers, maximum=workers)
+        self.in_flight = 0
+        self.slots = threading.Condition(threading.Lock())
+        self.lock = threading.Lock()
+        self.batches = {}  # topic -> (time of the first message, messages)
+        self.queue = Queue.Queue(workers * 2)
+        self.error = None
+        self.created = time.time()
+        self.accepted = 0
+        self.published = 0
+        self.published_bytes = 0
+        self.batches_published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rpc_seconds = 0.0
+        self.latency_seconds = 0.0  # summed over the messages
+        self.max_latency_seconds = 0.0
+        self.stopped = threading.Event()
+        self.workers = [threading.Thread(target=self._work)
+                        for _ in range(workers)]
+        self.threads = self.workers + [
+            threading.Thread(target=self._flush_old)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _check_error(self):
+        """Raises the error of a batch that failed since the last call.
+
+        The caller holds self.lock.
+        """
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def publish(self, topic, messages):
+        full = []
+        with self.lock:
+            self._check_error()
+            started, batch = self.batches.setdefault(
+                topic, (time.time(), []))
+            batch.extend(messages)
+            self.accepted += len(messages)
+            batch_size = self._batch_size()
+            while len(batch) >= batch_size:
+                full.append((topic, batch[:batch_size], started))
+                del batch[:batch_size]
+            if not batch:
+                del self.batches[topic]
+        for batch in full:
+            self.queue.put(batch)
+
+    def _batch_size(self):
+        if self.batch_limit:
+            return self.batch_limit.value
+        return self.batch_size
+
+    def _acquire_slot(self):
+        """Waits until the adaptive concurrency allows another request."""
+        with self.slots:
+            while self.concurrency and (
+                    self.in_flight >= self.concurrency.value):
+                self.slots.wait()
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self.slots:
+            self.in_flight -= 1
+            self.slots.notify()
+
+    def _observe(self, messages, seconds, error=None):
+        """Tells the adaptive limits how a publish request went."""
+        if self.batch_limit:
+            if error is None:
+                self.batch_limit.observe(
+                    len(messages), seconds,
+                    saturated=len(messages) >= self.batch_limit.value)
+                self.concurrency.observe(
+                    len(messages), seconds,
+                    saturated=not self.queue.empty())
+            else:
+                self.batch_limit.observe_error(error, len(messages), seconds)
+                self.concurrency.observe_error(error, len(messages), seconds)
+        with self.slots:
+            # The concurrency may have grown.
+            self.slots.notify_all()
+
+    def _take_batches(self, older_than=None):
+        taken = []
+        with self.lock:
+            for topic, (started, messages) in self.batches.items():
+                if older_than is None or started <= older_than:
+                    del self.batches[topic]
+                    taken.append((topic, messages, started))
+        return taken
+
+    def _flush_old(self):
+        while not self.stopped.wait(self.max_latency):
+            for batch in self._take_batches(time.time() - self.max_latency):
+                self.queue.put(batch)
+
+    def _restore_batches(self, batches):
+        """Puts taken batches back, ahead of what was published since."""
+        with self.lock:
+            for topic, messages, started in batches:
+                if topic in self.batches:
+                    messages = messages + self.batches[topic][1]
+                self.batches[topic] = (started, messages)
+
+    def pending(self):
+        """Returns the number of messages not yet published or dropped."""
+        with self.lock:
+            return (self.accepted - self.published - self.failed -
+                    self.dropped)
+
+    def flush(self, timeout=None):
+        """Publishes the partial batches and waits for all batches, or
+        raises FlushTimeout if they aren't published within timeout
+        seconds."""
+        deadline = _deadline(timeout)
+        batches = self._take_batches()
+        while batches:
+            try:
+                self.queue.put(batches[0], timeout=_remaining(deadline))
+            except Queue.Full:
+                self._restore_batches(batches)
+                break
+            batches.pop(0)
+        if not _join(self.queue, deadline):
+            raise FlushTimeout('{} messages unpublished after {:.1f}s'.format(
+                self.pending(), timeout))
+        with self.lock:
+            self._check_error()
+
+    def _drop_unsent(self):
+        """Drops the partial batches and the queued ones."""
+        dropped = sum(len(messages)
+                      for _, messages, _ in self._take_batches())
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                dropped += len(item[1])
+            self.queue.task_done()
+        with self.lock:
+            self.dropped += dropped
+
+    def close(self, flush=True, timeout=None):
+        """Flushes, unless flush is False, and stops the threads.
+
+        What isn't being published once it gives up flushing, or right
+        away without flush, is dropped. With a timeout, the batches that
+        are being published may still be when it returns.
+        """
+        deadline = _deadline(timeout)
+        try:
+            if flush:
+                self.flush(timeout)
+        finally:
+            self.stopped.set()
+            self._drop_unsent()
+            self.threads[-1].join()  # _flush_old() may have queued more
+            self._drop_unsent()
+            for _ in self.workers:
+                self.queue.put(None)
+            for thread in self.workers:
+                thread.join(_remaining(deadline))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            topic, messages, started = item
+            self._acquire_slot()
+            rpc_start = time.time()
+            error = None
+            try:
+                with pubsub_profile.span('publish', messages=len(messages)):
+                    self.transport.publish(topic, messages)
+                done = time.time()
+                self._observe(messages, done - rpc_start)
+                with self.lock:
+                    self.published += len(messages)
+                    self.published_bytes += sum(len(m.data)
+                                                for m in messages)
+                    self.batches_published += 1
+                    self.rpc_seconds += done - rpc_start
+                    # Every message in the batch waited at most this long.
+                    self.latency_seconds += (done - started) * len(messages)
+                    self.max_latency_seconds = max(self.max_latency_seconds,
+                                                   done - started)
+            except Exception as e:  # surfaced by publish() and flush()
+                error = e
+                self._observe(messages, time.time() - rpc_start, e)
+                with self.lock:
+                    self.failed += len(messages)
+                    if self.error is None and not self.on_done:
+                        self.error = e
+            finally:
+                self._release_slot()
+            try:
+                if self.on_done:
+                    self.on_done(messages, error)
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        """Returns a dict of publishing statistics since creation.
+
+        latency is how long messages took from publish() until their batch
+        was published, in seconds; rpc is the average publish request time.
+        batch_size and concurrency are the current, possibly adapted,
+        limits.
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.created, 1e-9)
+            published = max(self.published, 1)
+            return {
+                'messages': self.published,
+                'bytes': self.published_bytes,
+                'batches': self.batches_published,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'messages_per_second': self.published / elapsed,
+                'bytes_per_second': self.published_bytes / elapsed,
+                'latency': self.latency_seconds / published,
+                'max_latency': self.max_latency_seconds,
+                'rpc': self.rpc_seconds / max(self.batches_published, 1),
+                'batch_size': self._batch_size(),
+                'concurrency': (self.concurrency.value if self.concurrency
+                                else len(self.workers)),
+            }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(flush=exc_type is None)
+
+
+class MultiTopicPublisher(object):
+    """Publishes to each topic with its own BatchPublisher.
+
+    Every topic gets its own batches, worker threads and queue of
+    in-flight batches, so a slow or throttled topic doesn't hold up the
+    others. The BatchPublisher arguments apply to every topic.
+    """
+
+    def __init__(self, transport, *args, **kwargs):
+        self.transport = transport
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.publishers = {}
+
+    def _publisher(self, topic):
+        with self.lock:
+            if topic not in self.publishers:
+                kwargs = dict(self.kwargs, name=topic)
+                self.publishers[topic] = BatchPublisher(
+                    self.transport, *self.args, **kwargs)
+            return self.publishers[topic]
+
+    def publish(self, topic, messages):
+        self._publisher(topic).publish(topic, messages)
+
+    def _all(self):
+        with self.lock:
+            return self.publishers.values()
+
+    def flush(self, timeout=None):
+        deadline = _deadline(timeout)
+        for publisher in self._all():
+            publisher.flush(_remaining(deadline))
+
+    def close(self, flush=True, timeout=None):
+        deadline = _deadline(timeout)
+        errors = []
+        for publisher in self._all():
+            try:
+                publisher.close(flush, _remaining(deadline))
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def stats(self):
+        """Returns {topic: BatchPublisher.stats()}."""
+        with self.lock:
+            return dict((topic, publisher.stats())
+                        for topic, publisher in self.publishers.items())
+
+    def report(self):
+        """Prints the statistics of every topic."""
+        for topic, stats in sorted(self.stats().items()):
+            print ('%s: %d msgs (%.0f msgs/s, %.2f MB/s) in %d batches '
+                   '(%d x %d in flight), %d failed, %d dropped, latency avg '
+                   '%.3fs max %.3fs, rpc avg %.3fs' %
+                   (topic, stats['messages'], stats['messages_per_second'],
+                    stats['bytes_per_second'] / 1e6, stats['batches'],
+                    stats['batch_size'], stats['concurrency'],
+                    stats['failed'], stats['dropped'], stats['latency'],
+                    stats['max_latency'], stats['rpc']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(flush=exc_type is None)
+
+
+class RateLimitedPublisher(object):
+    """Limits publishing to message_rate messages and byte_rate payload
+    bytes per second, and reports the achieved rates against the targets
+    every report_seconds.
+
+    The rates are numbers or functions of the elapsed seconds, like the
+    ones parse_profile returns; either may be None for no limit.
+    """
+
+    def __init__(self, publisher, message_rate=None, byte_rate=None,
+                 report_seconds=REPORT_SECONDS):
+        self.publisher = publisher
+        self.message_bucket = None
+        if message_rate:
+            self.message_bucket = TokenBucket(message_rate)
+        self.byte_bucket = None
+        if byte_rate:
+            self.byte_bucket = TokenBucket(byte_rate)
+        self.report_seconds = report_seconds
+        self.window_start = time.time()
+        self.window_messages = self.window_bytes = 0
+        self.window_target_messages = self.window_target_bytes = 0.0
+        self.last_update = self.window_start
+
+    def publish(self, topic, messages):
+        size = sum(len(m.data) for m in messages)
+        if self.message_bucket:
+            self.message_bucket.acquire(len(messages))
+        if self.byte_bucket:
+            self.byte_bucket.acquire(size)
+        self.publisher.publish(topic, messages)
+        self._update(len(messages), size)
+
+    def _update(self, messages, size):
+        now = time.time()
+        # Integrate the targets, so that a window spanning a ramp or a
+        # step is compared against the average target over the window.
+        if self.message_bucket:
+            self.window_target_messages += (
+                self.message_bucket.current_rate() * (now - self.last_update))
+        if self.byte_bucket:
+            self.window_target_bytes += (
+                self.byte_bucket.current_rate() * (now - self.last_update))
+        self.last_update = now
+        self.window_messages += messages
+        self.window_bytes += size
+        elapsed = now - self.window_start
+        if elapsed >= self.report_seconds:
+            self.report(elapsed)
+            self.window_start = now
+            self.window_messages = self.window_bytes = 0
+            self.window_target_messages = self.window_target_bytes = 0.0
+
+    def report(self, elapsed):
+        parts = ['%.0f msgs/s' % (self.window_messages / elapsed)]
+        if self.message_bucket:
+            parts[-1] += ' (target %.0f)' % (
+                self.window_target_messages / elapsed)
+        parts.append('%.2f MB/s' % (self.window_bytes / elapsed / 1e6))
+        if self.byte_bucket:
+            parts[-1] += ' (target %.2f)' % (
+                self.window_target_bytes / elapsed / 1e6)
+        print 'publish rate: %s' % ', '.join(parts)
+
+    def flush(self, timeout=None):
+        self.publisher.flush(timeout)
+
+    def close(self, flush=True, timeout=None):
+        self.publisher.close(flush, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(flush=exc_type is None)
@@ -18,27 +18,52 @@
 
 
 import argparse
-import base64
+import collections
 import json
 import re
-import socket
 import sys
+import threading
 import time
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import pubsub_adaptive
+import pubsub_codec
+import pubsub_consumer
+import pubsub_latency
+import pubsub_profile
+import pubsub_publisher
+import pubsub_shutdown
+import pubsub_transport
 
 
-PUBSUB_SCOPES = ["https://www.googleapis.com/auth/pubsub"]
-
 BOTNAME = 'pubsub-irc-bot/1.0'
 
 PORT = 6667
 
-NUM_RETRIES = 3
-
 BATCH_SIZE = 10
 
+PAGE_SIZE = 1000
+
+LIST_WORKERS = 8
+
+# Partial response masks used while listing.
+TOPIC_NAMES_FIELDS = 'topics/name,nextPageToken'
+
+# Concurrency and rate limit for the apply and destroy commands.
+PROVISION_WORKERS = 16
+
+PROVISION_RATE = 20
+
+# Defaults of the relay command.
+RELAY_WORKERS = 4
+
+RELAY_BATCH_SIZE = 100
+
+REPORT_SECONDS = 10
+
+PROBE_RATE = 10
+
+PROBE_SIZE = 16
+
 
 def fqrn(resource_type, project, resource):
     """Return a fully qualified resource name for Cloud Pub/Sub."""
@@ -55,62 +80,135 @@ def get_full_subscription_name(project, subscription):
     return fqrn('subscriptions', project, subscription)
 
 
-def list_topics(client, args):
-    """Show the list of current topics."""
-    next_page_token = None
-    while True:
-        resp = client.projects().topics().list(
-            project='projects/{}'.format(args.project_name),
-            pageToken=next_page_token).execute(num_retries=NUM_RETRIES)
-        if 'topics' in resp:
-            for topic in resp['topics']:
-                print topic['name']
-        next_page_token = resp.get('nextPageToken')
-        if not next_page_token:
-            break
+def codec_arg(codec):
+    """Validate the value of a --codec option."""
+    try:
+        pubsub_codec.split_codec(codec)
+    except pubsub_codec.CodecError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return codec
+
 
+def make_message(data, codec=None):
+    """Return a Message for data, encoded with codec if one is given."""
+    with pubsub_profile.span('encode'):
+        data, attributes = pubsub_codec.encode_message(data, codec=codec)
+    return pubsub_transport.make_message(data, attributes)
 
-def list_subscriptions(client, args):
-    """Show the list of current subscriptions.
+
+def to_json_line(resource):
+    """Return a resource as compact, single line JSON."""
+    return json.dumps(resource, separators=(',', ':'))
+
+
+def iter_resources(list_func, parent, page_size=None, fields=None):
+    """Yield the resources from every page of a list call.
+
+    While the resources of one page are consumed, the next page is already
+    being fetched in the background.
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = None
+    try:
+        resources, next_page_token = list_func(
+            parent, page_size=page_size, fields=fields)
+        while True:
+            next_page = None
+            if next_page_token:
+                pool = pool or ThreadPool(1)
+                next_page = pool.apply_async(
+                    list_func, (parent,),
+                    {'page_size': page_size, 'page_token': next_page_token,
+                     'fields': fields})
+            for resource in resources:
+                yield resource
+            if next_page is None:
+                return
+            resources, next_page_token = next_page.get()
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def imap_bounded(func, iterable, workers):
+    """Yield func(item) for every item, running up to workers at a time.
+
+    Results come out in the order of iterable, and at most twice as many
+    items as workers are in flight at once.
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def list_topics(transport, args):
+    """Show the list of current topics.
+
+    With --with_subscriptions, the subscriptions of each topic are looked
+    up concurrently and every topic is shown as a line of JSON.
+    """
+    topics = iter_resources(
+        transport.list_topics, 'projects/{}'.format(args.project_name),
+        page_size=args.page_size, fields=TOPIC_NAMES_FIELDS)
+    if not args.with_subscriptions:
+        for topic in topics:
+            print topic['name']
+        return
+
+    def with_subscriptions(topic):
+        subscriptions = iter_resources(
+            transport.list_topic_subscriptions, topic['name'],
+            page_size=args.page_size)
+        return {'name': topic['name'], 'subscriptions': list(subscriptions)}
+
+    for topic in imap_bounded(with_subscriptions, topics, args.workers):
+        print to_json_line(topic)
+
+
+def list_subscriptions(transport, args):
+    """Show the list of current subscriptions, one JSON value per line.
 
     If a topic is specified, only subscriptions associated with the topic will
     be listed.
     """
-    next_page_token = None
-    while True:
-        if args.topic is None:
-            resp = client.projects().subscriptions().list(
-                project='projects/{}'.format(args.project_name),
-                pageToken=next_page_token).execute(num_retries=NUM_RETRIES)
-        else:
-            topic = get_full_topic_name(args.project_name, args.topic)
-            resp = client.projects().topics().subscriptions().list(
-                topic=topic,
-                pageToken=next_page_token).execute(num_retries=NUM_RETRIES)
-        for subscription in resp['subscriptions']:
-            print json.dumps(subscription, indent=1)
-        next_page_token = resp.get('nextPageToken')
-        if not next_page_token:
-            break
+    if args.topic is None:
+        subscriptions = iter_resources(
+            transport.list_subscriptions,
+            'projects/{}'.format(args.project_name),
+            page_size=args.page_size)
+    else:
+        subscriptions = iter_resources(
+            transport.list_topic_subscriptions,
+            get_full_topic_name(args.project_name, args.topic),
+            page_size=args.page_size)
+    for subscription in subscriptions:
+        print to_json_line(subscription)
 
 
-def create_topic(client, args):
+def create_topic(transport, args):
     """Create a new topic."""
-    topic = client.projects().topics().create(
-        name=get_full_topic_name(args.project_name, args.topic),
-        body={}).execute(num_retries=NUM_RETRIES)
+    topic = transport.create_topic(
+        get_full_topic_name(args.project_name, args.topic))
     print 'Topic {} was created.'.format(topic['name'])
 
 
-def delete_topic(client, args):
+def delete_topic(transport, args):
     """Delete a topic."""
     topic = get_full_topic_name(args.project_name, args.topic)
-    client.projects().topics().delete(
-        topic=topic).execute(num_retries=NUM_RETRIES)
+    transport.delete_topic(topic)
     print 'Topic {} was deleted.'.format(topic)
 
 
-def create_subscription(client, args):
+def create_subscription(transport, args):
     """Create a new subscription to a given topic.
 
     If an endpoint is specified, this function will attach to that
@@ -121,23 +219,171 @@ def create_subscription(client, args):
         topic_name = args.topic
     else:
         topic_name = get_full_topic_name(args.project_name, args.topic)
-    body = {'topic': topic_name}
-    if args.push_endpoint is not None:
-        body['pushConfig'] = {'pushEndpoint': args.push_endpoint}
-    subscription = client.projects().subscriptions().create(
-        name=name, body=body).execute(num_retries=NUM_RETRIES)
+    subscription = transport.create_subscription(
+        name, topic_name, push_endpoint=args.push_endpoint)
     print 'Subscription {} was created.'.format(subscription['name'])
 
 
-def delete_subscription(client, args):
+def delete_subscription(transport, args):
     """Delete a subscription."""
     subscription = get_full_subscription_name(args.project_name,
                                               args.subscription)
-    client.projects().subscriptions().delete(
-        subscription=subscription).execute(num_retries=NUM_RETRIES)
+    transport.delete_subscription(subscription)
     print 'Subscription {} was deleted.'.format(subscription)
 
 
+class RateLimiter(object):
+    """Spaces out calls to wait() to at most rate per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_manifest(args):
+    """Read a manifest of topics and subscriptions.
+
+    The manifest is a JSON or YAML file like:
+
+        topics:
+          - my-topic
+        subscriptions:
+          - name: my-subscription
+            topic: my-topic
+            push_endpoint: https://example.com/push  # optional
+            ack_deadline_seconds: 30                   # optional
+
+    Returns (topics, subscriptions) with fully qualified names.
+    """
+    with open(args.manifest) as manifest_file:
+        if args.manifest.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                sys.exit('Reading YAML manifests requires PyYAML: '
+                         'pip install pyyaml')
+            manifest = yaml.safe_load(manifest_file) or {}
+        else:
+            manifest = json.load(manifest_file)
+
+    def topic_name(topic):
+        if '/' in topic:
+            return topic
+        return get_full_topic_name(args.project_name, topic)
+
+    topics = [topic_name(topic) for topic in manifest.get('topics', [])]
+    subscriptions = []
+    for subscription in manifest.get('subscriptions', []):
+        subscription = dict(subscription)
+        subscription['name'] = get_full_subscription_name(
+            args.project_name, subscription['name'])
+        subscription['topic'] = topic_name(subscription['topic'])
+        subscriptions.append(subscription)
+    return topics, subscriptions
+
+
+def _provision(operations, args):
+    """Run (description, func) operations concurrently with a rate limit.
+
+    Resources that already exist on create or are already gone on delete
+    count as done. Returns the number of failed operations.
+    """
+    limiter = RateLimiter(args.rate)
+
+    def run(operation):
+        description, func = operation
+        limiter.wait()
+        try:
+            func()
+            return '{}: done'.format(description)
+        except pubsub_transport.TransportError as e:
+            if e.status == 409:
+                return '{}: already exists'.format(description)
+            elif e.status == 404:
+                return '{}: already deleted'.format(description)
+            return '{}: FAILED: {}'.format(description, e)
+
+    failures = 0
+    for result in imap_bounded(run, operations, args.workers):
+        print result
+        failures += 'FAILED' in result
+    return failures
+
+
+def apply_manifest(transport, args):
+    """Create the topics and subscriptions in a manifest that are missing.
+
+    Existing subscriptions get the push endpoint from the manifest.
+    Nothing outside the manifest is deleted.
+    """
+    topics, subscriptions = load_manifest(args)
+    project = 'projects/{}'.format(args.project_name)
+    existing_topics = set(
+        topic['name'] for topic in iter_resources(
+            transport.list_topics, project, page_size=PAGE_SIZE,
+            fields=TOPIC_NAMES_FIELDS))
+    existing_subscriptions = dict(
+        (subscription['name'], subscription)
+        for subscription in iter_resources(
+            transport.list_subscriptions, project, page_size=PAGE_SIZE))
+
+    operations = [
+        ('Create topic {}'.format(topic),
+         lambda topic=topic: transport.create_topic(topic))
+        for topic in topics if topic not in existing_topics]
+    failures = _provision(operations, args)
+
+    operations = []
+    for subscription in subscriptions:
+        name = subscription['name']
+        push_endpoint = subscription.get('push_endpoint')
+        existing = existing_subscriptions.get(name)
+        if existing is None:
+            operations.append((
+                'Create subscription {}'.format(name),
+                lambda s=subscription: transport.create_subscription(
+                    s['name'], s['topic'],
+                    push_endpoint=s.get('push_endpoint'),
+                    ack_deadline_seconds=s.get('ack_deadline_seconds'))))
+        elif existing['topic'] != subscription['topic']:
+            print ('Subscription {} is attached to {}, not {}; delete it to '
+                   'change the topic.'.format(name, existing['topic'],
+                                              subscription['topic']))
+        elif (existing.get('pushConfig', {}).get('pushEndpoint') !=
+              push_endpoint):
+            operations.append((
+                'Update push endpoint of {}'.format(name),
+                lambda name=name, push_endpoint=push_endpoint:
+                    transport.modify_push_config(name, push_endpoint)))
+    failures += _provision(operations, args)
+    if failures:
+        sys.exit('{} operations failed.'.format(failures))
+
+
+def destroy_manifest(transport, args):
+    """Delete the topics and subscriptions in a manifest."""
+    topics, subscriptions = load_manifest(args)
+    failures = _provision(
+        [('Delete subscription {}'.format(s['name']),
+          lambda name=s['name']: transport.delete_subscription(name))
+         for s in subscriptions], args)
+    failures += _provision(
+        [('Delete topic {}'.format(topic),
+          lambda topic=topic: transport.delete_topic(topic))
+         for topic in topics], args)
+    if failures:
+        sys.exit('{} operations failed.'.format(failures))
+
+
 def _check_connection(irc):
     """Check a connection to an IRC channel."""
     readbuffer = ''
@@ -153,8 +399,14 @@ def _check_connection(irc):
                 sys.exit(1)
 
 
-def connect_irc(client, args):
-    """Connect to an IRC channel and publishe messages."""
+def connect_irc(transport, args):
+    """Connect to an IRC channel and publishe messages.
+
+    On SIGTERM or Ctrl-C, it publishes the lines it has received, then
+    leaves the channel.
+    """
+    import errno
+    import socket
     server = args.server
     channel = args.channel
     topic = get_full_topic_name(args.project_name, args.topic)
@@ -173,73 +425,413 @@ def connect_irc(client, args):
     priv_mark = "PRIVMSG {} :".format(channel)
     p = re.compile(
         r'\x0314\[\[\x0307(.*)\x0314\]\]\x03.*\x0302(http://[^\x03]*)\x03')
-    while True:
-        readbuffer = readbuffer + irc.recv(1024)
-        temp = readbuffer.split('\n')
-        readbuffer = temp.pop()
-        for line in temp:
-            line = line.rstrip()
-            parts = line.split()
-            if parts[0] == "PING":
-                irc.send("PONG {}\r\n".format(parts[1]))
-            else:
-                i = line.find(priv_mark)
-                if i == -1:
+    published = 0
+    with pubsub_shutdown.Shutdown(args.drain_seconds) as shutdown:
+        while not shutdown.requested():
+            try:
+                data = irc.recv(1024)
+            except socket.error as e:
+                if e.errno == errno.EINTR:  # by the stop signal
                     continue
-                line = line[i + len(priv_mark):]
-                m = p.match(line)
-                if m:
-                    line = "Title: {}, Diff: {}".format(m.group(1), m.group(2))
-                body = {
-                    'messages': [{'data': base64.b64encode(str(line))}]
-                }
-                client.projects().topics().publish(
-                    topic=topic, body=body).execute(num_retries=NUM_RETRIES)
-
-
-def publish_message(client, args):
+                raise
+            if not data:
+                print 'Disconnected from {}.'.format(server)
+                break
+            readbuffer = readbuffer + data
+            temp = readbuffer.split('\n')
+            readbuffer = temp.pop()
+            for line in temp:
+                line = line.rstrip()
+                parts = line.split()
+                if parts[0] == "PING":
+                    irc.send("PONG {}\r\n".format(parts[1]))
+                else:
+                    i = line.find(priv_mark)
+                    if i == -1:
+                        continue
+                    line = line[i + len(priv_mark):]
+                    m = p.match(line)
+                    if m:
+                        line = "Title: {}, Diff: {}".format(m.group(1),
+                                                            m.group(2))
+                    transport.publish(topic,
+                                      [make_message(str(line), args.codec)])
+                    published += 1
+        else:
+            irc.send("QUIT\r\n")
+    irc.close()
+    print 'Published {} messages to {}.'.format(published, topic)
+
+
+def publish_message(transport, args):
     """Publish a message to a given topic."""
     topic = get_full_topic_name(args.project_name, args.topic)
-    message = base64.b64encode(str(args.message))
-    body = {'messages': [{'data': message}]}
-    resp = client.projects().topics().publish(
-        topic=topic, body=body).execute(num_retries=NUM_RETRIES)
+    message = make_message(str(args.message), args.codec)
+    with pubsub_profile.span('publish', messages=1):
+        message_ids = transport.publish(topic, [message])
     print ('Published a message "{}" to a topic {}. The message_id was {}.'
-           .format(args.message, topic, resp.get('messageIds')[0]))
+           .format(args.message, topic, message_ids[0]))
+
+
+def publish_via_daemon(transport, args):
+    """Hand a message off to a running serve command."""
+    import pubsub_daemon
+    topic = get_full_topic_name(args.project_name, args.topic)
+    message = make_message(str(args.message), args.codec)
+    path = args.socket or pubsub_daemon.SOCKET_PATH
+    with pubsub_daemon.DaemonClient(path) as client:
+        client.publish(topic, [message])
+    print 'Published a message "{}" to a topic {} through the daemon.'.format(
+        args.message, topic)
+
+
+def serve(transport, args):
+    """Publish the messages of publish_message --via_daemon callers.
+
+    On SIGTERM or Ctrl-C, it stops taking requests, and publishes what is
+    queued within --drain_seconds.
+    """
+    import pubsub_daemon
+    path = args.socket or pubsub_daemon.SOCKET_PATH
+    daemon = pubsub_daemon.PublishDaemon(
+        transport, path, batch_size=args.batch_size, workers=args.workers,
+        max_latency=args.max_latency, adaptive=args.adaptive)
+    # Serve on another thread, so that the main one can take the signals.
+    server = threading.Thread(target=daemon.serve_forever)
+    server.daemon = True
+    print 'Serving on {}'.format(path)
+    with pubsub_shutdown.Shutdown(args.drain_seconds) as shutdown:
+        server.start()
+        try:
+            while not shutdown.wait(REPORT_SECONDS):
+                daemon.report()
+        finally:
+            daemon.shutdown()
+            try:
+                daemon.close(timeout=shutdown.remaining())
+            except pubsub_publisher.FlushTimeout as e:
+                print 'Gave up draining: {}'.format(e)
+            finally:
+                daemon.report()
 
 
-def pull_messages(client, args):
+def pull_batch(transport, subscription, limit=None):
+    """Pull up to BATCH_SIZE messages, or as many as an AdaptiveLimit
+    allows, and tell the limit how it went."""
+    max_messages = limit.value if limit else BATCH_SIZE
+    start = time.time()
+    try:
+        with pubsub_profile.span('pull'):
+            received_messages = transport.pull(subscription, max_messages)
+    except Exception as e:
+        if limit:
+            limit.observe_error(e, seconds=time.time() - start)
+        raise
+    if limit:
+        limit.observe(len(received_messages), time.time() - start,
+                      saturated=len(received_messages) >= max_messages)
+    return received_messages
+
+
+def make_handler(args, probe=None, print_lock=None):
+    """Return the function that handles every pulled message: the
+    --handler hook, probe.record, or one that prints the message."""
+    if args.handler:
+        return load_hook(args.handler)
+    if probe:
+        return probe.record
+    print_lock = print_lock or threading.Lock()
+
+    def handle(message):
+        with pubsub_profile.span('decode'):
+            data = pubsub_codec.decode(message.data, message.attributes)
+        with print_lock:
+            print data
+
+    return handle
+
+
+def make_failure_policy(transport, subscription, args):
+    """Return the FailurePolicy of pull_messages, or None without
+    --max_attempts or --dead_letter.
+
+    With --dead_letter, the policy has a DeadLetterQueue, which the caller
+    must close.
+    """
+    max_attempts = args.max_attempts
+    if args.dead_letter and not max_attempts:
+        max_attempts = pubsub_consumer.MAX_ATTEMPTS
+    if not max_attempts:
+        return None
+    dead_letters = None
+    if args.dead_letter:
+        spec = args.dead_letter
+        if not spec.startswith(('file:', 'projects/')):
+            spec = get_full_topic_name(args.project_name, spec)
+        dead_letters = pubsub_consumer.DeadLetterQueue(
+            transport, subscription,
+            pubsub_consumer.make_dead_letter_sink(transport, spec))
+    return pubsub_consumer.FailurePolicy(max_attempts, dead_letters)
+
+
+def pull_keyed_messages(transport, subscription, args, probe=None,
+                        limit=None, policy=None, shutdown=None):
+    """Pull messages and print them in order per key, on several lanes.
+
+    Once shutdown is requested, the messages still queued on the lanes
+    are nacked.
+    """
+    shutdown = shutdown or pubsub_shutdown.Shutdown()
+    print_lock = pubsub_consumer.print_lock
+    dispatcher = pubsub_consumer.KeyedDispatcher(
+        transport, subscription, make_handler(args, probe, print_lock),
+        pubsub_consumer.make_key_func(args.key), lanes=args.lanes,
+        policy=policy)
+    next_report = time.time() + REPORT_SECONDS
+    try:
+        while not shutdown.requested():
+            try:
+                received_messages = pull_batch(transport, subscription,
+                                               limit)
+            except Exception as e:
+                if not shutdown.requested():  # else interrupted by it
+                    print e
+                    shutdown.wait(0.5)
+                continue
+            # Blocks while the lanes of these messages are full.
+            dispatcher.dispatch(received_messages)
+            if args.no_loop:
+                break
+            if time.time() >= next_report:
+                with print_lock:
+                    dispatcher.report()
+                    if probe:
+                        print probe.report()
+                next_report += REPORT_SECONDS
+    finally:
+        if not dispatcher.close(drain=not shutdown.requested(),
+                                timeout=shutdown.remaining()):
+            print ('Lanes still busy after draining; their messages will be '
+                   'redelivered after the ack deadline')
+        with print_lock:
+            dispatcher.report()
+
+
+def pull_messages(transport, args):
     """Pull messages from a given subscription."""
     subscription = get_full_subscription_name(
         args.project_name,
         args.subscription)
-    body = {
-        'returnImmediately': False,
-        'maxMessages': BATCH_SIZE
-    }
-    while True:
+    probe = limit = None
+    if args.latency:
+        probe = pubsub_latency.LatencyProbe()
+    if args.adaptive:
+        limit = pubsub_adaptive.AdaptiveLimit(
+            'pull max messages', BATCH_SIZE,
+            maximum=pubsub_publisher.MAX_BATCH_SIZE, step=BATCH_SIZE)
+    policy = make_failure_policy(transport, subscription, args)
+    with pubsub_shutdown.Shutdown(args.drain_seconds) as shutdown:
+        try:
+            if args.key:
+                pull_keyed_messages(transport, subscription, args, probe,
+                                    limit, policy, shutdown)
+            else:
+                pull_batches(transport, subscription, args, probe, limit,
+                             policy, shutdown)
+        finally:
+            if policy and policy.dead_letters:
+                policy.dead_letters.close(shutdown.remaining())
+            if probe:
+                print probe.report()
+
+
+def pull_batches(transport, subscription, args, probe=None, limit=None,
+                 policy=None, shutdown=None):
+    """Pull messages and print them, or record them with probe.
+
+    Messages are acknowledged once handled. Failed ones are left to be
+    redelivered after their ack deadline, or, with a policy, nacked or
+    dead-lettered. Once shutdown is requested, the rest of the batch at
+    hand is nacked.
+    """
+    shutdown = shutdown or pubsub_shutdown.Shutdown()
+    handler = make_handler(args, probe)
+    counts = collections.Counter()
+    next_report = time.time() + REPORT_SECONDS
+    while not shutdown.requested():
         try:
-            resp = client.projects().subscriptions().pull(
-                subscription=subscription, body=body).execute(
-                    num_retries=NUM_RETRIES)
+            received_messages = pull_batch(transport, subscription, limit)
         except Exception as e:
-            time.sleep(0.5)
-            print e
+            if not shutdown.requested():  # else interrupted by it
+                print e
+                shutdown.wait(0.5)
             continue
-        receivedMessages = resp.get('receivedMessages')
-        if receivedMessages:
-            ack_ids = []
-            for receivedMessage in receivedMessages:
-                message = receivedMessage.get('message')
-                if message:
-                    print base64.b64decode(str(message.get('data')))
-                    ack_ids.append(receivedMessage.get('ackId'))
-            ack_body = {'ackIds': ack_ids}
-            client.projects().subscriptions().acknowledge(
-                subscription=subscription, body=ack_body).execute(
-                    num_retries=NUM_RETRIES)
+        if received_messages:
+            ack_ids, nack_ids = pubsub_consumer.handle_batch(
+                received_messages, handler, policy, shutdown.requested)
+            if ack_ids:
+                with pubsub_profile.span('ack', messages=len(ack_ids)):
+                    transport.acknowledge(subscription, ack_ids)
+            if nack_ids:
+                transport.modify_ack_deadline(subscription, nack_ids, 0)
+            counts.update(pulled=len(received_messages),
+                          acked=len(ack_ids), nacked=len(nack_ids))
         if args.no_loop:
             break
+        if probe and time.time() >= next_report:
+            print probe.report()
+            next_report += REPORT_SECONDS
+    print 'pulled {} messages: {} acknowledged, {} nacked'.format(
+        counts['pulled'], counts['acked'], counts['nacked'])
+
+
+def send_probes(transport, args):
+    """Publish messages stamped for pull_messages --latency."""
+    topic = get_full_topic_name(args.project_name, args.topic)
+    prober = pubsub_latency.Prober()
+    bucket = pubsub_publisher.TokenBucket(args.rate)
+    payload = 'x' * args.size
+    sent = 0
+    next_report = time.time() + REPORT_SECONDS
+    print 'Sending probes to {} as {}'.format(topic, prober.source)
+    while not args.count or sent < args.count:
+        bucket.acquire()
+        message = pubsub_transport.make_message(
+            payload, prober.stamp(topic))
+        try:
+            with pubsub_profile.span('publish', messages=1):
+                transport.publish(topic, [message])
+            sent += 1
+        except Exception as e:
+            # The lost sequence number shows up as a gap on the receiver.
+            print e
+        if time.time() >= next_report:
+            print 'sent {} probes'.format(sent)
+            next_report += REPORT_SECONDS
+    print 'sent {} probes'.format(sent)
+
+
+def load_hook(spec):
+    """Import a 'module.function' hook, like the transform of the relay
+    command or the handler of pull_messages."""
+    module_name, _, function_name = spec.rpartition('.')
+    if not module_name:
+        raise ValueError('Expected module.function, got {}'.format(spec))
+    import importlib
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class RelayStats(object):
+    """Thread safe counters of the relay command."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counts = collections.Counter()
+
+    def add(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def report(self):
+        with self.lock:
+            counts = dict(self.counts)
+        elapsed = time.time() - self.start
+        in_flight = (counts.get('pulled', 0) - counts.get('acked', 0) -
+                     counts.get('nacked', 0))
+        print ('relayed {} messages ({:.0f} msgs/s), {} dropped, '
+               '{} failed, {} in flight'.format(
+                   counts.get('published', 0),
+                   counts.get('published', 0) / elapsed,
+                   counts.get('dropped', 0), counts.get('nacked', 0),
+                   in_flight))
+
+
+def relay_batch(transport, subscription, topic, received_messages,
+                transform, stats):
+    """Republish pulled messages, then acknowledge them.
+
+    Messages are only acknowledged once the publish succeeded. If the
+    transform or the publish fails, they are nacked, so that they are
+    redelivered right away.
+    """
+    ack_ids = [received.ack_id for received in received_messages]
+    messages = []
+    try:
+        for received in received_messages:
+            message = pubsub_transport.make_message(
+                received.message.data, received.message.attributes)
+            if transform:
+                message = transform(message)
+            if message is not None:
+                messages.append(message)
+        if messages:
+            with pubsub_profile.span('publish', messages=len(messages)):
+                transport.publish(topic, messages)
+    except Exception as e:
+        print 'Failed to relay {} messages: {}'.format(len(ack_ids), e)
+        transport.modify_ack_deadline(subscription, ack_ids, 0)
+        stats.add(nacked=len(ack_ids))
+        return
+    with pubsub_profile.span('ack', messages=len(ack_ids)):
+        transport.acknowledge(subscription, ack_ids)
+    stats.add(published=len(messages),
+              dropped=len(ack_ids) - len(messages), acked=len(ack_ids))
+
+
+def relay_messages(transport, args):
+    """Copy messages from a subscription to a topic.
+
+    Each worker pulls a batch, republishes it with the same attributes and
+    acknowledges it, so that workers pull and publish at the same time
+    and at most workers * batch_size messages are held in memory.
+    """
+    subscription = get_full_subscription_name(args.project_name,
+                                              args.subscription)
+    topic = args.topic
+    if not topic.startswith('projects/'):
+        topic = get_full_topic_name(args.project_name, topic)
+    transform = load_hook(args.transform) if args.transform else None
+    stats = RelayStats()
+
+    def work():
+        while True:
+            try:
+                with pubsub_profile.span('pull'):
+                    received_messages = transport.pull(
+                        subscription, args.batch_size,
+                        return_immediately=args.no_loop)
+            except Exception as e:
+                time.sleep(0.5)
+                print e
+                continue
+            if received_messages:
+                stats.add(pulled=len(received_messages))
+                try:
+                    relay_batch(transport, subscription, topic,
+                                received_messages, transform, stats)
+                except Exception as e:  # the messages will be redelivered
+                    print e
+            elif args.no_loop:
+                return
+
+    workers = [threading.Thread(target=work) for _ in range(args.workers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    report_until_done(workers, stats)
+
+
+def report_until_done(threads, stats):
+    """Wait for threads, and print the stats every REPORT_SECONDS until
+    they are done, and once more then."""
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(REPORT_SECONDS)
+            if thread.is_alive():
+                stats.report()
+                break
+    stats.report()
 
 
 def main(argv):
@@ -248,11 +840,30 @@ def main(argv):
     parser = argparse.ArgumentParser(
         description='A sample command line interface for Pub/Sub')
     parser.add_argument('project_name', help='Project name in console')
+    parser.add_argument(
+        '--transport', choices=pubsub_transport.TRANSPORTS, default='rest',
+        help='How to talk to Cloud Pub/Sub; "memory" uses an in-process '
+        'stand-in')
+    pubsub_profile.add_arguments(parser)
 
     topic_parser = argparse.ArgumentParser(add_help=False)
     topic_parser.add_argument('topic', help='Topic name')
     subscription_parser = argparse.ArgumentParser(add_help=False)
     subscription_parser.add_argument('subscription', help='Subscription name')
+    codec_parser = argparse.ArgumentParser(add_help=False)
+    codec_parser.add_argument(
+        '-c', '--codec', type=codec_arg,
+        help='Encode payloads with these codecs, e.g. "zlib" or "row+zlib". '
+        'Available: {}'.format(', '.join(pubsub_codec.CODECS)))
+    drain_parser = argparse.ArgumentParser(add_help=False)
+    drain_parser.add_argument(
+        '--drain_seconds', type=float,
+        default=pubsub_shutdown.DRAIN_SECONDS,
+        help='Seconds to finish the work in flight on SIGTERM or Ctrl-C')
+    list_parser = argparse.ArgumentParser(add_help=False)
+    list_parser.add_argument(
+        '--page_size', type=int, default=PAGE_SIZE,
+        help='Number of resources to request per page')
 
     # Sub command parsers
     sub_parsers = parser.add_subparsers(
@@ -260,8 +871,15 @@ def main(argv):
 
     list_topics_str = 'List topics in project'
     parser_list_topics = sub_parsers.add_parser(
-        'list_topics', description=list_topics_str, help=list_topics_str)
+        'list_topics', parents=[list_parser],
+        description=list_topics_str, help=list_topics_str)
     parser_list_topics.set_defaults(func=list_topics)
+    parser_list_topics.add_argument(
+        '-s', '--with_subscriptions', action='store_true',
+        help='Also list the subscriptions of every topic')
+    parser_list_topics.add_argument(
+        '-w', '--workers', type=int, default=LIST_WORKERS,
+        help='Number of topics to look up subscriptions for concurrently')
 
     create_topic_str = 'Create a topic with specified name'
     parser_create_topic = sub_parsers.add_parser(
@@ -277,7 +895,7 @@ def main(argv):
 
     list_subscriptions_str = 'List subscriptions in project'
     parser_list_subscriptions = sub_parsers.add_parser(
-        'list_subscriptions',
+        'list_subscriptions', parents=[list_parser],
         description=list_subscriptions_str, help=list_subscriptions_str)
     parser_list_subscriptions.set_defaults(func=list_subscriptions)
     parser_list_subscriptions.add_argument(
@@ -298,9 +916,31 @@ def main(argv):
         description=delete_subscription_str, help=delete_subscription_str)
     parser_delete_subscription.set_defaults(func=delete_subscription)
 
+    provision_parser = argparse.ArgumentParser(add_help=False)
+    provision_parser.add_argument(
+        'manifest', help='JSON or YAML file listing topics and subscriptions')
+    provision_parser.add_argument(
+        '-w', '--workers', type=int, default=PROVISION_WORKERS,
+        help='Number of concurrent requests')
+    provision_parser.add_argument(
+        '-r', '--rate', type=float, default=PROVISION_RATE,
+        help='Maximum number of requests per second')
+
+    apply_str = 'Create the topics and subscriptions in a manifest'
+    parser_apply = sub_parsers.add_parser(
+        'apply', parents=[provision_parser],
+        description=apply_str, help=apply_str)
+    parser_apply.set_defaults(func=apply_manifest)
+
+    destroy_str = 'Delete the topics and subscriptions in a manifest'
+    parser_destroy = sub_parsers.add_parser(
+        'destroy', parents=[provision_parser],
+        description=destroy_str, help=destroy_str)
+    parser_destroy.set_defaults(func=destroy_manifest)
+
     connect_irc_str = 'Connect to the topic IRC channel'
     parser_connect_irc = sub_parsers.add_parser(
-        'connect_irc', parents=[topic_parser],
+        'connect_irc', parents=[topic_parser, codec_parser, drain_parser],
         description=connect_irc_str, help=connect_irc_str)
     parser_connect_irc.set_defaults(func=connect_irc)
     parser_connect_irc.add_argument('server', help='Server name')
@@ -308,29 +948,129 @@ def main(argv):
 
     publish_message_str = 'Publish a message to specified topic'
     parser_publish_message = sub_parsers.add_parser(
-        'publish_message', parents=[topic_parser],
+        'publish_message', parents=[topic_parser, codec_parser],
         description=publish_message_str, help=publish_message_str)
     parser_publish_message.set_defaults(func=publish_message)
     parser_publish_message.add_argument('message', help='Message to publish')
+    parser_publish_message.add_argument(
+        '--via_daemon', '--via-daemon', action='store_true',
+        help='Hand the message off to a running serve command; it replies '
+        'once the batch of the message is published, after up to its '
+        '--max_latency plus the publish request')
+    parser_publish_message.add_argument(
+        '--socket', help='Unix domain socket of the serve command, by '
+        'default one in $XDG_RUNTIME_DIR')
+
+    serve_str = ('Keep a publisher running on a Unix domain socket for '
+                 'publish_message --via_daemon')
+    parser_serve = sub_parsers.add_parser(
+        'serve', parents=[drain_parser], description=serve_str,
+        help=serve_str)
+    parser_serve.set_defaults(func=serve)
+    parser_serve.add_argument(
+        '--socket', help='Unix domain socket to serve on, by default one '
+        'in $XDG_RUNTIME_DIR')
+    parser_serve.add_argument(
+        '-b', '--batch_size', type=int, default=pubsub_publisher.BATCH_SIZE,
+        help='Maximum number of messages per publish request')
+    parser_serve.add_argument(
+        '-w', '--workers', type=int,
+        default=pubsub_publisher.PUBLISH_WORKERS,
+        help='Number of concurrent publish requests per topic')
+    parser_serve.add_argument(
+        '--adaptive', action='store_true',
+        help='Tune the batch size and the requests in flight to the load, '
+        'starting from -b and up to -w')
+    parser_serve.add_argument(
+        '--max_latency', type=float, default=pubsub_publisher.MAX_LATENCY,
+        help='Seconds a message may wait for its batch to fill up')
 
     pull_messages_str = ('Pull messages for given subscription. '
                          'Loops continuously unless otherwise specified')
     parser_pull_messages = sub_parsers.add_parser(
-        'pull_messages', parents=[subscription_parser],
+        'pull_messages', parents=[subscription_parser, drain_parser],
         description=pull_messages_str, help=pull_messages_str)
     parser_pull_messages.set_defaults(func=pull_messages)
     parser_pull_messages.add_argument(
         '-n', '--no_loop', action='store_true',
         help='Execute only once and do not loop')
+    parser_pull_messages.add_argument(
+        '-k', '--key',
+        help='Handle messages with the same key in order, and different '
+        'keys in parallel. The key is attribute:NAME, or field:N for the '
+        'Nth comma separated field of the payload')
+    parser_pull_messages.add_argument(
+        '--adaptive', action='store_true',
+        help='Tune the number of messages per pull to the load, instead of '
+        'pulling {} at a time'.format(BATCH_SIZE))
+    parser_pull_messages.add_argument(
+        '--latency', action='store_true',
+        help='Instead of printing messages, report their latency, and the '
+        'gaps and duplicates in the sequences of the probe command')
+    parser_pull_messages.add_argument(
+        '-l', '--lanes', type=int, default=pubsub_consumer.LANES,
+        help='Number of keyed lanes handled in parallel')
+    parser_pull_messages.add_argument(
+        '--handler',
+        help='A module.function that gets every Message, and raises when it '
+        'fails to handle it; by default messages are printed')
+    parser_pull_messages.add_argument(
+        '--max_attempts', type=int, default=0,
+        help='Nack failed messages so they are retried right away, and '
+        'after this many attempts hand them to --dead_letter, or else '
+        'leave them to their ack deadline (default {} with '
+        '--dead_letter)'.format(pubsub_consumer.MAX_ATTEMPTS))
+    parser_pull_messages.add_argument(
+        '--dead_letter',
+        help='Where --max_attempts puts messages that keep failing: a topic, '
+        'or file:PATH to append them to as JSON lines')
 
-    # Google API setup
-    credentials = GoogleCredentials.get_application_default()
-    if credentials.create_scoped_required():
-        credentials = credentials.create_scoped(PUBSUB_SCOPES)
-    client = discovery.build('pubsub', 'v1', credentials=credentials)
+    probe_str = ('Publish probe messages at a steady rate, for '
+                 'pull_messages --latency')
+    parser_probe = sub_parsers.add_parser(
+        'probe', parents=[topic_parser],
+        description=probe_str, help=probe_str)
+    parser_probe.set_defaults(func=send_probes)
+    parser_probe.add_argument(
+        '-r', '--rate', type=float, default=PROBE_RATE,
+        help='Probes per second')
+    parser_probe.add_argument(
+        '-c', '--count', type=int, default=0,
+        help='Number of probes to send; 0 sends them until interrupted')
+    parser_probe.add_argument(
+        '-s', '--size', type=int, default=PROBE_SIZE,
+        help='Payload bytes per probe')
+
+    relay_str = ('Republish the messages of a subscription to a topic, '
+                 'which can be in another project')
+    parser_relay = sub_parsers.add_parser(
+        'relay', parents=[subscription_parser],
+        description=relay_str, help=relay_str)
+    parser_relay.set_defaults(func=relay_messages)
+    parser_relay.add_argument(
+        'topic', help='Topic name, or full name like projects/P/topics/T')
+    parser_relay.add_argument(
+        '-w', '--workers', type=int, default=RELAY_WORKERS,
+        help='Number of concurrent pull and publish loops')
+    parser_relay.add_argument(
+        '-b', '--batch_size', type=int, default=RELAY_BATCH_SIZE,
+        help='Maximum number of messages per pull and publish')
+    parser_relay.add_argument(
+        '-t', '--transform',
+        help='A module.function that gets every Message and returns the '
+        'Message to publish, or None to drop it')
+    parser_relay.add_argument(
+        '-n', '--no_loop', action='store_true',
+        help='Stop once the subscription has no more messages')
 
     args = parser.parse_args(argv[1:])
-    args.func(client, args)
+    if getattr(args, 'via_daemon', False):
+        # The daemon has a client already, so don't pay for another one.
+        publish_via_daemon(None, args)
+        return
+    transport = pubsub_transport.create_transport(args.transport)
+    with pubsub_profile.from_args(args):
+        args.func(transport, args)
 
 
 if __name__ == '__main__':
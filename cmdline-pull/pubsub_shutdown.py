@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Graceful shutdown of the commands that loop until they are stopped.
+
+Killing pull_messages, connect_irc or the traffic generator outright
+loses the messages batched for publishing, and leaves the messages that
+were pulled but not acknowledged to be redelivered after their ack
+deadline, and handled again. While a Shutdown is installed, the first
+SIGTERM or Ctrl-C is a request to stop instead: the loops stop taking in
+new work, and have drain_seconds to publish and acknowledge what is in
+flight, and to nack what they won't handle, so that it is redelivered
+right away, e.g. to the next consumer of a rolling deploy. A second
+signal stops the drain with KeyboardInterrupt.
+"""
+
+import signal
+import threading
+import time
+
+
+DRAIN_SECONDS = 10
+
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+class Shutdown(object):
+    """Turns stop signals into a request to stop, while used in a with
+    statement. Signals can only be caught on the main thread."""
+
+    def __init__(self, drain_seconds=DRAIN_SECONDS):
+        self.drain_seconds = drain_seconds
+        self.event = threading.Event()
+        self.deadline = None
+        self.previous = {}
+
+    def __enter__(self):
+        for signum in SIGNALS:
+            self.previous[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)
+        self.previous.clear()
+
+    def _handle(self, signum, frame):
+        if self.event.is_set():
+            raise KeyboardInterrupt
+        print ('Stopping on signal {}: draining for up to {:.0f}s, signal '
+               'again to stop right away'.format(signum, self.drain_seconds))
+        self.request()
+
+    def request(self):
+        """Asks the loops to stop, and starts the drain deadline."""
+        if not self.event.is_set():
+            self.deadline = time.time() + self.drain_seconds
+            self.event.set()
+
+    def requested(self):
+        return self.event.is_set()
+
+    def wait(self, seconds):
+        """Sleeps for seconds, or until a stop is requested. Returns
+        whether one was."""
+        return self.event.wait(max(seconds, 0))
+
+    def remaining(self):
+        """Returns the seconds left to drain, or None, for no limit, when
+        the loops ended without a stop request."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
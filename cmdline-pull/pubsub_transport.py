@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Transports for the Cloud Pub/Sub samples.
+
+Every sample talks to Cloud Pub/Sub through a Transport, which has three
+implementations:
+
+- RestTransport uses the discovery based Google API client.
+- GrpcTransport uses the gRPC Publisher and Subscriber stubs.
+- InMemoryTransport keeps everything in-process, with ack deadlines,
+  redelivery and in-order delivery, for tests and benchmarks.
+
+Resources (topics and subscriptions) are returned as dicts in the JSON
+format of the REST API. Message payloads are byte strings; encoding them
+for the wire is left to the transport.
+"""
+
+import base64
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+
+PUBSUB_SCOPES = ['https://www.googleapis.com/auth/pubsub']
+
+PUBSUB_ENDPOINT = 'pubsub.googleapis.com'
+
+SSL_PORT = 443
+
+NUM_RETRIES = 3
+
+GRPC_TIMEOUT = 30
+
+DEFAULT_ACK_DEADLINE_SECONDS = 10
+
+TRANSPORTS = ['rest', 'grpc', 'memory']
+
+DISCOVERY_URL = ('https://www.googleapis.com/discovery/v1/apis/'
+                 'pubsub/v1/rest')
+
+# Where the discovery document of the REST API is cached, and for how long.
+DISCOVERY_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'pubsub-samples', 'pubsub-v1.json')
+
+DISCOVERY_CACHE_SECONDS = 24 * 60 * 60
+
+# host:port of a local Cloud Pub/Sub emulator (or of pubsub_fake) to use
+# instead of the service, without credentials, as the gcloud SDK does.
+EMULATOR_HOST_ENV = 'PUBSUB_EMULATOR_HOST'
+
+EMULATOR_DISCOVERY_PATH = '/discovery/v1/apis/pubsub/v1/rest'
+
+
+Message = collections.namedtuple(
+    'Message', ['data', 'attributes', 'message_id', 'publish_time'])
+
+ReceivedMessage = collections.namedtuple(
+    'ReceivedMessage', ['ack_id', 'message'])
+
+
+def make_message(data, attributes=None):
+    """Returns a Message to be published."""
+    return Message(data=data, attributes=attributes or {},
+                   message_id=None, publish_time=None)
+
+
+class TransportError(Exception):
+    """An error returned by Cloud Pub/Sub, with an HTTP status code."""
+
+    def __init__(self, status, message):
+        super(TransportError, self).__init__(message)
+        self.status = status
+
+
+_credentials = None
+
+
+def get_credentials():
+    """Returns the application default credentials scoped for Pub/Sub.
+
+    They are looked up once per process, since on GCE that takes a request
+    to the metadata server.
+    """
+    global _credentials
+    if _credentials is None:
+        from oauth2client.client import GoogleCredentials
+        credentials = GoogleCredentials.get_application_default()
+        if credentials.create_scoped_required():
+            credentials = credentials.create_scoped(PUBSUB_SCOPES)
+        _credentials = credentials
+    return _credentials
+
+
+def get_discovery_document(path=DISCOVERY_CACHE_PATH,
+                           max_age=DISCOVERY_CACHE_SECONDS):
+    """Returns the discovery document of the API, cached in path.
+
+    discovery.build fetches the document on every run, which costs short
+    lived invocations of the samples a round trip.
+    """
+    try:
+        if time.time() - os.path.getmtime(path) < max_age:
+            with open(path) as cached:
+                return cached.read()
+    except (IOError, OSError):
+        pass
+    import httplib2
+    response, content = httplib2.Http().request(DISCOVERY_URL)
+    if response.status >= 400:
+        raise TransportError(response.status,
+                             'Failed to fetch ' + DISCOVERY_URL)
+    json.loads(content)  # don't cache a broken document
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Rename into place, so that concurrent runs never read half of it.
+        tmp_path = '{}.{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as cached:
+            cached.write(content)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass  # the cache is only an optimization
+    return content
+
+
+def get_emulator_discovery_document(host):
+    """Returns a discovery document for the REST API of an emulator.
+
+    pubsub_fake serves one of its own; for the Cloud Pub/Sub emulator,
+    which doesn't, the document of the service is pointed at the host.
+    """
+    import httplib2
+    try:
+        response, content = httplib2.Http().request(
+            'http://{}{}'.format(host, EMULATOR_DISCOVERY_PATH))
+        if response.status == 200:
+            return content
+    except (httplib2.HttpLib2Error, IOError):
+        pass
+    document = json.loads(get_discovery_document())
+    document['rootUrl'] = 'http://{}/'.format(host)
+    document['baseUrl'] = document['rootUrl'] + document['servicePath']
+    return json.dumps(document)
+
+
+class _Unauthenticated(object):
+    """Stands in for credentials, for an emulator, which needs none."""
+
+    def authorize(self, http):
+        return http
+
+
+def create_transport(name, credentials=None):
+    """Creates the transport with the given name.
+
+    Nothing is imported or looked up before a transport is asked for, so
+    that commands that fail early, or only print help, start quickly.
+    When PUBSUB_EMULATOR_HOST is set, the rest and grpc transports talk
+    to the emulator there instead of Cloud Pub/Sub.
+    """
+    emulator_host = os.environ.get(EMULATOR_HOST_ENV)
+    if name == 'rest':
+        from googleapiclient import discovery
+        if emulator_host:
+            import httplib2
+            credentials = _Unauthenticated()
+            client = discovery.build_from_document(
+                get_emulator_discovery_document(emulator_host),
+                http=httplib2.Http())
+            return RestTransport(client, credentials)
+        credentials = credentials or get_credentials()
+        client = discovery.build_from_document(
+            get_discovery_document(), credentials=credentials)
+        return RestTransport(client, credentials)
+    elif name == 'grpc':
+        if emulator_host:
+            return GrpcTransport.create_insecure(emulator_host)
+        return GrpcTransport.create(credentials or get_credentials())
+    elif name == 'memory':
+        return SHARED_IN_MEMORY_TRANSPORT
+    raise ValueError('Unknown transport: {}'.format(name))
+
+
+class Transport(object):
+    """The operations the samples use on Cloud Pub/Sub.
+
+    Methods taking a page_token return a (items, next_page_token) tuple.
+    Their fields argument is a partial response mask, such as
+    'topics/name,nextPageToken'; transports that can't trim responses
+    ignore it.
+
+    Transports are safe to use from several threads.
+    """
+
+    def get_topic(self, topic):
+        raise NotImplementedError
+
+    def create_topic(self, topic):
+        raise NotImplementedError
+
+    def delete_topic(self, topic):
+        raise NotImplementedError
+
+    def list_topics(self, project, page_size=None, page_token=None,
+                    fields=None):
+        raise NotImplementedError
+
+    def list_topic_subscriptions(self, topic, page_size=None,
+                                 page_token=None, fields=None):
+        """Lists the names of the subscriptions attached to a topic."""
+        raise NotImplementedError
+
+    def get_subscription(self, subscription):
+        raise NotImplementedError
+
+    def create_subscription(self, subscription, topic, push_endpoint=None,
+                            ack_deadline_seconds=None):
+        raise NotImplementedError
+
+    def delete_subscription(self, subscription):
+        raise NotImplementedError
+
+    def modify_push_config(self, subscription, push_endpoint=None):
+        """Sets the push endpoint; None turns it into a pull subscription."""
+        raise NotImplementedError
+
+    def list_subscriptions(self, project, page_size=None, page_token=None,
+                           fields=None):
+        raise NotImplementedError
+
+    def publish(self, topic, messages):
+        """Publishes a list of Messages and returns their message IDs."""
+        raise NotImplementedError
+
+    def pull(self, subscription, max_messages, return_immediately=False):
+        """Returns a list of ReceivedMessages."""
+        raise NotImplementedError
+
+    def acknowledge(self, subscription, ack_ids):
+        raise NotImplementedError
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        raise NotImplementedError
+
+
+class RestTransport(Transport):
+    """A transport using the discovery based Google API client."""
+
+    def __init__(self, client, credentials=None, num_retries=NUM_RETRIES):
+        """Creates the transport.
+
+        httplib2.Http objects are not thread safe, so when credentials are
+        given every thread executes requests on its own authorized Http.
+        """
+        self.client = client
+        self.credentials = credentials
+        self.num_retries = num_retries
+        self.local = threading.local()
+
+    def _http(self):
+        """Returns the Http to execute requests with on this thread."""
+        if self.credentials is None:
+            return None
+        if not hasattr(self.local, 'http'):
+            import httplib2
+            self.local.http = self.credentials.authorize(httplib2.Http())
+        return self.local.http
+
+    def _execute(self, request):
+        """Executes an API request, raising TransportError on failure."""
+        from googleapiclient import errors
+        try:
+            return request.execute(http=self._http(),
+                                   num_retries=self.num_retries)
+        except errors.HttpError as e:
+            raise TransportError(e.resp.status, str(e))
+
+    def get_topic(self, topic):
+        return self._execute(self.client.projects().topics().get(topic=topic))
+
+    def create_topic(self, topic):
+        return self._execute(
+            self.client.projects().topics().create(name=topic, body={}))
+
+    def delete_topic(self, topic):
+        self._execute(self.client.projects().topics().delete(topic=topic))
+
+    def list_topics(self, project, page_size=None, page_token=None,
+                    fields=None):
+        resp = self._execute(self.client.projects().topics().list(
+            project=project, pageSize=page_size, pageToken=page_token,
+            fields=fields))
+        return resp.get('topics', []), resp.get('nextPageToken')
+
+    def list_topic_subscriptions(self, topic, page_size=None,
+                                 page_token=None, fields=None):
+        resp = self._execute(
+            self.client.projects().topics().subscriptions().list(
+                topic=topic, pageSize=page_size, pageToken=page_token,
+                fields=fields))
+        return resp.get('subscriptions', []), resp.get('nextPageToken')
+
+    def get_subscription(self, subscription):
+        return self._execute(self.client.projects().subscriptions().get(
+            subscription=subscription))
+
+    def create_subscription(self, subscription, topic, push_endpoint=None,
+                            ack_deadline_seconds=None):
+        body = {'topic': topic}
+        if push_endpoint is not None:
+            body['pushConfig'] = {'pushEndpoint': push_endpoint}
+        if ack_deadline_seconds is not None:
+            body['ackDeadlineSeconds'] = ack_deadline_seconds
+        return self._execute(self.client.projects().subscriptions().create(
+            name=subscription, body=body))
+
+    def delete_subscription(self, subscription):
+        self._execute(self.client.projects().subscriptions().delete(
+            subscription=subscription))
+
+    def modify_push_config(self, subscription, push_endpoint=None):
+        push_config = {}
+        if push_endpoint is not None:
+            push_config['pushEndpoint'] = push_endpoint
+        self._execute(
+            self.client.projects().subscriptions().modifyPushConfig(
+                subscription=subscription, body={'pushConfig': push_config}))
+
+    def list_subscriptions(self, project, page_size=None, page_token=None,
+                           fields=None):
+        resp = self._execute(self.client.projects().subscriptions().list(
+            project=project, pageSize=page_size, pageToken=page_token,
+            fields=fields))
+        return resp.get('subscriptions', []), resp.get('nextPageToken')
+
+    def publish(self, topic, messages):
+        body = {'messages': []}
+        for message in messages:
+            payload = {'data': base64.b64encode(message.data)}
+            if message.attributes:
+                payload['attributes'] = message.attributes
+            body['messages'].append(payload)
+        resp = self._execute(self.client.projects().topics().publish(
+            topic=topic, body=body))
+        return resp.get('messageIds', [])
+
+    def pull(self, subscription, max_messages, return_immediately=False):
+        body = {'returnImmediately': return_immediately,
+                'maxMessages': max_messages}
+        resp = self._execute(self.client.projects().subscriptions().pull(
+            subscription=subscription, body=body))
+        received = []
+        for received_message in resp.get('receivedMessages', []):
+            message = received_message.get('message')
+            if not message:
+                continue
+            received.append(ReceivedMessage(
+                ack_id=received_message.get('ackId'),
+                message=Message(
+                    data=base64.b64decode(str(message.get('data', ''))),
+                    attributes=message.get('attributes', {}),
+                    message_id=message.get('messageId'),
+                    publish_time=message.get('publishTime'))))
+        return received
+
+    def acknowledge(self, subscription, ack_ids):
+        self._execute(self.client.projects().subscriptions().acknowledge(
+            subscription=subscription, body={'ackIds': ack_ids}))
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        body = {'ackIds': ack_ids, 'ackDeadlineSeconds': ack_deadline_seconds}
+        self._execute(
+            self.client.projects().subscriptions().modifyAckDeadline(
+                subscription=subscription, body=body))
+
+
+# gRPC status codes and the HTTP status codes the REST API uses for them.
+GRPC_TO_HTTP_STATUS = {
+    'INVALID_ARGUMENT': 400,
+    'UNAUTHENTICATED': 401,
+    'PERMISSION_DENIED': 403,
+    'NOT_FOUND': 404,
+    'ALREADY_EXISTS': 409,
+    'RESOURCE_EXHAUSTED': 429,
+    'CANCELLED': 499,
+    'INTERNAL': 500,
+    'UNIMPLEMENTED': 501,
+    'UNAVAILABLE': 503,
+    'DEADLINE_EXCEEDED': 504,
+}
+
+
+class GrpcTransport(Transport):
+    """A transport using the gRPC Publisher and Subscriber stubs."""
+
+    def __init__(self, publisher, subscriber, timeout=GRPC_TIMEOUT):
+        from google.pubsub.v1 import pubsub_pb2
+        self.pb2 = pubsub_pb2
+        self.publisher = publisher
+        self.subscriber = subscriber
+        self.timeout = timeout
+
+    @classmethod
+    def create(cls, credentials, host=PUBSUB_ENDPOINT, port=SSL_PORT):
+        """Creates a transport over a secure channel to Cloud Pub/Sub."""
+        from google.pubsub.v1 import pubsub_pb2
+        from grpc.beta import implementations
+
+        def auth_func(ctx, callback):
+            token = credentials.get_access_token().access_token
+            callback([('authorization', 'Bearer %s' % token)], None)
+
+        ssl_creds = implementations.ssl_channel_credentials(None, None, None)
+        call_creds = implementations.metadata_call_credentials(auth_func)
+        channel = implementations.secure_channel(
+            host, port,
+            implementations.composite_channel_credentials(ssl_creds,
+                                                          call_creds))
+        return cls(pubsub_pb2.beta_create_Publisher_stub(channel),
+                   pubsub_pb2.beta_create_Subscriber_stub(channel))
+
+    @classmethod
+    def create_insecure(cls, host_port):
+        """Creates a transport over a plaintext channel to an emulator."""
+        from google.pubsub.v1 import pubsub_pb2
+        from grpc.beta import implementations
+        host, _, port = host_port.rpartition(':')
+        channel = implementations.insecure_channel(host, int(port))
+        return cls(pubsub_pb2.beta_create_Publisher_stub(channel),
+                   pubsub_pb2.beta_create_Subscriber_stub(channel))
+
+    def _call(self, method, request):
+        """Calls a stub method, raising TransportError on failure."""
+        from grpc.framework.interfaces.face import face
+        try:
+            return method(request, self.timeout)
+        except face.AbortionError as e:
+            code = getattr(e.code, 'name', None) or str(e.code).split('.')[-1]
+            raise TransportError(GRPC_TO_HTTP_STATUS.get(code, 500),
+                                 '{}: {}'.format(code, e.details))
+
+    @staticmethod
+    def _topic_to_dict(topic):
+        return {'name': topic.name}
+
+    @staticmethod
+    def _subscription_to_dict(subscription):
+        resource = {'name': subscription.name, 'topic': subscription.topic,
+                    'ackDeadlineSeconds': subscription.ack_deadline_seconds}
+        if subscription.push_config.push_endpoint:
+            resource['pushConfig'] = {
+                'pushEndpoint': subscription.push_config.push_endpoint}
+        return resource
+
+    def get_topic(self, topic):
+        return self._topic_to_dict(self._call(
+            self.publisher.GetTopic, self.pb2.GetTopicRequest(topic=topic)))
+
+    def create_topic(self, topic):
+        return self._topic_to_dict(self._call(
+            self.publisher.CreateTopic, self.pb2.Topic(name=topic)))
+
+    def delete_topic(self, topic):
+        self._call(self.publisher.DeleteTopic,
+                   self.pb2.DeleteTopicRequest(topic=topic))
+
+    def list_topics(self, project, page_size=None, page_token=None,
+                    fields=None):
+        resp = self._call(
+            self.publisher.ListTopics,
+            self.pb2.ListTopicsRequest(project=project,
+                                       page_size=page_size or 0,
+                                       page_token=page_token or ''))
+        return ([self._topic_to_dict(t) for t in resp.topics],
+                resp.next_page_token or None)
+
+    def list_topic_subscriptions(self, topic, page_size=None,
+                                 page_token=None, fields=None):
+        resp = self._call(
+            self.publisher.ListTopicSubscriptions,
+            self.pb2.ListTopicSubscriptionsRequest(
+                topic=topic, page_size=page_size or 0,
+                page_token=page_token or ''))
+        return list(resp.subscriptions), resp.next_page_token or None
+
+    def get_subscription(self, subscription):
+        return self._subscription_to_dict(self._call(
+            self.subscriber.GetSubscription,
+            self.pb2.GetSubscriptionRequest(subscription=subscription)))
+
+    def create_subscription(self, subscription, topic, push_endpoint=None,
+                            ack_deadline_seconds=None):
+        request = self.pb2.Subscription(
+            name=subscription, topic=topic,
+            ack_deadline_seconds=ack_deadline_seconds or 0)
+        if push_endpoint is not None:
+            request.push_config.push_endpoint = push_endpoint
+        return self._subscription_to_dict(
+            self._call(self.subscriber.CreateSubscription, request))
+
+    def delete_subscription(self, subscription):
+        self._call(self.subscriber.DeleteSubscription,
+                   self.pb2.DeleteSubscriptionRequest(
+                       subscription=subscription))
+
+    def modify_push_config(self, subscription, push_endpoint=None):
+        request = self.pb2.ModifyPushConfigRequest(subscription=subscription)
+        if push_endpoint is not None:
+            request.push_config.push_endpoint = push_endpoint
+        self._call(self.subscriber.ModifyPushConfig, request)
+
+    def list_subscriptions(self, project, page_size=None, page_token=None,
+                           fields=None):
+        resp = self._call(
+            self.subscriber.ListSubscriptions,
+            self.pb2.ListSubscriptionsRequest(
+                project=project, page_size=page_size or 0,
+                page_token=page_token or ''))
+        return ([self._subscription_to_dict(s) for s in resp.subscriptions],
+                resp.next_page_token or None)
+
+    def publish(self, topic, messages):
+        request = self.pb2.PublishRequest(topic=topic)
+        for message in messages:
+            request.messages.add(data=message.data,
+                                 attributes=message.attributes)
+        return list(self._call(self.publisher.Publish, request).message_ids)
+
+    def pull(self, subscription, max_messages, return_immediately=False):
+        resp = self._call(self.subscriber.Pull, self.pb2.PullRequest(
+            subscription=subscription, max_messages=max_messages,
+            return_immediately=return_immediately))
+        return [
+            ReceivedMessage(
+                ack_id=received.ack_id,
+                message=Message(
+                    data=received.message.data,
+                    attributes=dict(received.message.attributes),
+                    message_id=received.message.message_id,
+                    publish_time=received.message.publish_time.ToJsonString()
+                    if received.message.HasField('publish_time') else None))
+            for received in resp.received_messages]
+
+    def acknowledge(self, subscription, ack_ids):
+        self._call(self.subscriber.Acknowledge, self.pb2.AcknowledgeRequest(
+            subscription=subscription, ack_ids=ack_ids))
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        self._call(self.subscriber.ModifyAckDeadline,
+                   self.pb2.ModifyAckDeadlineRequest(
+                       subscription=subscription, ack_ids=ack_ids,
+                       ack_deadline_seconds=ack_deadline_seconds))
+
+
+class _InMemorySubscription(object):
+    """The state of a subscription in an InMemoryTransport."""
+
+    def __init__(self, name, topic, push_endpoint, ack_deadline_seconds):
+        self.name = name
+        self.topic = topic
+        self.push_endpoint = push_endpoint
+        self.ack_deadline_seconds = ack_deadline_seconds
+        # Heap of (sequence, message) waiting to be delivered, so that
+        # redelivered messages keep their place in the publish order.
+        self.pending = []
+        # ack_id -> (sequence, message, deadline) of delivered messages.
+        self.outstanding = {}
+
+    def to_dict(self):
+        resource = {'name': self.name, 'topic': self.topic,
+                    'ackDeadlineSeconds': self.ack_deadline_seconds}
+        if self.push_endpoint:
+            resource['pushConfig'] = {'pushEndpoint': self.push_endpoint}
+        return resource
+
+
+class InMemoryTransport(Transport):
+    """An in-process stand-in for the Cloud Pub/Sub service.
+
+    Messages are delivered in publish order. A delivered message that is
+    not acknowledged before its ack deadline becomes available again, with
+    a new ack ID, ahead of the messages published after it.
+    """
+
+    def __init__(self, clock=time.time, max_wait=1.0):
+        self.clock = clock
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.topics = {}
+        self.subscriptions = {}
+        self.sequence = itertools.count(1)
+        self.ack_ids = itertools.count(1)
+
+    def reset(self):
+        """Deletes every topic and subscription."""
+        with self.condition:
+            self.topics.clear()
+            self.subscriptions.clear()
+
+    def _subscription(self, name):
+        try:
+            return self.subscriptions[name]
+        except KeyError:
+            raise TransportError(404, 'Subscription not found: ' + name)
+
+    def _redeliver_expired(self, subscription):
+        """Moves messages past their ack deadline back to pending."""
+        now = self.clock()
+        for ack_id, (sequence, message, deadline) in (
+                subscription.outstanding.items()):
+            if deadline <= now:
+                del subscription.outstanding[ack_id]
+                heapq.heappush(subscription.pending, (sequence, message))
+
+    @staticmethod
+    def _paginate(items, page_size, page_token):
+        start = int(page_token or 0)
+        if not page_size:
+            return items[start:], None
+        end = start + page_size
+        return items[start:end], str(end) if end < len(items) else None
+
+    def get_topic(self, topic):
+        with self.condition:
+            if topic not in self.topics:
+                raise TransportError(404, 'Topic not found: ' + topic)
+            return {'name': topic}
+
+    def create_topic(self, topic):
+        with self.condition:
+            if topic in self.topics:
+                raise TransportError(409, 'Topic already exists: ' + topic)
+            self.topics[topic] = set()
+            return {'name': topic}
+
+    def delete_topic(self, topic):
+        with self.condition:
+            if topic not in self.topics:
+                raise TransportError(404, 'Topic not found: ' + topic)
+            for name in self.topics.pop(topic):
+                # Subscriptions outlive their topic, like in Cloud Pub/Sub.
+                self.subscriptions[name].topic = '_deleted-topic_'
+
+    def list_topics(self, project, page_size=None, page_token=None,
+                    fields=None):
+        prefix = project + '/topics/'
+        with self.condition:
+            names = sorted(t for t in self.topics if t.startswith(prefix))
+        names, token = self._paginate(names, page_size, page_token)
+        return [{'name': name} for name in names], token
+
+    def list_topic_subscriptions(self, topic, page_size=None,
+                                 page_token=None, fields=None):
+        with self.condition:
+            if topic not in self.topics:
+                raise TransportError(404, 'Topic not found: ' + topic)
+            names = sorted(self.topics[topic])
+        return self._paginate(names, page_size, page_token)
+
+    def get_subscription(self, subscription):
+        with self.condition:
+            return self._subscription(subscription).to_dict()
+
+    def create_subscription(self, subscription, topic, push_endpoint=None,
+                            ack_deadline_seconds=None):
+        with self.condition:
+            if subscription in self.subscriptions:
+                raise TransportError(
+                    409, 'Subscription already exists: ' + subscription)
+            if topic not in self.topics:
+                raise TransportError(404, 'Topic not found: ' + topic)
+            state = _InMemorySubscription(
+                subscription, topic, push_endpoint,
+                ack_deadline_seconds or DEFAULT_ACK_DEADLINE_SECONDS)
+            self.subscriptions[subscription] = state
+            self.topics[topic].add(subscription)
+            return state.to_dict()
+
+    def delete_subscription(self, subscription):
+        with self.condition:
+            state = self._subscription(subscription)
+            del self.subscriptions[subscription]
+            self.topics.get(state.topic, set()).discard(subscription)
+
+    def modify_push_config(self, subscription, push_endpoint=None):
+        with self.condition:
+            self._subscription(subscription).push_endpoint = push_endpoint
+
+    def list_subscriptions(self, project, page_size=None, page_token=None,
+                           fields=None):
+        prefix = project + '/subscriptions/'
+        with self.condition:
+            resources = [self.subscriptions[name].to_dict()
+                         for name in sorted(self.subscriptions)
+                         if name.startswith(prefix)]
+        return self._paginate(resources, page_size, page_token)
+
+    def publish(self, topic, messages):
+        with self.condition:
+            if topic not in self.topics:
+                raise TransportError(404, 'Topic not found: ' + topic)
+            publish_time = datetime.datetime.utcfromtimestamp(
+                self.clock()).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            message_ids = []
+            for message in messages:
+                sequence = next(self.sequence)
+                published = message._replace(
+                    message_id=str(sequence), publish_time=publish_time)
+                for name in self.topics[topic]:
+                    heapq.heappush(self.subscriptions[name].pending,
+                                   (sequence, published))
+                message_ids.append(published.message_id)
+            self.condition.notify_all()
+            return message_ids
+
+    def pull(self, subscription, max_messages, return_immediately=False):
+        with self.condition:
+            state = self._subscription(subscription)
+            self._redeliver_expired(state)
+            if not state.pending and not return_immediately:
+                # Block like a long poll, but wake up in time to redeliver
+                # messages whose ack deadline passes while waiting.
+                self.condition.wait(self.max_wait)
+                state = self._subscription(subscription)
+                self._redeliver_expired(state)
+            deadline = self.clock() + state.ack_deadline_seconds
+            received = []
+            while state.pending and len(received) < max_messages:
+                sequence, message = heapq.heappop(state.pending)
+                ack_id = str(next(self.ack_ids))
+                state.outstanding[ack_id] = (sequence, message, deadline)
+                received.append(ReceivedMessage(ack_id, message))
+            return received
+
+    def acknowledge(self, subscription, ack_ids):
+        with self.condition:
+            state = self._subscription(subscription)
+            self._redeliver_expired(state)
+            for ack_id in ack_ids:
+                # Acks for expired or unknown ack IDs are ignored.
+                state.outstanding.pop(ack_id, None)
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        with self.condition:
+            state = self._subscription(subscription)
+            self._redeliver_expired(state)
+            deadline = self.clock() + ack_deadline_seconds
+            for ack_id in ack_ids:
+                if ack_id in state.outstanding:
+                    sequence, message, _ = state.outstanding[ack_id]
+                    state.outstanding[ack_id] = (sequence, message, deadline)
+            if ack_deadline_seconds == 0:
+                self._redeliver_expired(state)
+                self.condition.notify_all()
+
+
+# The transport returned by create_transport('memory'), shared by every
+# sample run in this process.
+SHARED_IN_MEMORY_TRANSPORT = InMemoryTransport()
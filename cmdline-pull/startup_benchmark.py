@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Measures the startup time of the command line sample.
+
+Runs pubsub_sample.py in fresh interpreters and compares the median
+wall time, minus that of a bare interpreter, to a budget. It exits with
+status 1 when over budget, so it can guard against regressions in CI:
+
+% python startup_benchmark.py
+% python startup_benchmark.py --budget 0.1 -- --transport memory \
+  MYPROJ list_topics
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+RUNS = 10
+
+# Seconds that printing the help may take on top of starting Python.
+STARTUP_BUDGET = 0.1
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'pubsub_sample.py')
+
+# Modules that only some commands need, and which must be imported lazily.
+LAZY_MODULES = ['googleapiclient', 'oauth2client', 'httplib2', 'grpc',
+                'cProfile', 'pstats', 'logging', 'multiprocessing', 'socket']
+
+
+def time_runs(command, runs):
+    """Returns the sorted wall times of running command runs times."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def imported_lazy_modules():
+    """Returns the lazy modules that importing the sample imports."""
+    script = ('import sys; import pubsub_sample; '
+              'print " ".join(m for m in {!r} if m in sys.modules)'
+              .format(LAZY_MODULES))
+    return subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(SAMPLE)).split()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Check the startup time of pubsub_sample.py')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                        help='Seconds allowed on top of a bare interpreter')
+    parser.add_argument('sample_args', nargs='*', default=['--help'],
+                        help='Arguments to run the sample with')
+    args = parser.parse_args(argv[1:])
+
+    bare = time_runs([sys.executable, '-c', 'pass'], args.runs)
+    sample = time_runs([sys.executable, SAMPLE] + args.sample_args,
+                       args.runs)
+    overhead = sample[len(sample) // 2] - bare[len(bare) // 2]
+    print 'python:  min {:.3f}s median {:.3f}s'.format(
+        bare[0], bare[len(bare) // 2])
+    print 'sample:  min {:.3f}s median {:.3f}s'.format(
+        sample[0], sample[len(sample) // 2])
+    print 'startup: {:.3f}s, budget {:.3f}s'.format(overhead, args.budget)
+    eager = imported_lazy_modules()
+    if eager:
+        print 'imported eagerly: {}'.format(' '.join(eager))
+    if overhead > args.budget or eager:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
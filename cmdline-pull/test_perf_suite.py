@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the performance suite."""
+
+
+import unittest
+
+from perf_suite import BASELINE_PATH
+from perf_suite import compare
+from perf_suite import HIGHER_IS_BETTER
+from perf_suite import load_baselines
+from perf_suite import median
+
+
+class CompareTestCase(unittest.TestCase):
+    """A test case for the comparison with the baselines."""
+
+    def regressed(self, measured, baselines, latency_floor=0):
+        return dict((result.metric, result.regressed)
+                    for result in compare(measured, baselines, 0.5,
+                                          latency_floor))
+
+    def test_rates_may_not_fall(self):
+        self.assertEqual(
+            self.regressed({'rest/publish msgs/s': 60,
+                            'rest/pull+ack msgs/s': 40},
+                           {'rest/publish msgs/s': 100,
+                            'rest/pull+ack msgs/s': 100}),
+            {'rest/publish msgs/s': False, 'rest/pull+ack msgs/s': True})
+
+    def test_latencies_may_not_rise(self):
+        self.assertEqual(
+            self.regressed({'rest/round trip p50 ms': 14,
+                            'rest/round trip p99 ms': 16},
+                           {'rest/round trip p50 ms': 10,
+                            'rest/round trip p99 ms': 10}),
+            {'rest/round trip p50 ms': False,
+             'rest/round trip p99 ms': True})
+
+    def test_latency_floor(self):
+        """Test that sub-millisecond latencies may rise by the floor."""
+        self.assertEqual(
+            self.regressed({'memory/round trip p50 ms': 0.5,
+                            'memory/round trip p99 ms': 1.2},
+                           {'memory/round trip p50 ms': 0.05,
+                            'memory/round trip p99 ms': 0.1},
+                           latency_floor=1.0),
+            {'memory/round trip p50 ms': False,
+             'memory/round trip p99 ms': True})
+
+    def test_median(self):
+        self.assertEqual(2, median([3, 1, 2]))
+        self.assertEqual(2.5, median([4, 1, 3, 2]))
+
+    def test_new_metrics_pass(self):
+        results = compare({'grpc/publish msgs/s': 1}, {})
+        self.assertIsNone(results[0].baseline)
+        self.assertFalse(results[0].regressed)
+
+    def test_recorded_baselines(self):
+        baselines = load_baselines(BASELINE_PATH)
+        self.assertTrue(baselines)
+        for metric in baselines:
+            self.assertIn(metric.rsplit(' ', 1)[-1], HIGHER_IS_BETTER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the adaptive limits."""
+
+
+import unittest
+
+from pubsub_adaptive import AdaptiveLimit
+from pubsub_fake import FakeClock
+from pubsub_publisher import BatchPublisher
+from pubsub_transport import InMemoryTransport
+from pubsub_transport import make_message
+from pubsub_transport import TransportError
+
+
+TOPIC = 'projects/test/topics/topic'
+
+
+class ThrottledTransport(InMemoryTransport):
+    """Fails every publish request with HTTP 429."""
+
+    def publish(self, topic, messages):
+        raise TransportError(429, 'Too many requests')
+
+
+class AdaptiveLimitTestCase(unittest.TestCase):
+    """A test case for AdaptiveLimit."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.logged = []
+        self.limit = AdaptiveLimit('test', 100, maximum=200, step=10,
+                                   target_latency=1.0, window=2,
+                                   clock=self.clock, log=self.logged.append)
+
+    def window(self, items=100, seconds=0.1, elapsed=1.0, **kwargs):
+        """Observes a window of two requests over elapsed seconds."""
+        self.clock.now += elapsed
+        for _ in range(2):
+            self.limit.observe(items, seconds, **kwargs)
+
+    def test_additive_increase(self):
+        """Test that saturated requests grow the limit up to maximum."""
+        for _ in range(5):
+            self.window()
+        self.assertEqual(150, self.limit.value)
+        self.assertEqual('test: 100 -> 110 (throughput 200/s, latency '
+                         '0.100s)', self.logged[0])
+        for _ in range(10):
+            self.window()
+        self.assertEqual(200, self.limit.value)
+
+    def test_hold_when_not_saturated(self):
+        """Test that the limit stays put when requests don't fill it."""
+        self.window(saturated=False)
+        self.assertEqual(100, self.limit.value)
+        self.assertEqual([], self.logged)
+
+    def test_multiplicative_decrease(self):
+        """Test that throttling and high latency halve the limit."""
+        self.window(throttled=True)
+        self.assertEqual(50, self.limit.value)
+        self.window(seconds=2.0)
+        self.assertEqual(25, self.limit.value)
+        self.assertIn('latency 2.000s over 1.000s', self.logged[-1])
+        self.limit.observe_error(TransportError(503, 'unavailable'))
+        self.limit.observe_error(TransportError(404, 'not found'))
+        self.assertEqual(12, self.limit.value)
+        self.assertIn('1 throttled and 1 failed', self.logged[-1])
+
+    def test_throughput_drop_undoes_increase(self):
+        """Test that an increase that lowers throughput is undone."""
+        self.window()
+        self.assertEqual(110, self.limit.value)
+        self.window(elapsed=2.0)
+        self.assertEqual(100, self.limit.value)
+        self.assertIn('throughput fell from 200/s to 100/s', self.logged[-1])
+
+
+class AdaptivePublisherTestCase(unittest.TestCase):
+    """A test case for the adaptive BatchPublisher."""
+
+    def test_throttling_shrinks_batches(self):
+        """Test that throttled publish requests shrink the limits."""
+        transport = ThrottledTransport()
+        publisher = BatchPublisher(transport, batch_size=8, workers=4,
+                                   adaptive=True)
+        publisher.batch_limit.log = publisher.concurrency.log = len
+        publisher.batch_limit.window = publisher.concurrency.window = 1
+        publisher.publish(TOPIC, [make_message('a')] * 8)
+        with self.assertRaises(TransportError):
+            publisher.flush()
+        publisher.close(flush=False)
+        self.assertEqual(4, publisher.stats()['batch_size'])
+        self.assertEqual(2, publisher.stats()['concurrency'])
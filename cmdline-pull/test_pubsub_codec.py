@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the payload codecs."""
+
+
+import unittest
+
+import pubsub_codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+TRAFFIC_LINE = ('2010-01-01 00:00:00,1108413,5,S,ML,.43,3,97.8,64.9,'
+                '0.0123,,-12,-0.5,007,1e3,-0,  ,caf\xc3\xa9,' + 'x' * 40 +
+                ',0.' + '1' * 40)
+
+CODEC = pubsub_codec.CODEC_ATTRIBUTE
+
+
+class CodecTestCase(unittest.TestCase):
+    """A test case for pubsub_codec."""
+
+    def test_row_round_trip(self):
+        """Test that the row format reproduces every kind of field."""
+        packed = pubsub_codec.pack_row(TRAFFIC_LINE)
+        self.assertEqual(TRAFFIC_LINE, pubsub_codec.unpack_row(packed))
+
+    def test_row_is_compact(self):
+        """Test that a numeric traffic reading shrinks."""
+        line = '2010-01-01 00:05:00,1108413,5,S,ML,3,97.8,64.9,411,0.0816'
+        self.assertLess(len(pubsub_codec.pack_row(line)), len(line) * 2 / 3)
+
+    def test_encode_message(self):
+        """Test that chained codecs are recorded and undone."""
+        attributes = {'timestamp': '1262304000000'}
+        data, encoded_attributes = pubsub_codec.encode_message(
+            TRAFFIC_LINE, attributes, 'row+zlib')
+        self.assertEqual('row+zlib',
+                         encoded_attributes[pubsub_codec.CODEC_ATTRIBUTE])
+        self.assertNotIn(pubsub_codec.CODEC_ATTRIBUTE, attributes)
+        self.assertEqual(TRAFFIC_LINE,
+                         pubsub_codec.decode(data, encoded_attributes))
+
+    def test_no_codec(self):
+        """Test that payloads without a codec pass through."""
+        self.assertEqual(('a', None), pubsub_codec.encode_message('a'))
+        self.assertEqual('a', pubsub_codec.decode('a', None))
+        self.assertEqual('a', pubsub_codec.decode('a', {'k': 'v'}))
+        # Another publisher's attribute of the same plain name.
+        self.assertEqual('a', pubsub_codec.decode('a', {'codec': 'zlib'}))
+
+    def test_errors(self):
+        """Test unknown codecs and malformed payloads."""
+        self.assertRaises(pubsub_codec.CodecError,
+                          pubsub_codec.encode, 'a', 'rot13')
+        self.assertRaises(pubsub_codec.CodecError,
+                          pubsub_codec.decode, 'a', {CODEC: 'zlib'})
+        self.assertRaises(pubsub_codec.CodecError, pubsub_codec.decode,
+                          '\x01\x4c', {CODEC: 'row'})
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_corrupt_zstd(self):
+        """Test that a corrupt zstd payload is a CodecError."""
+        data = pubsub_codec.encode('x' * 100, 'zstd')
+        for corrupt in ('garbage', data[:-3]):
+            self.assertRaises(pubsub_codec.CodecError, pubsub_codec.decode,
+                              corrupt, {CODEC: 'zstd'})
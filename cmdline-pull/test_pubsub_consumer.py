@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the keyed, ordered consumer."""
+
+
+import collections
+import random
+import threading
+import time
+import unittest
+
+import mock
+
+from pubsub_consumer import DeadLetterQueue
+from pubsub_consumer import DeadLetterTopic
+from pubsub_consumer import FailurePolicy
+from pubsub_consumer import handle_batch
+from pubsub_consumer import KeyedDispatcher
+from pubsub_consumer import make_key_func
+from pubsub_transport import InMemoryTransport
+from pubsub_transport import make_message
+
+
+TOPIC = 'projects/test/topics/topic'
+SUBSCRIPTION = 'projects/test/subscriptions/sub'
+DEAD_LETTER_TOPIC = 'projects/test/topics/dead'
+DEAD_LETTER_SUBSCRIPTION = 'projects/test/subscriptions/dead'
+
+
+class KeyedDispatcherTestCase(unittest.TestCase):
+    """A test case for KeyedDispatcher."""
+
+    def setUp(self):
+        self.transport = InMemoryTransport()
+        self.transport.create_topic(TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC)
+
+    def pull_all(self):
+        return self.transport.pull(SUBSCRIPTION, 1000,
+                                   return_immediately=True)
+
+    def test_key_funcs(self):
+        """Test the attribute and field keys."""
+        message = make_message('1,400001,101,N', {'station': 'a'})
+        self.assertEqual('a', make_key_func('attribute:station')(message))
+        self.assertEqual('400001', make_key_func('field:1')(message))
+        self.assertIsNone(make_key_func('field:9')(message))
+        for spec in ('station', 'attribute:', 'field:x'):
+            self.assertRaises(ValueError, make_key_func, spec)
+
+    def test_order_per_key(self):
+        """Test that each key is handled in order, and everything acked."""
+        messages = [make_message('{},{}'.format(i, i % 7))
+                    for i in range(300)]
+        self.transport.publish(TOPIC, messages)
+        handled = collections.defaultdict(list)
+        lock = threading.Lock()
+
+        def handle(message):
+            time.sleep(random.random() / 1000)
+            seq, key = message.data.split(',')
+            with lock:
+                handled[key].append(int(seq))
+
+        dispatcher = KeyedDispatcher(self.transport, SUBSCRIPTION, handle,
+                                     make_key_func('field:1'), lanes=4,
+                                     max_lane_depth=5, ack_batch_size=8)
+        dispatcher.dispatch(self.pull_all())
+        dispatcher.close()
+        self.assertEqual(7, len(handled))
+        for key, seqs in handled.items():
+            self.assertEqual(range(int(key), 300, 7), seqs)
+        self.assertEqual([0] * 4, dispatcher.depths())
+        self.assertEqual([], self.pull_all())
+
+    def test_failed_message_is_not_acked(self):
+        """Test that a message whose handler raises is redelivered."""
+        self.transport.publish(TOPIC, [make_message('ok'),
+                                       make_message('bad')])
+
+        def handle(message):
+            if message.data == 'bad':
+                raise ValueError(message.data)
+
+        dispatcher = KeyedDispatcher(self.transport, SUBSCRIPTION, handle,
+                                     make_key_func('attribute:none'))
+        with mock.patch('sys.stdout'):
+            dispatcher.dispatch(self.pull_all())
+            dispatcher.close()
+        self.assertEqual(1, sum(dispatcher.failed))
+        outstanding = self.transport.subscriptions[SUBSCRIPTION].outstanding
+        self.assertEqual(['bad'], [message.data for _, message, _
+                                   in outstanding.values()])
+
+    def test_unicode_key(self):
+        """Test that non-ASCII keys, as parsed from JSON, are hashed."""
+        self.transport.publish(TOPIC, [make_message('a', {'k': u'caf\xe9'}),
+                                       make_message('b', {'k': u'caf\xe9'})])
+        handled = []
+        dispatcher = KeyedDispatcher(self.transport, SUBSCRIPTION,
+                                     lambda message: handled.append(
+                                         message.data),
+                                     make_key_func('attribute:k'))
+        self.assertEqual(
+            dispatcher.lane(make_message('', {'k': u'caf\xe9'})),
+            dispatcher.lane(make_message('', {'k': 'caf\xc3\xa9'})))
+        dispatcher.dispatch(self.pull_all())
+        dispatcher.close()
+        self.assertEqual(['a', 'b'], handled)
+
+    def test_order_after_failure(self):
+        """Test that a key waits for its failed message to succeed."""
+        self.transport.publish(TOPIC, [make_message(str(i), {'k': 'a'})
+                                       for i in range(3)])
+        attempts = collections.Counter()
+        handled = []
+
+        def handle(message):
+            attempts[message.data] += 1
+            if message.data == '0' and attempts['0'] == 1:
+                raise ValueError(message.data)
+            handled.append(message.data)
+
+        dispatcher = KeyedDispatcher(self.transport, SUBSCRIPTION, handle,
+                                     make_key_func('attribute:k'),
+                                     policy=FailurePolicy())
+        with mock.patch('sys.stdout'), \
+                mock.patch('pubsub_consumer.HOLD_SECONDS', 0):
+            for _ in range(5):
+                dispatcher.dispatch(self.pull_all())
+                dispatcher.join()
+            dispatcher.close()
+        self.assertEqual(['0', '1', '2'], handled)
+        self.assertEqual(2, attempts['0'])
+        self.assertEqual(2, sum(dispatcher.returned))
+        self.assertEqual([], self.pull_all())
+
+    def test_hold_backs_off(self):
+        """Test that held messages come back later the longer their key
+        waits, and that the key is released after MAX_HOLD_SECONDS."""
+        self.transport.publish(TOPIC, [make_message(str(i), {'k': 'a'})
+                                       for i in range(3)])
+        received = self.pull_all()
+        dispatcher = KeyedDispatcher(self.transport, SUBSCRIPTION,
+                                     lambda message: None,
+                                     make_key_func('attribute:k'), lanes=1)
+        now = time.time()
+        for waited, seconds in ((0, 1), (30, 30), (500, 60)):
+            failed_keys = {'a': (received[0].message.message_id,
+                                 now - waited)}
+            self.assertEqual(seconds, dispatcher._handle(0, received[1],
+                                                         failed_keys))
+        failed_keys = {'a': (received[0].message.message_id, now - 601)}
+        self.assertEqual('ack', dispatcher._handle(0, received[2],
+                                                   failed_keys))
+        self.assertEqual({}, failed_keys)
+        dispatcher.close()
+
+    def test_close_without_drain(self):
+        """Test that the messages left on the lanes are nacked."""
+        self.transport.publish(TOPIC, [make_message(str(i))
+                                       for i in range(10)])
+        started = threading.Event()
+        release = threading.Event()
+
+        def handle(message):
+            started.set()
+            release.wait(5)
+
+        dispatcher = KeyedDispatcher(self.transport, SUBSCRIPTION, handle,
+                                     make_key_func('attribute:none'),
+                                     lanes=1)
+        dispatcher.dispatch(self.pull_all())
+        started.wait(5)
+        self.assertFalse(dispatcher.close(drain=False, timeout=0.05))
+        release.set()
+        self.assertTrue(dispatcher.close(timeout=5))
+        self.assertEqual([1], dispatcher.handled)
+        self.assertEqual([9], dispatcher.returned)
+        # Nacked messages are redelivered right away.
+        self.assertEqual([str(i) for i in range(1, 10)],
+                         [r.message.data for r in self.pull_all()])
+
+    def test_handle_batch_stopping(self):
+        """Test that handle_batch nacks what is left once stopping."""
+        self.transport.publish(TOPIC, [make_message(str(i))
+                                       for i in range(3)])
+        received_messages = self.pull_all()
+        handled = []
+        ack_ids, nack_ids = handle_batch(
+            received_messages, lambda message: handled.append(message.data),
+            stopping=lambda: len(handled) >= 2)
+        self.assertEqual(['0', '1'], handled)
+        self.assertEqual([r.ack_id for r in received_messages[:2]], ack_ids)
+        self.assertEqual([received_messages[2].ack_id], nack_ids)
+
+
+class DeadLetterTestCase(unittest.TestCase):
+    """A test case for FailurePolicy and DeadLetterQueue."""
+
+    def setUp(self):
+        self.transport = InMemoryTransport()
+        self.transport.create_topic(TOPIC)
+        self.transport.create_topic(DEAD_LETTER_TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC)
+        self.transport.create_subscription(DEAD_LETTER_SUBSCRIPTION,
+                                           DEAD_LETTER_TOPIC)
+
+    def pull_all(self, subscription=SUBSCRIPTION):
+        return self.transport.pull(subscription, 1000,
+                                   return_immediately=True)
+
+    def test_poison_message_is_dead_lettered(self):
+        """Test that a message that keeps failing is set aside."""
+        self.transport.publish(TOPIC, [make_message('ok'),
+                                       make_message('bad', {'k': 'v'}),
+                                       make_message('ok')])
+
+        def handle(message):
+            if message.data == 'bad':
+                raise ValueError('cannot handle ' + message.data)
+
+        dead_letters = DeadLetterQueue(
+            self.transport, SUBSCRIPTION,
+            DeadLetterTopic(self.transport, DEAD_LETTER_TOPIC),
+            max_latency=0)
+        policy = FailurePolicy(2, dead_letters)
+        handled = 0
+        with mock.patch('sys.stdout'):
+            for attempt in range(2):
+                received_messages = self.pull_all()
+                ack_ids, nack_ids = handle_batch(received_messages, handle,
+                                                 policy)
+                handled += len(ack_ids)
+                self.transport.acknowledge(SUBSCRIPTION, ack_ids)
+                self.transport.modify_ack_deadline(SUBSCRIPTION, nack_ids, 0)
+                # The nacked message comes back right away, the first time.
+                self.assertEqual(1 - attempt, len(nack_ids))
+            dead_letters.close()
+        self.assertEqual(2, handled)
+        self.assertEqual(1, dead_letters.stored)
+        self.assertEqual([], self.pull_all())
+        dead = self.pull_all(DEAD_LETTER_SUBSCRIPTION)
+        self.assertEqual(['bad'], [d.message.data for d in dead])
+        attributes = dead[0].message.attributes
+        self.assertEqual('v', attributes['k'])
+        self.assertEqual('2', attributes['dead_letter_attempts'])
+        self.assertEqual(SUBSCRIPTION,
+                         attributes['dead_letter_subscription'])
+        self.assertEqual('cannot handle bad',
+                         attributes['dead_letter_error'])
+        self.assertEqual({}, dict(policy.attempts))
+
+    def test_retries_back_off_without_dead_letters(self):
+        """Test that a message that keeps failing stops being nacked."""
+        self.transport.publish(TOPIC, [make_message('bad')])
+        policy = FailurePolicy(2)
+
+        def handle(message):
+            raise ValueError(message.data)
+
+        nacked = []
+        with mock.patch('sys.stdout'):
+            for _ in range(2):
+                ack_ids, nack_ids = handle_batch(self.pull_all(), handle,
+                                                 policy)
+                self.assertEqual([], ack_ids)
+                nacked.append(len(nack_ids))
+                self.transport.modify_ack_deadline(SUBSCRIPTION, nack_ids, 0)
+        # The second time, it is left to its ack deadline.
+        self.assertEqual([1, 0], nacked)
+        self.assertEqual([], self.pull_all())
+        self.assertEqual(2, policy.failures)
+
+    def test_failed_store_nacks(self):
+        """Test that dead letters which can't be stored come back."""
+        self.transport.publish(TOPIC, [make_message('bad')])
+        sink = mock.Mock()
+        sink.write.side_effect = IOError('disk full')
+        dead_letters = DeadLetterQueue(self.transport, SUBSCRIPTION, sink,
+                                       max_latency=0)
+        with mock.patch('sys.stdout'):
+            dead_letters.put(self.pull_all()[0], ValueError('bad'), 5)
+            dead_letters.close()
+        self.assertEqual(0, dead_letters.stored)
+        self.assertEqual(['bad'], [r.message.data for r in self.pull_all()])
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the publishing daemon."""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pubsub_daemon import DaemonClient
+from pubsub_daemon import DaemonError
+from pubsub_daemon import PublishDaemon
+from pubsub_transport import InMemoryTransport
+from pubsub_transport import make_message
+
+
+TOPIC = 'projects/test/topics/topic'
+SUBSCRIPTION = 'projects/test/subscriptions/sub'
+
+
+class PublishDaemonTestCase(unittest.TestCase):
+    """A test case for PublishDaemon and DaemonClient."""
+
+    def setUp(self):
+        self.transport = InMemoryTransport()
+        self.transport.create_topic(TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC)
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'daemon.sock')
+        self.daemon = PublishDaemon(self.transport, self.path,
+                                    batch_size=10, max_latency=0.01)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.close()
+        shutil.rmtree(self.tmp)
+
+    def test_publish(self):
+        """Test that messages from several clients are published."""
+        for client_id in range(3):
+            with DaemonClient(self.path) as client:
+                for i in range(5):
+                    self.assertEqual(1, client.publish(TOPIC, [make_message(
+                        '{}-{}'.format(client_id, i), {'client': 'x'})]))
+        self.daemon.shutdown()
+        self.daemon.close()
+        self.assertFalse(os.path.exists(self.path))
+        received = self.transport.pull(SUBSCRIPTION, 100,
+                                       return_immediately=True)
+        self.assertEqual(15, len(received))
+        self.assertEqual({'client': 'x'}, received[0].message.attributes)
+        self.assertEqual(15, self.daemon.received)
+
+    def test_publish_failure(self):
+        """Test that a failed publish is reported to its client only."""
+        with DaemonClient(self.path) as client:
+            with self.assertRaises(DaemonError):
+                client.publish(TOPIC + 'x', [make_message('a')])
+            self.assertEqual(1, client.publish(TOPIC, [make_message('b')]))
+        self.assertEqual(1, self.daemon.failed)
+
+    def test_reply_timeout(self):
+        """Test that a publish that hangs is reported as an error."""
+        release = threading.Event()
+        self.transport.publish = lambda topic, messages: release.wait(5)
+        self.daemon.reply_timeout = 0.05
+        try:
+            with DaemonClient(self.path) as client:
+                with self.assertRaises(DaemonError):
+                    client.publish(TOPIC, [make_message('a')])
+        finally:
+            release.set()
+
+    def test_errors(self):
+        """Test that errors are reported to the client."""
+        with DaemonClient(self.path) as client:
+            client.sock.sendall('{"topic": "t"}\n')
+            self.assertIn('error', client.replies.readline())
+            self.assertEqual(1, client.publish(TOPIC, [make_message('a')]))
+        self.assertRaises(DaemonError, PublishDaemon, self.transport,
+                          self.path)
+        self.assertRaises(DaemonError, DaemonClient,
+                          os.path.join(self.tmp, 'none.sock'))
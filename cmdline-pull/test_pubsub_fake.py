@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the rest transport, against a local fake server."""
+
+
+import os
+import unittest
+
+from pubsub_fake import FakeClock
+from pubsub_fake import FakePubsubServer
+from pubsub_transport import create_transport
+from pubsub_transport import EMULATOR_HOST_ENV
+from pubsub_transport import InMemoryTransport
+from pubsub_transport import make_message
+from pubsub_transport import TransportError
+
+
+TOPIC = 'projects/test/topics/topic'
+SUBSCRIPTION = 'projects/test/subscriptions/sub'
+
+
+class RestTransportTestCase(unittest.TestCase):
+    """A test case for the publish, pull, ack and deadline semantics seen
+    through the rest transport, i.e. over HTTP and the discovery client.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.clock = FakeClock()
+        cls.server = FakePubsubServer(
+            InMemoryTransport(clock=cls.clock, max_wait=0.05)).start()
+        os.environ[EMULATOR_HOST_ENV] = cls.server.host
+        try:
+            cls.transport = create_transport('rest')
+        finally:
+            del os.environ[EMULATOR_HOST_ENV]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.server.transport.reset()
+        self.transport.create_topic(TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC,
+                                           ack_deadline_seconds=10)
+
+    def publish(self, *payloads):
+        return self.transport.publish(
+            TOPIC, [make_message(payload) for payload in payloads])
+
+    def pull(self, max_messages=10):
+        return self.transport.pull(SUBSCRIPTION, max_messages,
+                                   return_immediately=True)
+
+    def test_publish_and_pull(self):
+        payloads = ['plain', '=@~', '\x00\xff binary']
+        message_ids = self.transport.publish(
+            TOPIC, [make_message(payload, {'key': 'value'})
+                    for payload in payloads])
+        received = self.pull()
+        self.assertEqual([r.message.data for r in received], payloads)
+        self.assertEqual([r.message.message_id for r in received],
+                         message_ids)
+        self.assertEqual(received[0].message.attributes, {'key': 'value'})
+        self.assertTrue(received[0].message.publish_time.endswith('Z'))
+
+    def test_acknowledged_messages_are_not_redelivered(self):
+        self.publish('a', 'b')
+        self.transport.acknowledge(SUBSCRIPTION,
+                                   [r.ack_id for r in self.pull()])
+        self.clock.now += 60
+        self.assertEqual(self.pull(), [])
+
+    def test_redelivery_after_ack_deadline(self):
+        self.publish('a', 'b')
+        first = self.pull(1)
+        self.clock.now += 11
+        received = self.pull()
+        self.assertEqual([r.message.data for r in received], ['a', 'b'])
+        self.assertNotEqual(received[0].ack_id, first[0].ack_id)
+        self.assertEqual(received[0].message.message_id,
+                         first[0].message.message_id)
+
+    def test_modify_ack_deadline(self):
+        self.publish('a', 'b')
+        extended, nacked = self.pull()
+        self.transport.modify_ack_deadline(SUBSCRIPTION, [extended.ack_id],
+                                           60)
+        self.transport.modify_ack_deadline(SUBSCRIPTION, [nacked.ack_id], 0)
+        redelivered = self.pull()
+        self.assertEqual([r.message.data for r in redelivered], ['b'])
+        self.transport.acknowledge(SUBSCRIPTION, [redelivered[0].ack_id])
+        self.clock.now += 30
+        self.assertEqual(self.pull(), [])
+
+    def test_long_poll_returns_empty(self):
+        self.assertEqual(self.transport.pull(SUBSCRIPTION, 10), [])
+
+    def test_errors(self):
+        with self.assertRaises(TransportError) as raised:
+            self.transport.create_topic(TOPIC)
+        self.assertEqual(raised.exception.status, 409)
+        with self.assertRaises(TransportError) as raised:
+            self.transport.pull('projects/test/subscriptions/missing', 1)
+        self.assertEqual(raised.exception.status, 404)
+
+    def test_list_pages(self):
+        self.transport.create_topic(TOPIC + '2')
+        topics, token = self.transport.list_topics('projects/test', 1)
+        self.assertEqual(topics, [{'name': TOPIC}])
+        topics, token = self.transport.list_topics('projects/test', 1, token)
+        self.assertEqual(topics, [{'name': TOPIC + '2'}])
+        self.assertIsNone(token)
+        self.assertEqual(
+            self.transport.list_topic_subscriptions(TOPIC),
+            ([SUBSCRIPTION], None))
+
+    def test_push_config(self):
+        self.transport.modify_push_config(SUBSCRIPTION, 'https://example.com')
+        self.assertEqual(
+            self.transport.get_subscription(SUBSCRIPTION)['pushConfig'],
+            {'pushEndpoint': 'https://example.com'})
+        self.transport.modify_push_config(SUBSCRIPTION)
+        self.assertNotIn('pushConfig',
+                         self.transport.get_subscription(SUBSCRIPTION))
+
+
+if __name__ == '__main__':
+    unittest.main()
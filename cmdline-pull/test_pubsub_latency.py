@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the delivery latency probes."""
+
+
+import unittest
+
+import pubsub_latency
+from pubsub_latency import Histogram
+from pubsub_latency import LatencyProbe
+from pubsub_latency import parse_timestamp
+from pubsub_latency import Prober
+from pubsub_latency import SENT_ATTRIBUTE
+from pubsub_transport import make_message
+
+
+class LatencyTestCase(unittest.TestCase):
+    """A test case for Prober, Histogram and LatencyProbe."""
+
+    def test_parse_timestamp(self):
+        """Test publish times with and without fractions of a second."""
+        self.assertEqual(1451703845, parse_timestamp('2016-01-02T03:04:05Z'))
+        self.assertAlmostEqual(
+            1451703845.123457,
+            parse_timestamp('2016-01-02T03:04:05.123456789Z'), places=6)
+        self.assertIsNone(parse_timestamp(None))
+        self.assertIsNone(parse_timestamp('yesterday'))
+
+    def test_histogram(self):
+        """Test that percentiles are within a bucket of the real ones."""
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+        self.assertEqual(1000, histogram.count)
+        for percent in (50, 90, 99):
+            self.assertLessEqual(percent / 100.0,
+                                 histogram.percentile(percent))
+            self.assertGreater(percent / 100.0 * 1.1,
+                               histogram.percentile(percent))
+        self.assertEqual(1.0, histogram.percentile(100))
+
+    def test_sequences(self):
+        """Test that gaps, late arrivals and duplicates are counted."""
+        prober = Prober('a')
+        messages = [make_message('x', prober.stamp('topic'))
+                    for _ in range(10)]
+        probe = LatencyProbe()
+        for i in (2, 3, 5, 4, 5, 1, 9):
+            probe.record(messages[i])
+        # 0 was never seen, so it isn't a gap; 6 to 8 are.
+        self.assertEqual(3, probe.gaps())
+        self.assertEqual(1, probe.duplicates)
+        self.assertEqual(2, probe.late)
+        self.assertIn('sequence: 7 messages in 1 sequences, 3 gaps',
+                      probe.report())
+
+    def test_sequences_per_topic(self):
+        """Test that the sequences of one source on two topics are apart."""
+        prober = Prober('a')
+        probe = LatencyProbe()
+        for topic in ('topic1', 'topic2', 'topic1', 'topic2'):
+            probe.record(make_message('x', prober.stamp(topic)))
+        self.assertEqual(0, probe.gaps())
+        self.assertEqual(0, probe.duplicates)
+        self.assertIn('sequence: 4 messages in 2 sequences, 0 gaps',
+                      probe.report())
+
+    def test_latency_only(self):
+        """Test that sequences are left alone without track_sequences."""
+        prober = Prober('a')
+        probe = LatencyProbe(track_sequences=False)
+        for _ in range(2):
+            probe.record(make_message('x', prober.stamp('topic')))
+        self.assertEqual({}, probe.sequences)
+        report = probe.report()
+        self.assertIn('end-to-end latency: n=2', report)
+        self.assertNotIn('sequence', report)
+
+    def test_gap_ranges(self):
+        """Test that gaps are kept as ranges, and the oldest given up."""
+        sequence = pubsub_latency._Sequence(0)
+        self.assertEqual('new', sequence.add(10 ** 9))
+        self.assertEqual([(1, 10 ** 9)], sequence.missing)
+        self.assertEqual('late', sequence.add(5))
+        self.assertEqual([(1, 5), (6, 10 ** 9)], sequence.missing)
+        self.assertEqual('late', sequence.add(1))
+        self.assertEqual('duplicate', sequence.add(5))
+        self.assertEqual(10 ** 9 - 3, sequence.gaps())
+
+        sequence = pubsub_latency._Sequence(0)
+        limit = pubsub_latency.MAX_GAP_RANGES
+        for i in range(1, limit + 2):
+            sequence.add(2 * i)
+        self.assertEqual(limit, len(sequence.missing))
+        self.assertEqual(1, sequence.lost)
+        self.assertEqual(limit + 1, sequence.gaps())
+        self.assertEqual('duplicate', sequence.add(1))
+        self.assertEqual('late', sequence.add(3))
+
+    def test_latency(self):
+        """Test the end-to-end and publish to receive latencies."""
+        attributes = Prober('a').stamp('topic')
+        sent = int(attributes[SENT_ATTRIBUTE]) / 1e6
+        message = make_message('x', attributes)._replace(
+            publish_time='2016-01-02T03:04:05Z')
+        probe = LatencyProbe()
+        probe.record(message, received=sent + 0.25)
+        self.assertEqual(1, probe.end_to_end.count)
+        self.assertAlmostEqual(0.25, probe.end_to_end.max, places=5)
+        self.assertAlmostEqual(sent + 0.25 - 1451703845, probe.delivery.max)
+        probe.report()
+        self.assertEqual(0, probe.end_to_end.count)
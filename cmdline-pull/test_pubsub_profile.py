@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the profiling and tracing helpers."""
+
+
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+import pubsub_profile
+
+
+def busy(seconds):
+    """Keeps the CPU busy, so that a sampling profiler sees it."""
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class ProfileTestCase(unittest.TestCase):
+    """A test case for pubsub_profile."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_trace(self):
+        """Test that spans are only recorded while tracing."""
+        path = os.path.join(self.tmp, 'trace.json')
+        with pubsub_profile.span('untraced'):
+            pass
+        with pubsub_profile.tracing(path):
+            with pubsub_profile.span('publish', messages=3):
+                time.sleep(0.01)
+        with open(path) as trace:
+            events = json.load(trace)['traceEvents']
+        self.assertEqual(['publish'], [event['name'] for event in events])
+        self.assertEqual({'messages': 3}, events[0]['args'])
+        self.assertGreaterEqual(events[0]['dur'], 10000)
+
+    def test_trace_limit(self):
+        """Test that spans past the limit are counted, not kept."""
+        tracer = pubsub_profile.Tracer(max_events=2)
+        for i in range(5):
+            tracer.add(str(i), 0, 1, {})
+        trace = json.loads(tracer.to_json())
+        self.assertEqual(['0', '1'], [event['name']
+                                      for event in trace['traceEvents']])
+        self.assertEqual({'dropped_events': 3}, trace['otherData'])
+
+    def test_cprofile(self):
+        """Test that cProfile results are written as pstats data."""
+        path = os.path.join(self.tmp, 'run.prof')
+        with mock.patch('sys.stderr'):
+            with pubsub_profile.profiled(path, 'cprofile'):
+                busy(0.01)
+        functions = [name for _, _, name in pstats.Stats(path).stats]
+        self.assertIn('busy', functions)
+
+    def test_sampling_profiler(self):
+        """Test that samples are written as collapsed stacks."""
+        path = os.path.join(self.tmp, 'run.folded')
+        with pubsub_profile.profiled(path, 'sample'):
+            busy(0.1)
+        with open(path) as folded:
+            lines = folded.read().splitlines()
+        self.assertTrue(any('busy (test_pubsub_profile.py' in line
+                            for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit()
+                            for line in lines))
+
+    def test_middleware(self):
+        """Test that requests asking for it are profiled and traced."""
+        def app(environ, start_response):
+            with pubsub_profile.span('handler'):
+                start_response('200 OK', [])
+                return ['ok']
+
+        middleware = pubsub_profile.ProfileMiddleware(
+            app, may_profile=lambda environ: 'ADMIN' in environ)
+        start_response = mock.Mock()
+        with mock.patch('logging.info') as info:
+            self.assertEqual(['ok'], middleware(
+                {'PATH_INFO': '/a', 'QUERY_STRING': ''}, start_response))
+            self.assertEqual(['ok'], middleware(
+                {'PATH_INFO': '/a', 'QUERY_STRING': 'profile'},
+                start_response))
+            self.assertFalse(info.called)
+            self.assertEqual(['ok'], middleware(
+                {'PATH_INFO': '/a', 'QUERY_STRING': 'profile',
+                 'ADMIN': True}, start_response))
+        logged = '\n'.join(str(call) for call in info.call_args_list)
+        self.assertIn('Profile of', logged)
+        self.assertIn('"handler"', logged)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the batching and rate limited publishers."""
+
+
+import threading
+import unittest
+
+import mock
+
+from pubsub_fake import FakeClock
+from pubsub_publisher import BatchPublisher
+from pubsub_publisher import FlushTimeout
+from pubsub_publisher import MultiTopicPublisher
+from pubsub_publisher import parse_profile
+from pubsub_publisher import TokenBucket
+from pubsub_transport import InMemoryTransport
+from pubsub_transport import make_message
+from pubsub_transport import TransportError
+
+
+TOPIC = 'projects/test/topics/topic'
+SUBSCRIPTION = 'projects/test/subscriptions/sub'
+
+
+class RateTestCase(unittest.TestCase):
+    """A test case for parse_profile and TokenBucket."""
+
+    def test_profiles(self):
+        """Test the rate of each profile over time."""
+        self.assertEqual(100, parse_profile('constant', 100)(50))
+        step = parse_profile('step:10:4', 100)
+        self.assertEqual([25, 25, 50, 100],
+                         [step(t) for t in (0, 9.9, 10, 100)])
+        ramp = parse_profile('ramp:10', 100)
+        self.assertEqual([0, 50, 100], [ramp(t) for t in (0, 5, 20)])
+        sine = parse_profile('sine:4:0.2', 100)
+        self.assertAlmostEqual(120, sine(1))
+        self.assertAlmostEqual(80, sine(3))
+        for spec in ('ramp', 'ramp:0', 'step:10', 'sine:x', 'square:1'):
+            self.assertRaises(ValueError, parse_profile, spec, 100)
+
+    def test_token_bucket(self):
+        """Test that acquire() waits for the tokens it takes."""
+        clock = FakeClock()
+        bucket = TokenBucket(100, clock=clock, sleep=clock.sleep)
+        for _ in range(50):
+            bucket.acquire()
+        bucket.acquire(150)
+        self.assertAlmostEqual(2.0, clock.slept)
+
+    def test_token_bucket_ramp(self):
+        """Test that a ramp from zero starts slowly and speeds up."""
+        clock = FakeClock()
+        bucket = TokenBucket(parse_profile('ramp:10', 100),
+                             clock=clock, sleep=clock.sleep)
+        bucket.acquire(25)
+        # The rate is 10 * t, so 25 tokens come in after sqrt(5) seconds.
+        self.assertAlmostEqual(5 ** .5, clock.now - 1000, places=2)
+
+
+class BatchPublisherTestCase(unittest.TestCase):
+    """A test case for BatchPublisher."""
+
+    def setUp(self):
+        self.transport = InMemoryTransport()
+        self.transport.create_topic(TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC)
+
+    def test_batches(self):
+        """Test that every message is published once, in full batches."""
+        with BatchPublisher(self.transport, batch_size=10, workers=3,
+                            max_latency=60) as publisher:
+            for i in range(95):
+                publisher.publish(TOPIC, [make_message(str(i))])
+        self.assertEqual(95, publisher.published)
+        self.assertEqual(10, publisher.batches_published)
+        received = self.transport.pull(SUBSCRIPTION, 1000,
+                                       return_immediately=True)
+        self.assertEqual(set(str(i) for i in range(95)),
+                         set(r.message.data for r in received))
+
+    def test_error(self):
+        """Test that a failed batch is reported by flush()."""
+        publisher = BatchPublisher(self.transport, batch_size=10)
+        publisher.publish(TOPIC + 'x', [make_message('a')])
+        with self.assertRaises(TransportError):
+            publisher.flush()
+        publisher.close(flush=False)
+
+    def test_error_is_reported_once(self):
+        """Test that a failed batch doesn't fail the batches after it."""
+        publisher = BatchPublisher(self.transport, batch_size=1)
+        publisher.publish(TOPIC + 'x', [make_message('a')])
+        with self.assertRaises(TransportError):
+            publisher.flush()
+        publisher.publish(TOPIC, [make_message('b')])
+        publisher.close()
+        self.assertEqual(1, publisher.published)
+        self.assertEqual(1, publisher.stats()['failed'])
+
+    def test_flush_timeout(self):
+        """Test that flush() gives up, and close() drops what is left."""
+        release = threading.Event()
+        transport = mock.Mock()
+        transport.publish.side_effect = (
+            lambda topic, messages: release.wait(5))
+        publisher = BatchPublisher(transport, batch_size=2, workers=1,
+                                   max_latency=60)
+        for i in range(5):
+            publisher.publish(TOPIC, [make_message(str(i))])
+        with self.assertRaises(FlushTimeout):
+            publisher.flush(timeout=0.05)
+        self.assertEqual(5, publisher.pending())
+        with self.assertRaises(FlushTimeout):
+            publisher.close(timeout=0.05)
+        release.set()
+        for thread in publisher.threads:
+            thread.join(5)
+        # The first batch was being published; the others were dropped.
+        self.assertEqual(2, publisher.published)
+        self.assertEqual(3, publisher.stats()['dropped'])
+        self.assertEqual(0, publisher.pending())
+
+    def test_topics_are_independent(self):
+        """Test that a failing topic doesn't stop the others."""
+        other = 'projects/test/topics/other'
+        self.transport.create_topic(other)
+        publisher = MultiTopicPublisher(self.transport, batch_size=2)
+        for topic in (TOPIC, other, TOPIC + 'x'):
+            publisher.publish(topic, [make_message('a'), make_message('b')])
+        with self.assertRaises(TransportError):
+            publisher.close()
+        stats = publisher.stats()
+        self.assertEqual(2, stats[TOPIC]['messages'])
+        self.assertEqual(2, stats[other]['messages'])
+        self.assertEqual(2, stats[TOPIC + 'x']['failed'])
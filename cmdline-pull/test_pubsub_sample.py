@@ -18,14 +18,21 @@
 
 
 import contextlib
+import json
 import os
 import StringIO
 import sys
+import tempfile
 import unittest
 import uuid
 
 
+import pubsub_fake
 from pubsub_sample import main
+from pubsub_sample import relay_batch
+from pubsub_sample import RelayStats
+import pubsub_transport
+from startup_benchmark import imported_lazy_modules
 
 
 TEST_PROJECT_ID_ENV = 'TEST_PROJECT_ID'
@@ -49,23 +56,67 @@ def get_project_id():
     return os.getenv(TEST_PROJECT_ID_ENV, DEFAULT_TEST_PROJECT_ID)
 
 
+class EmulatedPubsub(object):
+    """Points the rest and grpc transports at a local emulator, from
+    start() until stop().
+
+    An emulator already named by PUBSUB_EMULATOR_HOST is used as is;
+    otherwise a pubsub_fake server is started for the duration.
+    """
+
+    def __init__(self):
+        self.server = None
+
+    def start(self):
+        if not os.getenv(pubsub_transport.EMULATOR_HOST_ENV):
+            self.server = pubsub_fake.FakePubsubServer().start()
+            os.environ[pubsub_transport.EMULATOR_HOST_ENV] = self.server.host
+        return self
+
+    def stop(self):
+        if self.server:
+            del os.environ[pubsub_transport.EMULATOR_HOST_ENV]
+            self.server.stop()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
 class PubsubSampleTestCase(unittest.TestCase):
     """A test case for the Pubsub sample.
 
     Define a test case that creates and lists topics and subscriptions.
-    Also tests publishing and pulling messages
+    Also tests publishing and pulling messages. It runs the sample over
+    the rest transport, against a local emulator.
     """
 
     @classmethod
     def setUpClass(cls):
         """Create a new topic and subscription with a random name."""
+        cls.emulator = EmulatedPubsub().start()
+        try:
+            cls.create_resources()
+        except Exception:
+            cls.emulator.stop()
+            raise
+
+    @classmethod
+    def create_resources(cls):
         random_id = uuid.uuid4()
         cls.topic = 'topic-%s' % random_id
         cls.sub = 'sub-%s' % random_id
-        main(['pubsub_sample.py', get_project_id(), 'create_topic',
-              cls.topic])
-        main(['pubsub_sample.py', get_project_id(), 'create_subscription',
-              cls.sub, cls.topic])
+        # Provision both resources with one client via a manifest.
+        manifest = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        with manifest:
+            json.dump({'topics': [cls.topic],
+                       'subscriptions': [{'name': cls.sub,
+                                          'topic': cls.topic}]}, manifest)
+        cls.manifest = manifest.name
+        main(['pubsub_sample.py', get_project_id(), 'apply', cls.manifest])
         # The third message is to check the consistency between base64
         # variants used on the server side and the client side.
         cls.messages = ['message-1-%s' % uuid.uuid4(),
@@ -75,9 +126,12 @@ class PubsubSampleTestCase(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         """Delete resources used in the tests."""
-        main(['pubsub_sample.py', get_project_id(), 'delete_topic', cls.topic])
-        main(['pubsub_sample.py', get_project_id(), 'delete_subscription',
-              cls.sub])
+        try:
+            main(['pubsub_sample.py', get_project_id(), 'destroy',
+                  cls.manifest])
+            os.remove(cls.manifest)
+        finally:
+            cls.emulator.stop()
 
     def test_list_topics(self):
         """Test the list_topics action."""
@@ -114,3 +168,90 @@ class PubsubSampleTestCase(unittest.TestCase):
             output = out.getvalue().strip()
         for message in self.messages:
             self.assertTrue(message in output)
+
+
+def drop_odd(message):
+    """A relay transform that drops odd numbers and tags the others."""
+    if int(message.data) % 2:
+        return None
+    return message._replace(attributes=dict(message.attributes, relayed='1'))
+
+
+class RelayTestCase(unittest.TestCase):
+    """A test case for the relay command, on the in-memory transport."""
+
+    def setUp(self):
+        self.transport = pubsub_transport.SHARED_IN_MEMORY_TRANSPORT
+        self.transport.reset()
+        self.transport.create_topic('projects/test/topics/source')
+        self.transport.create_subscription(
+            'projects/test/subscriptions/source',
+            'projects/test/topics/source')
+        self.transport.create_topic('projects/other/topics/destination')
+        self.transport.create_subscription(
+            'projects/other/subscriptions/destination',
+            'projects/other/topics/destination')
+
+    def tearDown(self):
+        self.transport.reset()
+
+    def relay(self, *args):
+        with captured_output() as (out, _):
+            main(['pubsub_sample.py', '--transport', 'memory', 'test',
+                  'relay', 'source', 'projects/other/topics/destination',
+                  '-n', '-b', '7'] + list(args))
+        return out.getvalue()
+
+    def pull_destination(self):
+        return self.transport.pull('projects/other/subscriptions/destination',
+                                   1000, return_immediately=True)
+
+    def test_relay(self):
+        """Test that every message is copied once, with its attributes."""
+        self.transport.publish('projects/test/topics/source', [
+            pubsub_transport.make_message(str(i), {'i': str(i)})
+            for i in range(50)])
+        output = self.relay()
+        self.assertIn('relayed 50 messages', output)
+        received = self.pull_destination()
+        self.assertEqual(
+            dict((str(i), {'i': str(i)}) for i in range(50)),
+            dict((r.message.data, r.message.attributes) for r in received))
+        self.assertEqual([], self.transport.pull(
+            'projects/test/subscriptions/source', 10,
+            return_immediately=True))
+
+    def test_transform(self):
+        """Test the transform hook."""
+        self.transport.publish('projects/test/topics/source', [
+            pubsub_transport.make_message(str(i)) for i in range(10)])
+        self.relay('-t', 'test_pubsub_sample.drop_odd')
+        received = self.pull_destination()
+        self.assertEqual(['0', '2', '4', '6', '8'],
+                         sorted(r.message.data for r in received))
+        self.assertEqual(['1'] * 5,
+                         [r.message.attributes['relayed'] for r in received])
+
+    def test_not_acked_on_failure(self):
+        """Test that messages go back to the source if the publish fails."""
+        self.transport.publish('projects/test/topics/source',
+                               [pubsub_transport.make_message('a')])
+        received = self.transport.pull('projects/test/subscriptions/source',
+                                       10, return_immediately=True)
+        stats = RelayStats()
+        with captured_output():
+            relay_batch(self.transport, 'projects/test/subscriptions/source',
+                        'projects/other/topics/missing', received, None,
+                        stats)
+        self.assertEqual(1, stats.counts['nacked'])
+        redelivered = self.transport.pull(
+            'projects/test/subscriptions/source', 10, return_immediately=True)
+        self.assertEqual(['a'], [r.message.data for r in redelivered])
+
+
+class StartupTestCase(unittest.TestCase):
+    """A test case for the startup cost of the sample."""
+
+    def test_lazy_imports(self):
+        """Test that importing the sample leaves heavy modules alone."""
+        self.assertEqual([], imported_lazy_modules())
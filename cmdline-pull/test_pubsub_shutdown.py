@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the graceful shutdown."""
+
+
+import os
+import signal
+import time
+import unittest
+
+import mock
+
+from pubsub_shutdown import Shutdown
+
+
+class ShutdownTestCase(unittest.TestCase):
+    """A test case for Shutdown."""
+
+    def test_signals(self):
+        """Test that the first signal asks to stop, and the second forces
+        it."""
+        previous = signal.getsignal(signal.SIGTERM)
+        with mock.patch('sys.stdout'), Shutdown(5) as shutdown:
+            self.assertFalse(shutdown.requested())
+            self.assertIsNone(shutdown.remaining())
+            self.assertFalse(shutdown.wait(0.01))
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.assertTrue(shutdown.wait(1))
+            self.assertTrue(0 < shutdown.remaining() <= 5)
+            with self.assertRaises(KeyboardInterrupt):
+                os.kill(os.getpid(), signal.SIGINT)
+                time.sleep(1)
+        self.assertEqual(previous, signal.getsignal(signal.SIGTERM))
+
+    def test_deadline(self):
+        """Test that the drain deadline starts with the request."""
+        shutdown = Shutdown(0.05)
+        shutdown.request()
+        time.sleep(0.1)
+        self.assertEqual(0, shutdown.remaining())
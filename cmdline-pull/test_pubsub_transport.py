@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the in-memory Cloud Pub/Sub transport."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pubsub_fake import FakeClock
+from pubsub_transport import get_discovery_document
+from pubsub_transport import InMemoryTransport
+from pubsub_transport import make_message
+from pubsub_transport import TransportError
+
+
+TOPIC = 'projects/test/topics/topic'
+SUBSCRIPTION = 'projects/test/subscriptions/sub'
+
+
+class InMemoryTransportTestCase(unittest.TestCase):
+    """A test case for InMemoryTransport."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.transport = InMemoryTransport(clock=self.clock)
+        self.transport.create_topic(TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC,
+                                           ack_deadline_seconds=10)
+
+    def publish(self, *payloads):
+        return self.transport.publish(
+            TOPIC, [make_message(payload) for payload in payloads])
+
+    def pull(self, max_messages=10):
+        return self.transport.pull(SUBSCRIPTION, max_messages,
+                                   return_immediately=True)
+
+    def test_pull_in_publish_order(self):
+        """Test that messages are delivered once, in publish order."""
+        message_ids = self.publish('a', 'b', 'c')
+        received = self.pull(2) + self.pull(2)
+        self.assertEqual(['a', 'b', 'c'],
+                         [r.message.data for r in received])
+        self.assertEqual(message_ids,
+                         [r.message.message_id for r in received])
+        self.transport.acknowledge(SUBSCRIPTION,
+                                   [r.ack_id for r in received])
+        self.clock.now += 60
+        self.assertEqual([], self.pull())
+
+    def test_redelivery_after_ack_deadline(self):
+        """Test that unacked messages come back ahead of newer ones."""
+        self.publish('a', 'b')
+        first = self.pull()
+        self.transport.acknowledge(SUBSCRIPTION, [first[1].ack_id])
+        self.publish('c')
+        self.clock.now += 10
+        second = self.pull()
+        self.assertEqual(['a', 'c'], [r.message.data for r in second])
+        self.assertNotEqual(first[0].ack_id, second[0].ack_id)
+
+    def test_modify_ack_deadline(self):
+        """Test extending a deadline and nacking with a zero deadline."""
+        self.publish('a', 'b')
+        received = self.pull()
+        self.transport.modify_ack_deadline(
+            SUBSCRIPTION, [received[0].ack_id], 60)
+        self.transport.modify_ack_deadline(
+            SUBSCRIPTION, [received[1].ack_id], 0)
+        redelivered = self.pull()
+        self.assertEqual(['b'], [r.message.data for r in redelivered])
+        self.transport.acknowledge(SUBSCRIPTION, [redelivered[0].ack_id])
+        self.clock.now += 30
+        self.assertEqual([], self.pull())
+
+    def test_attributes(self):
+        """Test that attributes are delivered with the message."""
+        self.transport.publish(TOPIC, [make_message('a', {'k': 'v'})])
+        self.assertEqual({'k': 'v'}, self.pull()[0].message.attributes)
+
+    def test_fan_out(self):
+        """Test that every subscription gets its own copy."""
+        other = 'projects/test/subscriptions/other'
+        self.transport.create_subscription(other, TOPIC)
+        self.publish('a')
+        self.assertEqual(1, len(self.pull()))
+        self.assertEqual(
+            1, len(self.transport.pull(other, 10, return_immediately=True)))
+
+    def test_errors(self):
+        """Test the not found and already exists errors."""
+        for func, args, status in [
+                (self.transport.create_topic, (TOPIC,), 409),
+                (self.transport.get_topic, (TOPIC + 'x',), 404),
+                (self.transport.publish, (TOPIC + 'x', []), 404),
+                (self.transport.create_subscription,
+                 (SUBSCRIPTION, TOPIC), 409),
+                (self.transport.pull, (SUBSCRIPTION + 'x', 1), 404)]:
+            with self.assertRaises(TransportError) as cm:
+                func(*args)
+            self.assertEqual(status, cm.exception.status)
+
+    def test_list_pagination(self):
+        """Test listing topics page by page."""
+        for i in range(4):
+            self.transport.create_topic('projects/test/topics/t{}'.format(i))
+        self.transport.create_topic('projects/other/topics/t')
+        names, page_token = [], None
+        while True:
+            topics, page_token = self.transport.list_topics(
+                'projects/test', page_size=2, page_token=page_token)
+            names.extend(topic['name'] for topic in topics)
+            if not page_token:
+                break
+        self.assertEqual(5, len(names))
+        self.assertEqual(
+            [SUBSCRIPTION],
+            self.transport.list_topic_subscriptions(TOPIC)[0])
+
+
+class DiscoveryCacheTestCase(unittest.TestCase):
+    """A test case for the cached discovery document."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'pubsub-v1.json')
+        with open(self.path, 'w') as cached:
+            cached.write('{"name": "pubsub"}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_fresh_cache(self):
+        """Test that a fresh document is read without fetching it."""
+        self.assertEqual('{"name": "pubsub"}',
+                         get_discovery_document(self.path, max_age=60))
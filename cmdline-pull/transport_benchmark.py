@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Runs the same publish/pull/ack workload over each transport.
+
+Creates a temporary topic and subscription per transport, publishes the
+messages in batches, pulls and acknowledges all of them, and prints the
+achieved rates:
+
+% python transport_benchmark.py MYPROJ --transports rest grpc memory
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+
+import pubsub_transport
+
+
+def run_workload(transport, project, args):
+    """Returns (publish rate, pull and ack rate) in messages per second."""
+    random_id = uuid.uuid4()
+    topic = 'projects/{}/topics/bench-{}'.format(project, random_id)
+    subscription = 'projects/{}/subscriptions/bench-{}'.format(
+        project, random_id)
+    transport.create_topic(topic)
+    transport.create_subscription(subscription, topic)
+    try:
+        payload = os.urandom(args.payload_size)
+        start = time.time()
+        for offset in range(0, args.messages, args.batch_size):
+            count = min(args.batch_size, args.messages - offset)
+            transport.publish(
+                topic, [pubsub_transport.make_message(payload)] * count)
+        publish_rate = args.messages / (time.time() - start)
+
+        received = 0
+        start = time.time()
+        while received < args.messages:
+            messages = transport.pull(subscription, args.batch_size)
+            if messages:
+                transport.acknowledge(subscription,
+                                      [m.ack_id for m in messages])
+                received += len(messages)
+        pull_rate = received / (time.time() - start)
+        return publish_rate, pull_rate
+    finally:
+        transport.delete_subscription(subscription)
+        transport.delete_topic(topic)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Compare transports on an identical workload')
+    parser.add_argument('project_name', help='Project name in console')
+    parser.add_argument('--transports', nargs='+',
+                        choices=pubsub_transport.TRANSPORTS,
+                        default=pubsub_transport.TRANSPORTS)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--payload_size', type=int, default=256)
+    args = parser.parse_args(argv[1:])
+
+    print '{:<9} {:>16} {:>16}'.format(
+        'transport', 'publish msgs/s', 'pull+ack msgs/s')
+    for name in args.transports:
+        transport = pubsub_transport.create_transport(name)
+        publish_rate, pull_rate = run_workload(
+            transport, args.project_name, args)
+        print '{:<9} {:>16.1f} {:>16.1f}'.format(
+            name, publish_rate, pull_rate)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1 @@
+../cmdline-pull/pubsub_adaptive.py
\ No newline at end of file
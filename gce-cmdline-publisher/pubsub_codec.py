@@ -0,0 +1 @@
+../cmdline-pull/pubsub_codec.py
\ No newline at end of file
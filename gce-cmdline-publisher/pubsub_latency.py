@@ -0,0 +1 @@
+../cmdline-pull/pubsub_latency.py
\ No newline at end of file
@@ -0,0 +1 @@
+../cmdline-pull/pubsub_publisher.py
\ No newline at end of file
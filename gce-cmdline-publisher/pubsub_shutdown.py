@@ -0,0 +1 @@
+../cmdline-pull/pubsub_shutdown.py
\ No newline at end of file
@@ -0,0 +1 @@
+../cmdline-pull/pubsub_transport.py
\ No newline at end of file
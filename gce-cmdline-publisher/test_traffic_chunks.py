@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes comparing the chunked row transformations with the per-row
+ones of the traffic generator."""
+
+
+import datetime
+import unittest
+
+from dateutil.parser import parse
+import mock
+import numpy as np
+
+from traffic_chunks import process_chunk
+from traffic_pubsub_generator import process_current_mode
+from traffic_pubsub_generator import process_noncurrent_mode
+
+
+LINES = [['2010-01-01 00:%02d:00' % minute, str(1100000 + minute), '5', 'N']
+         for minute in range(0, 60, 5)]
+
+# Whole seconds; see test_replay_milliseconds for a shift with a fraction.
+DIFF = datetime.timedelta(days=2300, seconds=4321)
+
+
+class SequenceRandom(object):
+    """Returns the given numbers in order, one at a time to the per-row
+    code and in arrays to process_chunk."""
+
+    def __init__(self, values):
+        self.values = iter(values)
+
+    def random(self):
+        return next(self.values)
+
+    def random_sample(self, size):
+        return np.array([next(self.values) for _ in range(size)])
+
+
+def copy_lines(lines):
+    return [list(line) for line in lines]
+
+
+def process_rows(lines, current, replay, draws=()):
+    """Returns (line, ts, orig_date) for every line, from the per-row
+    code, with --random_delays when there are draws."""
+    rng = SequenceRandom(draws)
+    processed = []
+    for line in copy_lines(lines):
+        orig_date = parse(line[0])
+        if current:
+            line, ts = process_current_mode(orig_date, DIFF, line, replay,
+                                            bool(draws), rng)
+        else:
+            line, ts = process_noncurrent_mode(orig_date, line, bool(draws),
+                                               rng)
+        processed.append((line, ts, orig_date))
+    return processed
+
+
+def process_chunked(lines, current, replay, draws=()):
+    """Returns the output of process_chunk, without the incidents."""
+    rng = SequenceRandom(draws)
+    with mock.patch('sys.stdout'):
+        processed = process_chunk(copy_lines(lines), DIFF, current, replay,
+                                  bool(draws), 0, rng)
+    return [row[:3] for row in processed]
+
+
+class ProcessChunkTestCase(unittest.TestCase):
+    """A test case for process_chunk against the per-row code."""
+
+    def test_noncurrent(self):
+        self.assertEqual(process_rows(LINES, False, False),
+                         process_chunked(LINES, False, False))
+
+    def test_current_replay(self):
+        self.assertEqual(process_rows(LINES, True, True),
+                         process_chunked(LINES, True, True))
+
+    def test_random_delays(self):
+        """Test that the same draws delay the same rows, with and without
+        --current --replay."""
+        draws = [0.5, 0.001, 0.5, 0.5, 0.004] + [0.5] * (len(LINES) - 5)
+        per_row = process_rows(LINES, False, False, draws)
+        self.assertEqual([1, 4], [i for i, (line, _, _) in enumerate(per_row)
+                                  if line[0] != LINES[i][0]])
+        self.assertEqual(per_row, process_chunked(LINES, False, False, draws))
+        self.assertEqual(process_rows(LINES, True, True, draws),
+                         process_chunked(LINES, True, True, draws))
+
+    def test_current_without_replay(self):
+        """Test that without --replay every row of a chunk gets the time
+        the chunk is processed, where the per-row code takes the time of
+        every row."""
+        before = datetime.datetime.utcnow().replace(microsecond=0)
+        processed = process_chunked(LINES, True, False)
+        after = datetime.datetime.utcnow()
+        self.assertEqual(1, len(set(ts for _, ts, _ in processed)))
+        for i, (line, ts, orig_date) in enumerate(processed):
+            self.assertTrue(before <= parse(line[0]) <= after)
+            self.assertEqual(
+                line[0], datetime.datetime.utcfromtimestamp(
+                    int(ts) / 1000).strftime('%Y-%m-%d %H:%M:%S'))
+            self.assertEqual(parse(LINES[i][0]), orig_date)
+
+    def test_replay_milliseconds(self):
+        """Test the intended difference with a shift that has a fraction
+        of a second: process_current_mode adds its milliseconds to ts
+        twice, process_chunk once."""
+        diff = DIFF + datetime.timedelta(microseconds=250000)
+        orig_date = parse(LINES[0][0])
+        _, ts = process_current_mode(orig_date, diff, list(LINES[0]), True,
+                                     False)
+        [(line, chunk_ts, _, _)] = process_chunk(
+            [list(LINES[0])], diff, True, True, False, 0)
+        self.assertEqual(int(ts) - 250, int(chunk_ts))
+        self.assertEqual((orig_date + diff).strftime('%Y-%m-%d %H:%M:%S'),
+                         line[0])
+
+    def test_unparseable(self):
+        """Test that rows NumPy can't parse are left to the per-row
+        code."""
+        lines = copy_lines(LINES[:2]) + [['01/02/2010 00:05:00', '1'],
+                                         ['garbage', '2'], []]
+        processed = process_chunk(lines, DIFF, False, False, False, 0)
+        self.assertEqual([None] * 3, processed[2:])
+        self.assertEqual(process_rows(LINES[:2], False, False),
+                         [row[:3] for row in processed[:2]])
+
+    def test_incidents(self):
+        """Test that a row gets an incident when its draw is below the
+        threshold, like publish_row does."""
+        draws = [0.5, 0.001, 0.02, 0.0]
+        processed = process_chunk(copy_lines(LINES[:4]), DIFF, False, False,
+                                  False, 0.01, SequenceRandom(draws))
+        self.assertEqual([draw < 0.01 for draw in draws],
+                         [row[3] for row in processed])
+        processed = process_chunk(copy_lines(LINES[:4]), DIFF, False, False,
+                                  False, 0, SequenceRandom([]))
+        self.assertEqual([False] * 4, [row[3] for row in processed])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for reading merged, compressed traffic files."""
+
+
+import bz2
+import contextlib
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import traffic_inputs
+from traffic_inputs import MergedReader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def make_lines(minutes, station):
+    return ['2010-01-01 00:%02d:00,%d,5,N,ML\n' % (minute, station)
+            for minute in minutes]
+
+
+class MergedReaderTestCase(unittest.TestCase):
+    """A test case for MergedReader, over small files in a tmpdir."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.lines = {
+            'a.csv.gz': make_lines([0, 3, 6, 9], 1),
+            'b.csv.bz2': make_lines([1, 3, 4, 10, 11], 2),
+            'c.csv': make_lines([2, 5], 3),
+        }
+        self.paths = [self.write(name, lines)
+                      for name, lines in sorted(self.lines.items())]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmp, name)
+        data = ''.join(lines)
+        if name.endswith('.gz'):
+            with contextlib.closing(gzip.open(path, 'wb')) as f:
+                f.write(data)
+        elif name.endswith('.bz2'):
+            with contextlib.closing(bz2.BZ2File(path, 'wb')) as f:
+                f.write(data)
+        elif name.endswith('.zst'):
+            with open(path, 'wb') as f:
+                f.write(zstandard.ZstdCompressor().compress(data))
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def read(self, paths, offsets=None, count=None):
+        """Returns count rows, or all of them, and the position after."""
+        reader = MergedReader(paths, offsets)
+        try:
+            rows = []
+            for row in reader:
+                rows.append(','.join(row) + '\n')
+                if len(rows) == count:
+                    break
+            return rows, reader.position()
+        finally:
+            reader.close()
+
+    def expected(self):
+        # Ties go to the first file, like the order of --filename, which
+        # here has the lowest station.
+        return sorted(sum(self.lines.values(), []))
+
+    def test_merge_order(self):
+        """Test that the rows of every file are merged by timestamp."""
+        rows, position = self.read(self.paths)
+        self.assertEqual(self.expected(), rows)
+        self.assertEqual(
+            [len(''.join(lines))
+             for _, lines in sorted(self.lines.items())], position)
+
+    def test_position(self):
+        """Test that the position covers the rows returned so far."""
+        rows, position = self.read(self.paths, count=6)
+        self.assertEqual(self.expected()[:6], rows)
+        # 0, 3 from a; 1, 3, 4 from b; 2 from c.
+        line_bytes = len(self.lines['c.csv'][0])
+        self.assertEqual([2 * line_bytes, 3 * line_bytes, line_bytes],
+                         position)
+
+    def test_resume(self):
+        """Test that reading from a position returns the remaining rows,
+        skipping into the decompressed data."""
+        first, position = self.read(self.paths, count=6)
+        rest, end = self.read(self.paths, position)
+        self.assertEqual(self.expected(), first + rest)
+        self.assertEqual(self.read(self.paths)[1], end)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        path = self.write('d.csv.zst', make_lines([7, 8], 4))
+        rows, _ = self.read([path], [len(make_lines([7], 4)[0])])
+        self.assertEqual(make_lines([8], 4), rows)
+
+    def test_missing_file(self):
+        """Test that a file that can't be opened fails the iteration."""
+        with self.assertRaises(IOError):
+            self.read(self.paths + [os.path.join(self.tmp, 'missing.gz')])
+
+    def test_corrupt_file(self):
+        """Test that a file that can't be decompressed fails the
+        iteration."""
+        path = os.path.join(self.tmp, 'corrupt.csv.gz')
+        with open(path, 'wb') as f:
+            f.write('not gzip data\n')
+        with self.assertRaises(IOError):
+            self.read(self.paths + [path])
+
+    def test_offsets(self):
+        with self.assertRaises(ValueError):
+            MergedReader(self.paths, [0])
+
+    def test_expand_inputs(self):
+        """Test that globs are expanded in order, and must match."""
+        self.assertEqual(
+            self.paths,
+            traffic_inputs.expand_inputs([os.path.join(self.tmp, '*.csv*')]))
+        with self.assertRaises(ValueError):
+            traffic_inputs.expand_inputs([os.path.join(self.tmp, '*.zst')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Test classes for the checkpoints of the traffic generator."""
+
+
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import pubsub_transport
+from traffic_pubsub_generator import Checkpoint
+from traffic_pubsub_generator import load_checkpoint
+from traffic_pubsub_generator import main
+import traffic_synthetic
+
+
+TOPIC = 'projects/test/topics/traffic'
+
+SUBSCRIPTION = 'projects/test/subscriptions/traffic'
+
+
+class CheckpointTestCase(unittest.TestCase):
+    """A test case for saving checkpoints."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp, 'run.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_flushed_before_saved(self):
+        """Test that a checkpoint is only written once its lines are
+        published."""
+        saved = []
+        checkpoint = Checkpoint(
+            self.state_file, 2, 'source',
+            lambda: saved.append(load_checkpoint(self.state_file)))
+        date = datetime.datetime(2010, 1, 1)
+        checkpoint.update(10, 1, 0, date)
+        self.assertEqual([], saved)
+        self.assertIsNone(load_checkpoint(self.state_file))
+        checkpoint.update(20, 2, 0, date)
+        self.assertEqual([None], saved)
+        self.assertEqual({'source': 'source', 'position': 20,
+                          'line_count': 2, 'incident_count': 0,
+                          'prev_date': '2010-01-01T00:00:00'},
+                         load_checkpoint(self.state_file))
+
+    def test_atomic_save(self):
+        """Test that a save that fails leaves the previous checkpoint."""
+        checkpoint = Checkpoint(self.state_file, 1, 'source', lambda: None)
+        date = datetime.datetime(2010, 1, 1)
+        checkpoint.update(10, 1, 0, date)
+        with mock.patch('os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                checkpoint.update(20, 2, 0, date)
+        self.assertEqual(1, load_checkpoint(self.state_file)['line_count'])
+
+    def test_failed_run_keeps_checkpoint(self):
+        """Test that a run failing to flush keeps the previous
+        checkpoint."""
+        def flush():
+            raise pubsub_transport.TransportError(503, 'unavailable')
+        date = datetime.datetime(2010, 1, 1)
+        with open(self.state_file, 'w') as f:
+            json.dump({'line_count': 1}, f)
+        with self.assertRaises(ValueError):
+            with Checkpoint(self.state_file, 10, 'source', flush) as c:
+                c.update(20, 2, 0, date)
+                raise ValueError('bad row')
+        self.assertEqual({'line_count': 1}, load_checkpoint(self.state_file))
+
+
+class ResumeTestCase(unittest.TestCase):
+    """A test case for interrupting and resuming runs, on the in-memory
+    transport."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp, 'run.state')
+        self.lines = ['2010-01-01 00:%02d:00,%d,5,N,ML\n' % (i, 1100000 + i)
+                      for i in range(20)]
+        self.filename = self.write_file('readings.csv', self.lines)
+        self.transport = pubsub_transport.SHARED_IN_MEMORY_TRANSPORT
+        self.transport.reset()
+        self.transport.create_topic(TOPIC)
+        self.transport.create_subscription(SUBSCRIPTION, TOPIC)
+
+    def tearDown(self):
+        self.transport.reset()
+        shutil.rmtree(self.tmp)
+
+    def write_file(self, name, lines):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return path
+
+    def generate(self, *args):
+        with mock.patch('sys.stdout'):
+            main(['traffic_pubsub_generator.py', '--transport', 'memory',
+                  '--topic', TOPIC, '--state_file', self.state_file,
+                  '--checkpoint_lines', '3', '--batch_size', '1',
+                  '--publish_workers', '1', '--stats_seconds', '0'] +
+                 list(args))
+
+    def published(self):
+        received = self.transport.pull(SUBSCRIPTION, 1000,
+                                       return_immediately=True)
+        if received:
+            self.transport.acknowledge(SUBSCRIPTION,
+                                       [r.ack_id for r in received])
+        return [r.message.data for r in received]
+
+    def rows(self, lines):
+        return [line.rstrip('\n') for line in lines]
+
+    def test_resume(self):
+        """Test that a resumed run publishes exactly the remaining rows."""
+        self.generate('--filename', self.filename, '--num_lines', '8')
+        first = self.published()
+        self.assertEqual(self.rows(self.lines[:7]), first)
+        state = load_checkpoint(self.state_file)
+        self.assertEqual(7, state['line_count'])
+        self.assertEqual(len(''.join(self.lines[:7])), state['position'])
+
+        self.generate('--filename', self.filename, '--resume')
+        self.assertEqual(self.rows(self.lines[7:]), self.published())
+        self.assertEqual(20, load_checkpoint(self.state_file)['line_count'])
+
+    def test_resume_after_failure(self):
+        """Test that a checkpoint doesn't cover the rows that failed to
+        publish, so that resuming publishes them."""
+        publish = self.transport.publish
+        published = []
+
+        def fail_after_ten(topic, messages):
+            if len(published) >= 10:
+                raise pubsub_transport.TransportError(503, 'unavailable')
+            published.extend(messages)
+            return publish(topic, messages)
+
+        with mock.patch.object(self.transport, 'publish',
+                               side_effect=fail_after_ten):
+            with self.assertRaises(pubsub_transport.TransportError):
+                self.generate('--filename', self.filename)
+        first = self.published()
+        self.assertEqual(self.rows(self.lines[:10]), first)
+        state = load_checkpoint(self.state_file)
+        line_count = state['line_count']
+        self.assertLessEqual(line_count, 10)
+        self.assertEqual(len(''.join(self.lines[:line_count])),
+                         state['position'])
+
+        self.generate('--filename', self.filename, '--resume')
+        self.assertEqual(self.rows(self.lines[line_count:]),
+                         self.published())
+
+    def test_resume_synthetic(self):
+        """Test that a resumed --synthetic run regenerates the same
+        remaining rows."""
+        args = ['--synthetic', '--seed', '7', '--stations', '2',
+                '--span_hours', '1']
+        self.generate(*(args + ['--num_lines', '6']))
+        state = load_checkpoint(self.state_file)
+        self.assertEqual(5, state['position'])
+        first = self.published()
+        self.generate(*(args + ['--resume']))
+        rows = traffic_synthetic.generate_rows(
+            random.Random(7), 2, datetime.timedelta(hours=1))
+        self.assertEqual([','.join(row) for row in rows],
+                         first + self.published())
+
+    def test_other_source(self):
+        """Test that --resume refuses a checkpoint of other input."""
+        self.generate('--filename', self.filename, '--num_lines', '5')
+        other = self.write_file('other.csv', self.lines)
+        with self.assertRaises(SystemExit) as raised:
+            self.generate('--filename', other, '--resume')
+        self.assertIn('has a checkpoint for', str(raised.exception.code))
+        self.assertEqual(4, load_checkpoint(self.state_file)['line_count'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Chunked, vectorized versions of the per-row transformations in
+traffic_pubsub_generator.py, used with its --chunk_size flag.
+
+Rows are read in blocks, their timestamps are parsed into a NumPy
+datetime64 array, and the --current time shift, the --random_delays delay
+mask and the incident sampling are applied to the whole block at once.
+This module requires NumPy:
+% pip install numpy
+"""
+import datetime
+import itertools
+
+import numpy as np
+
+import pubsub_profile
+
+# Delay applied by --random_delays, and the fraction of rows it applies to.
+# These match maybe_add_delay in traffic_pubsub_generator.py.
+DELAY_MS = 600000
+DELAY_THRESH = .005
+
+
+def read_chunks(reader, chunk_size):
+    """Yield lists of up to chunk_size rows from a csv reader."""
+    while True:
+        chunk = list(itertools.islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_timestamps(timestrings):
+    """Parse 'YYYY-MM-DD HH:MM:SS' strings into a datetime64[us] array.
+
+    Strings NumPy can't parse become NaT, so that a bad row doesn't fail
+    its whole chunk.
+    """
+    try:
+        return np.array(timestrings, dtype='datetime64[us]')
+    except ValueError:
+        parsed = np.empty(len(timestrings), dtype='datetime64[us]')
+        for i, timestring in enumerate(timestrings):
+            try:
+                parsed[i] = np.datetime64(timestring, 'us')
+            except ValueError:
+                parsed[i] = np.datetime64('NaT')
+        return parsed
+
+
+def format_timestamps(timestamps):
+    """Format a datetime64 array as a list of 'YYYY-MM-DD HH:MM:SS'."""
+    strings = np.datetime_as_string(timestamps.astype('datetime64[s]'))
+    return np.char.replace(strings, 'T', ' ').tolist()
+
+
+def process_chunk(lines, diff, current, replay, random_delays,
+                  incident_thresh, rng=np.random):
+    """Transform a chunk of rows like the per-row code does.
+
+    Returns a list with, for every row, either None when its timestamp
+    can't be parsed, or a (line, ts, orig_date, incident) tuple where ts
+    is the 'timestamp' attribute and incident tells whether to generate
+    an incident for the row, which happens with probability
+    incident_thresh.
+
+    The results match process_current_mode and process_noncurrent_mode,
+    given the same random draws, except that:
+    - without --replay, --current uses the time the chunk is processed for
+      all of its rows;
+    - ts counts the milliseconds of the shifted time once, where the
+      per-row code adds them twice, so with --current --replay the two
+      differ by the milliseconds of diff.
+    """
+    orig = parse_timestamps([line[0] if line else '' for line in lines])
+    valid = ~np.isnat(orig)
+    if current:
+        if replay:
+            shifted = orig + np.timedelta64(diff, 'us')
+        else:
+            shifted = np.full(len(lines), np.datetime64(
+                datetime.datetime.utcnow(), 'us'))
+    else:
+        shifted = orig
+    ts = shifted.astype('datetime64[ms]').astype(np.int64)
+
+    # Rows whose first column is rewritten: all of them with --current,
+    # otherwise only the delayed ones.
+    rewrite = np.full(len(lines), current, dtype=bool)
+    if random_delays:
+        delayed = (rng.random_sample(len(lines)) < DELAY_THRESH) & valid
+        ts = np.where(delayed, ts - DELAY_MS, ts)
+        rewrite |= delayed
+        if delayed.any():
+            print "Delaying ts attr for %s rows" % delayed.sum()
+    if incident_thresh:
+        incident = rng.random_sample(len(lines)) < incident_thresh
+    else:
+        incident = np.zeros(len(lines), dtype=bool)
+
+    timestrings = format_timestamps(ts.astype('datetime64[ms]'))
+    orig_dates = orig.tolist()
+    ts_strings = ts.astype(str).tolist()
+    valid = valid.tolist()
+    rewrite = rewrite.tolist()
+    incident = incident.tolist()
+    processed = []
+    for i, line in enumerate(lines):
+        if not valid[i]:
+            processed.append(None)
+            continue
+        if rewrite[i]:
+            line[0] = timestrings[i]
+        processed.append((line, ts_strings[i], orig_dates[i], incident[i]))
+    return processed
+
+
+def iter_processed_rows(reader, chunk_size, diff, current, replay,
+                        random_delays, incident_thresh, seed=None):
+    """Yield (line, processed) for every row of a csv reader.
+
+    processed is a tuple from process_chunk, or None when the row should go
+    through the per-row code instead. incident_thresh is the probability of
+    generating an incident for a row, or 0 for no incidents. seed makes the
+    delays and incidents reproducible.
+    """
+    rng = np.random.RandomState(seed)
+    for chunk in read_chunks(reader, chunk_size):
+        with pubsub_profile.span('parse', rows=len(chunk)):
+            processed_chunk = process_chunk(chunk, diff, current, replay,
+                                            random_delays, incident_thresh,
+                                            rng)
+        for line, processed in zip(chunk, processed_chunk):
+            yield line, processed
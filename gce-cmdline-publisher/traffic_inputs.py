@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Reads the traffic data from several, possibly compressed, files.
+
+expand_inputs() turns the --filename arguments, which may be globs, into
+a list of files. MergedReader reads every file on a thread of its own,
+decompressing .gz, .bz2 and .zst files as it goes; zlib, bz2 and zstd
+release the GIL while decompressing, so the files are decompressed in
+parallel. Their rows are merged by timestamp into one stream, so that
+several days or districts replay as one. Every file must be sorted by
+time already, as the traffic files are.
+
+Timestamps are compared as strings, which sorts the ISO format of the
+traffic files ('2010-01-01 00:05:00') by time.
+
+The position after a row is the list of the offsets into the
+decompressed data of every file, so a merged run can be checkpointed
+and resumed like a single file.
+"""
+
+import bz2
+import contextlib
+import csv
+import glob
+import gzip
+import heapq
+import io
+import Queue
+import threading
+
+
+READ_BYTES = 1 << 20  # decompressed bytes read at a time from each file
+
+QUEUE_CHUNKS = 4  # chunks each file may be read ahead of the merge
+
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.zst')
+
+
+def expand_inputs(patterns):
+    """Returns the files matching a list of paths or globs, in order."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError('No file matches %s' % pattern)
+        paths.extend(matches)
+    return paths
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_input(path):
+    """Opens a file, decompressing it according to its suffix."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('Reading %s requires the zstandard package: '
+                             'pip install zstandard' % path)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb')), READ_BYTES)
+    return open(path, 'rb')
+
+
+def skip(data_file, offset):
+    """Skips offset bytes of (decompressed) data."""
+    while offset > 0:
+        data = data_file.read(min(offset, READ_BYTES))
+        if not data:
+            return
+        offset -= len(data)
+
+
+class MergedReader(object):
+    """Iterates over the CSV rows of several files, merged by timestamp.
+
+    offsets is where to start in every file, e.g. the position() of a
+    checkpoint. close() stops the reading threads.
+    """
+
+    def __init__(self, paths, offsets=None):
+        self.paths = paths
+        self.offsets = list(offsets or [0] * len(paths))
+        if len(self.offsets) != len(paths):
+            raise ValueError('Expected %d offsets, got %d' %
+                             (len(paths), len(self.offsets)))
+        self.stopped = threading.Event()
+        self.queues = [Queue.Queue(QUEUE_CHUNKS) for _ in paths]
+        self.threads = [threading.Thread(target=self._read, args=(index,))
+                        for index in range(len(paths))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, queue, item):
+        # Give up once closed, rather than block on a full queue forever.
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _read(self, index):
+        queue = self.queues[index]
+        offset = self.offsets[index]
+        try:
+            with contextlib.closing(open_input(self.paths[index])) as f:
+                skip(f, offset)
+                while not self.stopped.is_set():
+                    lines = f.readlines(READ_BYTES)
+                    if not lines:
+                        break
+                    rows = []
+                    # The traffic files have no quoted newlines, so every
+                    # line is one row.
+                    for line, row in zip(lines, csv.reader(lines)):
+                        offset += len(line)
+                        rows.append((row[0] if row else '', index, row,
+                                     offset))
+                    self._put(queue, rows)
+            self._put(queue, None)
+        except Exception as e:  # raised by the merge, on the main thread
+            self._put(queue, e)
+
+    def _rows(self, index):
+        queue = self.queues[index]
+        while True:
+            rows = queue.get()
+            if rows is None:
+                return
+            if isinstance(rows, Exception):
+                raise rows
+            for row in rows:
+                yield row
+
+    def __iter__(self):
+        streams = [self._rows(index) for index in range(len(self.paths))]
+        for _, index, row, offset in heapq.merge(*streams):
+            self.offsets[index] = offset
+            yield row
+
+    def position(self):
+        """Returns the offsets into every file after the last row."""
+        return list(self.offsets)
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
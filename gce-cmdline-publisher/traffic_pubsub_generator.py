@@ -44,6 +44,40 @@ To restrict to N lines, do something like this:
 % python traffic_pubsub_generator.py --filename 'yourdatafile.csv' \
   --num_lines 10 --replay
 
+--filename also takes several files or globs, including .gz, .bz2 and
+.zst compressed files, and replays them as one stream merged by
+timestamp (see traffic_inputs):
+% python traffic_pubsub_generator.py --filename 'district*/2010-01-*.csv.gz' \
+  --replay
+
+To generate reproducible data instead of reading a file, use --synthetic
+with a --seed, and set the number of stations and hours of data:
+% python traffic_pubsub_generator.py --synthetic --seed 42 \
+  --stations 1000 --span_hours 24 --replay
+
+To be able to pick up a long run where it stopped, save checkpoints to a
+state file, and pass --resume when running the same command again:
+% python traffic_pubsub_generator.py --filename 'yourdatafile.csv' \
+  --replay --state_file replay.state --resume
+
+To drive a fixed load instead, e.g. for capacity tests, set a target
+rate in messages and/or bytes per second, optionally with a profile that
+varies it over time (see pubsub_publisher.parse_profile):
+% python traffic_pubsub_generator.py --synthetic --span_hours 0 \
+  --rate 20000 --rate_profile ramp:300 --batch_size 500
+
+To spread the readings over more topics, add --route rules. A rule
+matches a column (timestamp, station_id, freeway, direction or a column
+number) against values, and its topic may use the columns of the row.
+The first matching rule wins, and other rows go to --topic:
+% python traffic_pubsub_generator.py --filename 'yourdatafile.csv' \
+  --route 'freeway=5|805:projects/your-project/topics/i5-i805' \
+  --route 'projects/your-project/topics/freeway-{freeway}-{direction}'
+
+On SIGTERM or Ctrl-C, the script stops reading rows, and has
+--drain_seconds to publish the messages in flight and save a last
+checkpoint; a second signal stops it right away.
+
 To alter the data timestamps to start from the script time, add
 the --current flag.
 If you want to set the topics from the command line, use
@@ -51,16 +85,28 @@ the --topic and --incident_topic flags.
 Run 'python traffic_pubsub_generator.py -h' for more information.
 """
 import argparse
-import base64
+import collections
+import contextlib
 import csv
 import datetime
+import itertools
+import json
+import os
 import random
+import string
 import sys
 import time
 
-from apiclient import discovery
 from dateutil.parser import parse
-from oauth2client.client import GoogleCredentials
+
+import pubsub_codec
+import pubsub_latency
+import pubsub_profile
+import pubsub_publisher
+import pubsub_shutdown
+import pubsub_transport
+import traffic_inputs
+import traffic_synthetic
 
 # default; set to your traffic topic. Can override on command line.
 TRAFFIC_TOPIC = 'projects/your-project/topics/your-topic'
@@ -68,8 +114,6 @@ TRAFFIC_TOPIC = 'projects/your-project/topics/your-topic'
 INCIDENT_TOPIC = 'projects/your-project/topics/your-incident-topic'
 LINE_BATCHES = 100  # report periodic progress
 
-PUBSUB_SCOPES = ['https://www.googleapis.com/auth/pubsub']
-NUM_RETRIES = 3
 INCIDENT_TYPES = ['Traffic Hazard - Vehicle', 'Traffic Collision - No Details',
                   'Traffic Collision - No Injuries',
                   'Traffic Collision - Ambulance Responding',
@@ -81,45 +125,40 @@ INCIDENT_DURATION_RANGE = 60  # max in minutes of a randomly generated duration
 # to increase/decrease the likelihood that an incident is generated for a given
 # reading.
 INCIDENT_THRESH = 0.005
+CHECKPOINT_LINES = 10000  # default number of lines between checkpoints
+STATS_SECONDS = 60  # default interval of the per-topic statistics
+# Names of the leading columns of a reading, for --route rules.
+COLUMNS = ['timestamp', 'station_id', 'freeway', 'direction']
 
 
-def create_pubsub_client():
+def create_pubsub_client(transport='rest'):
     """Build the pubsub client."""
-    credentials = GoogleCredentials.get_application_default()
-    if credentials.create_scoped_required():
-        credentials = credentials.create_scoped(PUBSUB_SCOPES)
-    return discovery.build('pubsub', 'v1beta2', credentials=credentials)
+    return pubsub_transport.create_transport(transport)
 
 
-def publish(client, pubsub_topic, data_line, msg_attributes=None):
-    """Publish to the given pubsub topic."""
-    data = base64.b64encode(data_line)
-    msg_payload = {'data': data}
-    if msg_attributes:
-        msg_payload['attributes'] = msg_attributes
-    body = {'messages': [msg_payload]}
-    resp = client.projects().topics().publish(
-        topic=pubsub_topic, body=body).execute(num_retries=NUM_RETRIES)
-    return resp
+def publish(client, pubsub_topic, data_line, msg_attributes=None, codec=None):
+    """Publish to the given pubsub topic, encoding the data with codec."""
+    with pubsub_profile.span('encode'):
+        data, msg_attributes = pubsub_codec.encode_message(
+            data_line, msg_attributes, codec)
+    return client.publish(
+        pubsub_topic, [pubsub_transport.make_message(data, msg_attributes)])
 
 
-def maybe_add_delay(line, ts_int):
+def maybe_add_delay(line, ts_int, rng=random):
     """Randomly determine whether to simulate a publishing delay with this
     data element."""
     # 10 mins in ms.  Edit this value to change the amount of delay.
     ms_delay = 600000
     threshold = .005
-    if random.random() < threshold:
+    if rng.random() < threshold:
         ts_int -= ms_delay  # generate 10-min apparent delay
-        print line
         line[0] = "%s" % datetime.datetime.utcfromtimestamp(ts_int/1000)
-        print ("Delaying ts attr %s, %s, %s" %
-               (ts_int, datetime.datetime.utcfromtimestamp(ts_int/1000),
-                line))
     return (line, ts_int)
 
 
-def process_current_mode(orig_date, diff, line, replay, random_delays):
+def process_current_mode(orig_date, diff, line, replay, random_delays,
+                         rng=random):
     """When using --current flag, modify original data to generate updated time
     information."""
     epoch = datetime.datetime(1970, 1, 1)
@@ -132,7 +171,7 @@ def process_current_mode(orig_date, diff, line, replay, random_delays):
         # 'random_delays' indicates whether to include random apparent delays
         # in published data
         if random_delays:
-            (line, ts_int) = maybe_add_delay(line, ts_int)
+            (line, ts_int) = maybe_add_delay(line, ts_int, rng)
         return (line, str(ts_int))
     else:  # simply using current time
         currtime = datetime.datetime.utcnow()
@@ -143,11 +182,11 @@ def process_current_mode(orig_date, diff, line, replay, random_delays):
         # 'random_delays' indicates whether to include random apparent delays
         # in published data
         if random_delays:
-            (line, ts_int) = maybe_add_delay(line, ts_int)
+            (line, ts_int) = maybe_add_delay(line, ts_int, rng)
         return (line, str(ts_int))
 
 
-def process_noncurrent_mode(orig_date, line, random_delays):
+def process_noncurrent_mode(orig_date, line, random_delays, rng=random):
     """Called when not using --current flag; retaining original time
     information in data."""
     epoch = datetime.datetime(1970, 1, 1)
@@ -157,26 +196,242 @@ def process_noncurrent_mode(orig_date, line, random_delays):
     # 'random_delays' indicates whether to include random apparent delays
     # in published data
     if random_delays:
-        (line, ts_int) = maybe_add_delay(line, ts_int)
+        (line, ts_int) = maybe_add_delay(line, ts_int, rng)
     return (line, str(ts_int))
 
 
 def publish_random_incident(client, incident_topic, incident_id,
                             timestamp, station_id, freeway, travel_direction,
-                            msg_attributes=None):
+                            msg_attributes=None, codec=None, rng=random):
     """Generate a random traffic 'incident' based on information from the
     given traffic reading, and publish it to the specified 'incidents' pubsub
     topic."""
-    duration = random.randrange(INCIDENT_DURATION_RANGE)  # minutes
-    cause = INCIDENT_TYPES[random.randrange(len(INCIDENT_TYPES))]
+    duration = rng.randrange(INCIDENT_DURATION_RANGE)  # minutes
+    cause = INCIDENT_TYPES[rng.randrange(len(INCIDENT_TYPES))]
     data_line = '%s,%s,%s,%s,%s,%s,%s' % (incident_id, timestamp, duration,
                                           station_id, freeway,
                                           travel_direction, cause)
     print "incident data: %s" % data_line
-    publish(client, incident_topic, data_line, msg_attributes)
+    publish(client, incident_topic, data_line, msg_attributes, codec)
 
 
-def main(argv):
+class LineReader(object):
+    """Iterates over the lines of a file, keeping track of the byte offset
+    after the last line read. Iterating over the file itself reads ahead,
+    so its tell() can't be used for this."""
+
+    def __init__(self, data_file):
+        self.data_file = data_file
+        self.offset = data_file.tell()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.data_file.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+
+def track_positions(rows, positions, get_position):
+    """Yield rows, appending the position after each row to positions."""
+    for row in rows:
+        positions.append(get_position())
+        yield row
+
+
+def get_source(args):
+    """Identify the input of a run, to check that --resume continues it."""
+    if args.synthetic:
+        return 'synthetic:%s:%s:%s' % (args.seed, args.stations,
+                                       args.span_hours)
+    return ','.join(os.path.abspath(path) for path in args.filename)
+
+
+def column_index(column):
+    """Return the index of a column given by name or number."""
+    if column in COLUMNS:
+        return COLUMNS.index(column)
+    if column.isdigit():
+        return int(column)
+    raise ValueError("Unknown column: %s" % column)
+
+
+class Router(object):
+    """Picks the topic of each reading from --route rules.
+
+    A rule is '[COLUMN=VALUE[|VALUE...]:]TOPIC'. Without a condition it
+    matches every row. TOPIC may contain {column} placeholders, by name
+    or number, which are filled in from the row.
+    """
+
+    def __init__(self, rules, default_topic):
+        self.rules = [self.parse_rule(rule) for rule in rules]
+        self.default_topic = default_topic
+
+    @staticmethod
+    def parse_rule(rule):
+        condition, _, topic = rule.rpartition(':')
+        index = values = None
+        if condition:
+            column, equals, values = condition.partition('=')
+            if not equals:
+                raise ValueError("Invalid route: %s" % rule)
+            index = column_index(column)
+            values = set(values.split('|'))
+        for _, field, _, _ in string.Formatter().parse(topic):
+            if field is not None:
+                column_index(field)  # fail early on unknown columns
+        return index, values, topic
+
+    def route(self, line):
+        for index, values, topic in self.rules:
+            if index is None or (index < len(line) and
+                                 line[index] in values):
+                return topic.format(*line, **dict(zip(COLUMNS, line)))
+        return self.default_topic
+
+
+@contextlib.contextmanager
+def open_rows(args, position=0):
+    """Yield the rows to publish, from --filename or --synthetic, starting
+    at position, and a deque that gets the position after each row read.
+
+    Positions are byte offsets in the file, lists of offsets into the
+    decompressed data of every file when several or compressed files are
+    merged, or row numbers with --synthetic. Rows may be read ahead of the
+    ones being published, so main() takes positions from the deque as it
+    finishes rows.
+    """
+    positions = collections.deque()
+    if args.synthetic:
+        span = None
+        if args.span_hours:
+            span = datetime.timedelta(hours=args.span_hours)
+        print "generating readings of %s stations" % args.stations
+        # Readings get their own generator, so resuming regenerates the
+        # same ones.
+        rows = traffic_synthetic.generate_rows(
+            random.Random(args.seed), args.stations, span)
+        counter = itertools.count(position + 1)
+        yield (track_positions(itertools.islice(rows, position, None),
+                               positions, counter.next),
+               positions)
+    elif (len(args.filename) == 1 and
+          not traffic_inputs.is_compressed(args.filename[0])):
+        filename = args.filename[0]
+        print "processing %s" % filename  # process the traffic data file
+        with open(filename) as data_file:
+            data_file.seek(position)
+            lines = LineReader(data_file)
+            yield (track_positions(csv.reader(lines), positions,
+                                   lambda: lines.offset),
+                   positions)
+    else:
+        print "merging %s files by timestamp" % len(args.filename)
+        reader = traffic_inputs.MergedReader(args.filename, position or None)
+        try:
+            yield (track_positions(reader, positions, reader.position),
+                   positions)
+        finally:
+            reader.close()
+
+
+@contextlib.contextmanager
+def draining(publisher, shutdown):
+    """Close publisher at the end, within the drain deadline once a
+    shutdown was requested. What isn't published by then, or when the run
+    fails, is dropped."""
+    try:
+        yield publisher
+    except pubsub_publisher.FlushTimeout, e:  # from the last checkpoint
+        print "gave up draining: %s" % e
+        publisher.close(flush=False, timeout=shutdown.remaining())
+        return
+    except BaseException:
+        publisher.close(flush=False, timeout=shutdown.remaining())
+        raise
+    try:
+        publisher.close(timeout=shutdown.remaining())
+    except pubsub_publisher.FlushTimeout, e:
+        print "gave up draining: %s" % e
+
+
+def flush_published(client, publishers, timeout):
+    """Wait until the lines handed to client are published, for a
+    Checkpoint. A failed batch raises its error only once, maybe already
+    ending the run, so fail here too rather than save a checkpoint that
+    covers its lines."""
+    client.flush(timeout)
+    failed = sum(stats['failed'] for stats in publishers.stats().values())
+    if failed:
+        raise RuntimeError("%s messages failed to publish" % failed)
+
+
+def load_checkpoint(state_file):
+    """Return the state saved by Checkpoint, or None if there is none."""
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+class Checkpoint(object):
+    """Saves how far a run got to a state file, every `every` lines and
+    when the run ends, including when it fails.
+
+    update() is called once a line has been handed to the publisher, and
+    flush() is called to wait until those lines are published before
+    saving, so the state never covers lines that weren't. The file is
+    replaced atomically, so a crash while saving leaves the previous
+    checkpoint.
+    """
+
+    def __init__(self, state_file, every, source, flush):
+        self.state_file = state_file
+        self.every = every
+        self.source = source
+        self.flush = flush
+        self.state = None
+        self.updates = 0
+
+    def update(self, position, line_count, incident_count, prev_date):
+        self.state = {'source': self.source,
+                      'position': position,
+                      'line_count': line_count,
+                      'incident_count': incident_count,
+                      'prev_date': prev_date.isoformat()}
+        self.updates += 1
+        if self.updates % self.every == 0:
+            self.save()
+
+    def save(self):
+        if not self.state_file or self.state is None:
+            return
+        self.flush()
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_file, self.state_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.save()
+        except Exception:
+            # A batch failed to publish, so keep the previous checkpoint.
+            if exc_type is None:
+                raise
+
+
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--replay", help="Replay in 'real time'",
                         action="store_true")
@@ -193,101 +448,375 @@ def main(argv):
                         "sometimes introduce delays between log date and " +
                         "publish timestamp.",
                         action="store_true")
-    parser.add_argument("--filename", help="input filename")
+    parser.add_argument("--filename", nargs="+",
+                        help="input files or globs, which may be .gz, " +
+                        ".bz2 or .zst compressed; several files are " +
+                        "merged by timestamp")
+    parser.add_argument("--synthetic",
+                        help="Generate random readings instead of reading " +
+                        "them from --filename.",
+                        action="store_true")
+    parser.add_argument("--stations", type=int, default=100,
+                        help="The number of stations to generate readings " +
+                        "for with --synthetic. Each reports every 5 minutes.")
+    parser.add_argument("--span_hours", type=float, default=24,
+                        help="The hours of readings to generate with " +
+                        "--synthetic. 0 generates readings forever.")
+    parser.add_argument("--seed", type=int,
+                        help="Seed for the random readings, delays and " +
+                        "incidents, to make runs reproducible.")
     parser.add_argument("--num_lines", type=int, default=0,
                         help="The number of lines to process. " +
                         "0 indicates all.")
     parser.add_argument("--topic", default=TRAFFIC_TOPIC,
                         help="The pubsub 'traffic' topic to publish to. " +
                         "Should already exist.")
+    parser.add_argument("--route", action="append", default=[],
+                        help="Publish the rows matching a rule " +
+                        "'[COLUMN=VALUE[|VALUE...]:]TOPIC' to TOPIC, " +
+                        "which may contain {column} placeholders. Can be " +
+                        "given more than once; the first match wins.")
+    parser.add_argument("--stats_seconds", type=float,
+                        default=STATS_SECONDS,
+                        help="How often to print per-topic statistics. " +
+                        "0 prints them only at the end.")
     parser.add_argument("--incident_topic", default=INCIDENT_TOPIC,
                         help="The pubsub 'incident' topic to publish to. " +
                         "Only used if the --incidents flag is set. " +
                         "If so, should already exist.")
-    args = parser.parse_args()
-
-    pubsub_topic = args.topic
-    print "Publishing to pubsub 'traffic' topic: %s" % pubsub_topic
-    incidents = args.incidents
-    random_delays = args.random_delays
-    if incidents:
-        incident_topic = args.incident_topic
-        print "Publishing to pubsub 'incident' topic: %s" % incident_topic
-    filename = args.filename
-    print "filename: %s" % filename
-    replay = args.replay
-    print "replay mode: %s" % replay
-    current = args.current
-    print "current date mode: %s" % current
-    num_lines = args.num_lines
-    if num_lines:
-        print "processing %s lines" % num_lines
-
-    client = create_pubsub_client()
-    dt = parse('01/01/2010 00:00:00')  # earliest date in the traffic files
-    now = datetime.datetime.utcnow()
-    # used if altering date to replay from start time
-    diff = now - dt
-    # used if running in 'replay' mode, reflecting pauses in the data
-    prev_date = dt
-    restart_time = now
-    line_count = 0
-    incident_count = 0
-
-    print "processing %s" % filename  # process the traffic data file
-    with open(filename) as data_file:
-        reader = csv.reader(data_file)
-        for line in reader:
-            line_count += 1
-            if num_lines:  # if terminating after num_lines processed
-                if line_count >= num_lines:
-                    print "Have processed %s lines" % num_lines
-                    break
-            if (line_count % LINE_BATCHES) == 0:
-                print "%s lines processed" % line_count
-            ts = ""
+    parser.add_argument("--state_file",
+                        help="Periodically save how far the run got to " +
+                        "this file, for --resume.")
+    parser.add_argument("--checkpoint_lines", type=int,
+                        default=CHECKPOINT_LINES,
+                        help="The number of lines between checkpoints.")
+    parser.add_argument("--resume",
+                        help="Continue from the checkpoint in --state_file " +
+                        "instead of from the first line.",
+                        action="store_true")
+    parser.add_argument("--batch_size", type=int,
+                        default=pubsub_publisher.BATCH_SIZE,
+                        help="The maximum number of messages per publish " +
+                        "request.")
+    parser.add_argument("--publish_workers", type=int,
+                        default=pubsub_publisher.PUBLISH_WORKERS,
+                        help="The number of publish requests in flight.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Tune the batch size and the requests in " +
+                        "flight of every topic to the observed latency, " +
+                        "throttling and throughput, starting from " +
+                        "--batch_size and up to --publish_workers.")
+    parser.add_argument("--rate", type=float,
+                        help="Target rate in messages per second.")
+    parser.add_argument("--byte_rate", type=float,
+                        help="Target rate in payload bytes per second.")
+    parser.add_argument("--rate_profile", default="constant",
+                        help="How --rate and --byte_rate vary over time: " +
+                        "constant, step:SECONDS:STEPS, ramp:SECONDS or " +
+                        "sine:SECONDS[:AMPLITUDE].")
+    parser.add_argument("--chunk_size", type=int, default=0,
+                        help="Transform rows in chunks of this many rows " +
+                        "with NumPy (e.g. 50000) instead of one by one. " +
+                        "0 disables chunking.")
+    parser.add_argument("--probe", action="store_true",
+                        help="Stamp messages with a sequence number and " +
+                        "send time, for pull_messages --latency.")
+    parser.add_argument("--codec",
+                        help="Encode published data with these codecs, " +
+                        "e.g. 'zlib' or 'row+zlib'. Available: " +
+                        ", ".join(pubsub_codec.CODECS))
+    parser.add_argument("--drain_seconds", type=float,
+                        default=pubsub_shutdown.DRAIN_SECONDS,
+                        help="Seconds to publish what is in flight on " +
+                        "SIGTERM or Ctrl-C.")
+    parser.add_argument("--transport", default="rest",
+                        choices=pubsub_transport.TRANSPORTS,
+                        help="How to talk to Cloud Pub/Sub.")
+    pubsub_profile.add_arguments(parser)
+    return parser
+
+
+def parse_args(argv):
+    """Parse and check the command line.
+
+    Returns the arguments, the Router of --route, and the rate profiles of
+    --rate and --byte_rate, or None.
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv[1:])
+    if not args.filename and not args.synthetic:
+        parser.error("either --filename or --synthetic is required")
+    if args.filename:
+        try:
+            args.filename = traffic_inputs.expand_inputs(args.filename)
+        except ValueError, e:
+            parser.error(str(e))
+    if args.resume and not args.state_file:
+        parser.error("--resume requires --state_file")
+    try:
+        message_rate = byte_rate = None
+        if args.rate:
+            message_rate = pubsub_publisher.parse_profile(args.rate_profile,
+                                                          args.rate)
+        if args.byte_rate:
+            byte_rate = pubsub_publisher.parse_profile(args.rate_profile,
+                                                       args.byte_rate)
+        router = Router(args.route, args.topic)
+    except ValueError, e:
+        parser.error(str(e))
+    return args, router, message_rate, byte_rate
+
+
+def print_settings(args):
+    """Print what the run is going to do."""
+    print "Publishing to pubsub 'traffic' topic: %s" % args.topic
+    for rule in args.route:
+        print "Routing rows with: %s" % rule
+    if args.incidents:
+        print ("Publishing to pubsub 'incident' topic: %s" %
+               args.incident_topic)
+    if not args.synthetic:
+        print "filename: %s" % ", ".join(args.filename)
+    print "replay mode: %s" % args.replay
+    print "current date mode: %s" % args.current
+    if args.codec:
+        pubsub_codec.split_codec(args.codec)  # fail early on unknown codecs
+        print "encoding data with: %s" % args.codec
+    if args.num_lines:
+        print "processing %s lines" % args.num_lines
+
+
+class TopicCreator(object):
+    """Creates the topics of the memory transport on first use, since the
+    in-process stand-in starts out without any. Other transports publish
+    to topics that already exist."""
+
+    def __init__(self, transport, enabled):
+        self.transport = transport
+        self.enabled = enabled
+        self.created = set()
+
+    def ensure(self, topic):
+        if self.enabled and topic not in self.created:
             try:
-                timestring = line[0]
-                orig_date = parse(timestring)
-                if current:  # if using --current flag
-                    (line, ts) = process_current_mode(
-                        orig_date, diff, line, replay, random_delays)
-                else:  # not using --current flag
-                    (line, ts) = process_noncurrent_mode(
-                        orig_date, line, random_delays)
-
-                if replay and orig_date != prev_date:
-                    date_delta = orig_date - prev_date
-                    print "date delta: %s" % date_delta.total_seconds()
-                    current_time = datetime.datetime.utcnow()
-                    timelapse = current_time - restart_time
-                    print "timelapse: %s" % timelapse.total_seconds()
-                    d2 = date_delta - timelapse
-                    sleeptime = d2.total_seconds()
-                    print "sleeping %s" % sleeptime
-                    time.sleep(sleeptime)
-                    restart_time = datetime.datetime.utcnow()
-                    print "restart_time is set to: %s" % restart_time
-                prev_date = orig_date
-                msg_attributes = {'timestamp': ts}
-                publish(client, pubsub_topic, ",".join(line), msg_attributes)
-                if incidents:  # if generating traffic 'incidents' as well
-                    # randomly determine whether we'll generate an incident
-                    # associated with this reading.
-                    if random.random() < INCIDENT_THRESH:
-                        print "Generating a traffic incident for %s." % line
-                        # grab the timestring, station id, freeway, and
-                        # direction of travel.
-                        # Then generate some 'incident' data and publish it to
-                        # the incident topic.  Use the incident count as a
-                        # simplistic id.
-                        incident_count += 1
-                        publish_random_incident(client, incident_topic,
-                                                incident_count,
-                                                line[0], line[1], line[2],
-                                                line[3], msg_attributes)
-            except ValueError, e:
-                sys.stderr.write("---Error: %s for %s\n" % (e, line))
+                self.transport.create_topic(topic)
+            except pubsub_transport.TransportError, e:
+                if e.status != 409:  # e.g. created earlier in the process
+                    raise
+            self.created.add(topic)
+
+
+def create_publishers(args, message_rate, byte_rate):
+    """Create the transport and the publishers of a run.
+
+    Returns the TopicCreator, the MultiTopicPublisher that reports the
+    statistics, and the client to publish with, which is rate limited
+    with --rate or --byte_rate.
+    """
+    transport = create_pubsub_client(args.transport)
+    topics = TopicCreator(transport, args.transport == 'memory')
+    topics.ensure(args.topic)
+    if args.incidents:
+        topics.ensure(args.incident_topic)
+    # Every topic gets its own batches and publish requests in flight.
+    publishers = client = pubsub_publisher.MultiTopicPublisher(
+        transport, args.batch_size, args.publish_workers,
+        adaptive=args.adaptive)
+    if message_rate or byte_rate:
+        print "publishing at %s msgs/s, %s bytes/s (%s)" % (
+            args.rate or 'any', args.byte_rate or 'any', args.rate_profile)
+        client = pubsub_publisher.RateLimitedPublisher(
+            client, message_rate, byte_rate)
+    return topics, publishers, client
+
+
+class RowPublisher(object):
+    """Publishes the rows of a run, keeping track of how far it got.
+
+    Every row gets its timestamps transformed, is paced by its data
+    timestamp with --replay, and is published along with any incident
+    generated for it.
+    """
+
+    def __init__(self, args, client, router, topics, prober, shutdown):
+        self.args = args
+        self.client = client
+        self.router = router
+        self.topics = topics
+        self.prober = prober
+        self.shutdown = shutdown
+        dt = parse('01/01/2010 00:00:00')  # earliest date in the traffic files
+        now = datetime.datetime.utcnow()
+        # used if altering date to replay from start time
+        self.diff = now - dt
+        # used if running in 'replay' mode, reflecting pauses in the data
+        self.prev_date = dt
+        self.restart_time = now
+        self.position = 0
+        self.line_count = 0
+        self.incident_count = 0
+        # random.Random() without a seed is seeded from the system, like the
+        # global random functions.
+        self.rng = random.Random(args.seed)
+
+    def resume(self, state_file, source):
+        """Continue from the checkpoint in state_file, if there is one."""
+        state = load_checkpoint(state_file)
+        if not state:
+            print "no checkpoint in %s, starting over" % state_file
+            return
+        if state['source'] != source:
+            sys.exit("%s has a checkpoint for %s, not %s" %
+                     (state_file, state['source'], source))
+        self.position = state['position']
+        self.line_count = state['line_count']
+        self.incident_count = state['incident_count']
+        self.prev_date = parse(state['prev_date'])
+        # Carry on from the last published line at the current time.
+        self.diff = self.restart_time - self.prev_date
+        print "resuming after %s lines" % self.line_count
+
+    def rows(self, reader):
+        """Yield (line, processed) for the rows of reader; processed is
+        the transformed row with --chunk_size, and None otherwise."""
+        args = self.args
+        if not args.chunk_size:
+            return ((line, None) for line in reader)
+        import traffic_chunks
+        return traffic_chunks.iter_processed_rows(
+            reader, args.chunk_size, self.diff, args.current, args.replay,
+            args.random_delays, INCIDENT_THRESH if args.incidents else 0,
+            args.seed)
+
+    def transform(self, line):
+        """Return the line with its date adjusted, its timestamp
+        attribute and its original date."""
+        args = self.args
+        with pubsub_profile.span('parse'):
+            orig_date = parse(line[0])
+            if args.current:  # if using --current flag
+                (line, ts) = process_current_mode(
+                    orig_date, self.diff, line, args.replay,
+                    args.random_delays, self.rng)
+            else:  # not using --current flag
+                (line, ts) = process_noncurrent_mode(
+                    orig_date, line, args.random_delays, self.rng)
+        return line, ts, orig_date
+
+    def pace(self, orig_date):
+        """With --replay, sleep for as long as the data timestamps moved
+        ahead since the previous row, less the time spent since."""
+        if self.args.replay and orig_date != self.prev_date:
+            date_delta = orig_date - self.prev_date
+            print "date delta: %s" % date_delta.total_seconds()
+            current_time = datetime.datetime.utcnow()
+            timelapse = current_time - self.restart_time
+            print "timelapse: %s" % timelapse.total_seconds()
+            d2 = date_delta - timelapse
+            sleeptime = d2.total_seconds()
+            print "sleeping %s" % sleeptime
+            self.shutdown.wait(sleeptime)
+            self.restart_time = datetime.datetime.utcnow()
+            print "restart_time is set to: %s" % self.restart_time
+        self.prev_date = orig_date
+
+    def stamp(self, topic, msg_attributes):
+        if self.prober:
+            return self.prober.stamp(topic, msg_attributes)
+        return msg_attributes
+
+    def publish_incident(self, line, msg_attributes):
+        """Generate some 'incident' data from the timestring, station id,
+        freeway, and direction of travel of a reading, and publish it to
+        the incident topic. Use the incident count as a simplistic id."""
+        print "Generating a traffic incident for %s." % line
+        self.incident_count += 1
+        incident_topic = self.args.incident_topic
+        publish_random_incident(self.client, incident_topic,
+                                self.incident_count,
+                                line[0], line[1], line[2], line[3],
+                                self.stamp(incident_topic, msg_attributes),
+                                self.args.codec, self.rng)
+
+    def publish_row(self, line, ts, is_incident):
+        """Publish a transformed row, and maybe an incident for it."""
+        msg_attributes = {'timestamp': ts}
+        topic = self.router.route(line)
+        self.topics.ensure(topic)
+        publish(self.client, topic, ",".join(line),
+                self.stamp(topic, msg_attributes), self.args.codec)
+        if not self.args.incidents:
+            return
+        # randomly determine whether we'll generate an incident
+        # associated with this reading.
+        if is_incident is None:
+            is_incident = self.rng.random() < INCIDENT_THRESH
+        if is_incident:
+            self.publish_incident(line, msg_attributes)
+
+    def handle(self, line, processed):
+        """Transform, pace and publish a row. Rows that can't be parsed
+        are reported and skipped."""
+        try:
+            if processed:  # already transformed by traffic_chunks
+                (line, ts, orig_date, is_incident) = processed
+            else:
+                (line, ts, orig_date) = self.transform(line)
+                is_incident = None
+            self.pace(orig_date)
+            self.publish_row(line, ts, is_incident)
+        except ValueError, e:
+            sys.stderr.write("---Error: %s for %s\n" % (e, line))
+
+
+def make_prober(args):
+    """Return the Prober that stamps messages with --probe, or None."""
+    if not args.probe:
+        return None
+    prober = pubsub_latency.Prober()
+    print "stamping messages as latency probe: %s" % prober.source
+    return prober
+
+
+def main(argv):
+    args, router, message_rate, byte_rate = parse_args(argv)
+    print_settings(args)
+    prober = make_prober(args)
+    topics, publishers, client = create_publishers(args, message_rate,
+                                                   byte_rate)
+    shutdown = pubsub_shutdown.Shutdown(args.drain_seconds)
+    rows = RowPublisher(args, client, router, topics, prober, shutdown)
+    source = get_source(args)
+    if args.resume:
+        rows.resume(args.state_file, source)
+    next_stats = time.time() + args.stats_seconds
+
+    with shutdown, pubsub_profile.from_args(args), \
+            open_rows(args, rows.position) as (reader, positions), \
+            draining(client, shutdown), \
+            Checkpoint(args.state_file, args.checkpoint_lines, source,
+                       lambda: flush_published(client, publishers,
+                                               shutdown.remaining())) \
+            as checkpoint:
+        for line, processed in rows.rows(reader):
+            if shutdown.requested():
+                print "stopping after %s lines" % rows.line_count
+                break
+            position = positions.popleft()
+            rows.line_count += 1
+            # if terminating after num_lines processed
+            if args.num_lines and rows.line_count >= args.num_lines:
+                print "Have processed %s lines" % args.num_lines
+                break
+            if (rows.line_count % LINE_BATCHES) == 0:
+                print "%s lines processed" % rows.line_count
+            rows.handle(line, processed)
+            checkpoint.update(position, rows.line_count, rows.incident_count,
+                              rows.prev_date)
+            if args.stats_seconds and time.time() >= next_stats:
+                publishers.report()
+                next_stats = time.time() + args.stats_seconds
+    publishers.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic traffic sensor readings, used by traffic_pubsub_generator.py's
+--synthetic flag instead of an input file.
+
+The rows have the same columns as the San Diego freeway files:
+timestamp, station id, freeway, direction of travel, lane type, station
+length, samples, % observed and average speed. Every station reports once
+per interval, and readings are produced in timestamp order, so the rows
+work with --replay and --current like the real data. All values come from
+the given random.Random, so a seeded generator always produces the same
+rows.
+"""
+import datetime
+import math
+
+# Same start as the traffic files, so --current and --replay line up.
+START = datetime.datetime(2010, 1, 1)
+INTERVAL_SECONDS = 300  # the traffic files have a reading every 5 minutes
+
+FREEWAYS = [(5, 'NS'), (8, 'EW'), (15, 'NS'), (52, 'EW'), (56, 'EW'),
+            (78, 'EW'), (94, 'EW'), (125, 'NS'), (163, 'NS'), (805, 'NS')]
+FREE_FLOW_SPEED = 65.0  # mph
+RUSH_HOURS = [8, 17.5]  # when speeds are lowest, in hours of the day
+
+
+def make_stations(rng, count):
+    """Returns count (station id, freeway, direction, length) tuples."""
+    stations = []
+    for i in range(count):
+        freeway, directions = FREEWAYS[rng.randrange(len(FREEWAYS))]
+        stations.append((1100000 + i, freeway, rng.choice(directions),
+                         '%.2f' % rng.uniform(.1, 2)))
+    return stations
+
+
+def average_speed(rng, when):
+    """A noisy speed reading, slower around the rush hours."""
+    hour = when.hour + when.minute / 60.0
+    slowdown = max(math.exp(-(hour - rush) ** 2) for rush in RUSH_HOURS)
+    speed = FREE_FLOW_SPEED * (1 - .6 * slowdown) + rng.gauss(0, 3)
+    return min(max(speed, 3.0), 80.0)
+
+
+def generate_rows(rng, stations=100, span=datetime.timedelta(days=1),
+                  interval=INTERVAL_SECONDS, start=START):
+    """Yield readings of stations for span (forever if None) as lists."""
+    station_info = make_stations(rng, stations)
+    step = datetime.timedelta(seconds=interval)
+    when = start
+    while span is None or when < start + span:
+        timestring = when.strftime('%Y-%m-%d %H:%M:%S')
+        for station_id, freeway, direction, length in station_info:
+            yield [timestring, str(station_id), str(freeway), direction,
+                   'ML', length, str(rng.randint(1, 10)),
+                   '%.1f' % rng.uniform(50, 100),
+                   '%.1f' % average_speed(rng, when)]
+        when += step
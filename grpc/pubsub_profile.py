@@ -0,0 +1 @@
+../cmdline-pull/pubsub_profile.py
\ No newline at end of file
@@ -19,14 +19,18 @@
 from __future__ import print_function
 
 
+import argparse
 import logging
+import os
 import sys
+import time
 
 from google.pubsub.v1 import pubsub_pb2
 from grpc.beta import implementations
-from grpc.framework.interfaces.face.face import NetworkError
 
-from oauth2client import client
+import pubsub_latency
+import pubsub_profile
+import pubsub_transport
 
 
 logging.basicConfig(level=logging.INFO)
@@ -35,14 +39,14 @@ log.setLevel(logging.INFO)
 
 PUBSUB_ENDPOINT = "pubsub.googleapis.com"
 SSL_PORT = 443
-OAUTH_SCOPE = "https://www.googleapis.com/auth/pubsub",
-GOOGLE_CREDS = client.GoogleCredentials.get_application_default()
-SCOPED_CREDS = GOOGLE_CREDS.create_scoped(OAUTH_SCOPE)
 TIMEOUT = 30
+BATCH_SIZE = 100
+REPORT_SECONDS = 10
 
 
-def auth_func(scoped_creds=SCOPED_CREDS):
+def auth_func(scoped_creds=None):
     """Returns a token obtained from Google Creds."""
+    scoped_creds = scoped_creds or pubsub_transport.get_credentials()
     authn = scoped_creds.get_access_token().access_token
     return [('authorization', 'Bearer %s' % authn)]
 
@@ -54,37 +58,77 @@ def make_channel_creds(ssl_creds, auth_func=auth_func):
     return implementations.composite_channel_credentials(ssl_creds, call_creds)
 
 
-def create_pubsub_stub(host=PUBSUB_ENDPOINT, port=SSL_PORT):
-    """Creates a secure pubsub channel."""
+def create_pubsub_transport(host=PUBSUB_ENDPOINT, port=SSL_PORT):
+    """Creates a transport over a secure pubsub channel, or over a plain
+    one to the emulator at PUBSUB_EMULATOR_HOST when it is set."""
+    emulator_host = os.environ.get(pubsub_transport.EMULATOR_HOST_ENV)
+    if emulator_host:
+        return pubsub_transport.GrpcTransport.create_insecure(emulator_host)
     ssl_creds = implementations.ssl_channel_credentials(None, None, None)
     channel_creds = make_channel_creds(ssl_creds, auth_func)
     channel = implementations.secure_channel(host, port, channel_creds)
-    return pubsub_pb2.beta_create_Publisher_stub(channel)
+    return pubsub_transport.GrpcTransport(
+        pubsub_pb2.beta_create_Publisher_stub(channel),
+        pubsub_pb2.beta_create_Subscriber_stub(channel),
+        timeout=TIMEOUT)
 
 
-def list_topics(stub, project):
+def list_topics(transport, project):
     """Lists topics in the given project."""
-    req = pubsub_pb2.ListTopicsRequest(project=project)
     try:
-        resp = stub.ListTopics(req, TIMEOUT)
-        for t in resp.topics:
-            print("Topic is: {}".format(t.name))
-    except NetworkError, e:
+        with pubsub_profile.span('list topics'):
+            topics, _ = transport.list_topics(project)
+        for t in topics:
+            print("Topic is: {}".format(t['name']))
+    except pubsub_transport.TransportError, e:
         logging.warning('Failed to list topics: {}'.format(e))
         sys.exit(1)
 
 
-def usage():
-    """Prints usage to the stderr."""
-    print('{} project_id'.format(sys.argv[0]), file=sys.stderr)
+def report_latency(transport, subscription):
+    """Pulls the messages of a subscription and logs their latency."""
+    probe = pubsub_latency.LatencyProbe()
+    next_report = time.time() + REPORT_SECONDS
+    try:
+        while True:
+            try:
+                with pubsub_profile.span('pull'):
+                    received = transport.pull(subscription, BATCH_SIZE)
+                for received_message in received:
+                    probe.record(received_message.message)
+                if received:
+                    with pubsub_profile.span('ack', messages=len(received)):
+                        transport.acknowledge(
+                            subscription, [r.ack_id for r in received])
+            except pubsub_transport.TransportError, e:
+                logging.warning('Failed to pull messages: {}'.format(e))
+                time.sleep(0.5)
+            if time.time() >= next_report:
+                log.info('Latency of %s:\n%s', subscription, probe.report())
+                next_report += REPORT_SECONDS
+    except KeyboardInterrupt:
+        pass
+    log.info('Latency of %s:\n%s', subscription, probe.report())
 
 
 def main():
-    if len(sys.argv) < 2:
-        usage()
-        exit(1)
-    stub = create_pubsub_stub()
-    list_topics(stub, 'projects/{}'.format(sys.argv[1]))
+    parser = argparse.ArgumentParser(
+        description='Lists the topics of a project over gRPC, or measures '
+        'the latency of a subscription')
+    parser.add_argument('project_id', help='Project name in console')
+    parser.add_argument(
+        '--latency', metavar='SUBSCRIPTION',
+        help='Instead of listing topics, pull the messages of SUBSCRIPTION '
+        'and log their latency, and the gaps and duplicates of probes')
+    pubsub_profile.add_arguments(parser)
+    args = parser.parse_args()
+    transport = create_pubsub_transport()
+    with pubsub_profile.from_args(args):
+        if args.latency:
+            report_latency(transport, 'projects/{}/subscriptions/{}'.format(
+                args.project_id, args.latency))
+        else:
+            list_topics(transport, 'projects/{}'.format(args.project_id))
 
 
 if __name__ == '__main__':